@@ -7,6 +7,7 @@ import os
 from flask import Flask, render_template, session
 from werkzeug.middleware.proxy_fix import ProxyFix
 from project.extensions import database, csrf, bootstrap, mail
+from project.instrumentation import init_sql_instrumentation
 from dotenv import load_dotenv
 from datetime import timedelta
 from flask_wtf.csrf import CSRFError
@@ -55,6 +56,57 @@ def create_app():
         # 時區台灣時間
         MYSQL_INIT_COMMAND="SET time_zone = '+08:00'",
 
+        # MySQL 連線池 (每個 gunicorn worker 各自一個池)
+        MYSQL_POOL_MIN_SIZE=int(os.environ.get("MYSQL_POOL_MIN_SIZE", 1)),
+        MYSQL_POOL_MAX_SIZE=int(os.environ.get("MYSQL_POOL_MAX_SIZE", 10)),
+        MYSQL_POOL_MAX_LIFETIME=int(
+            os.environ.get("MYSQL_POOL_MAX_LIFETIME", 1800)),
+        MYSQL_POOL_TIMEOUT=float(os.environ.get("MYSQL_POOL_TIMEOUT", 10)),
+        MYSQL_POOL_PING_INTERVAL=float(
+            os.environ.get("MYSQL_POOL_PING_INTERVAL", 10)),
+
+        # SQL 查詢統計 (Server-Timing header + project.sql log)
+        SQL_INSTRUMENTATION=os.environ.get("SQL_INSTRUMENTATION", "1") == "1",
+        SQL_SLOW_QUERY_TOP=int(os.environ.get("SQL_SLOW_QUERY_TOP", 3)),
+        # 測試時設為 True：路由查詢次數超過 @query_budget 直接報錯
+        SQL_QUERY_BUDGET_STRICT=os.environ.get(
+            "SQL_QUERY_BUDGET_STRICT", "0") == "1",
+
+        # 導覽列分類快取秒數 (各 worker 最長延遲)
+        CATEGORY_CACHE_TTL=int(os.environ.get("CATEGORY_CACHE_TTL", 600)),
+        # 首頁精選區塊快取秒數
+        HOMEPAGE_CACHE_TTL=int(os.environ.get("HOMEPAGE_CACHE_TTL", 300)),
+        # 熱門產品快取秒數 (銷量表本身即時更新，這裡只省掉重複查詢)
+        POPULAR_CACHE_TTL=int(os.environ.get("POPULAR_CACHE_TTL", 60)),
+        # 前台預約行事曆快取秒數 (其他 worker 的最長延遲)
+        SCHEDULE_CACHE_TTL=int(os.environ.get("SCHEDULE_CACHE_TTL", 30)),
+        # 進階報表：今天的每日彙總多久重算一次 (秒)，過去的日期彙總後即封存
+        REPORT_ROLLUP_TODAY_TTL=int(
+            os.environ.get("REPORT_ROLLUP_TODAY_TTL", 60)),
+        # 報表匯出：server-side cursor 每批讀取筆數
+        EXPORT_CHUNK_SIZE=int(os.environ.get("EXPORT_CHUNK_SIZE", 1000)),
+        # 文章瀏覽數批次寫回間隔 (秒)
+        VIEW_COUNTER_FLUSH_INTERVAL=float(
+            os.environ.get("VIEW_COUNTER_FLUSH_INTERVAL", 30)),
+
+        # 通知 outbox (設為 0 則 web 程序不送信，改由 flask outbox-worker 處理)
+        OUTBOX_INPROCESS_WORKER=os.environ.get(
+            "OUTBOX_INPROCESS_WORKER", "1") == "1",
+        OUTBOX_MAX_WORKERS=int(os.environ.get("OUTBOX_MAX_WORKERS", 4)),
+        OUTBOX_MAX_ATTEMPTS=int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 6)),
+        # 已送出 / 失敗的通知保留天數 (之後由 worker 刪除)
+        OUTBOX_RETENTION_DAYS=int(os.environ.get("OUTBOX_RETENTION_DAYS", 14)),
+        # 管理員 LINE 群組通知合併秒數 (0 = 每則立即送出)
+        ADMIN_DIGEST_WINDOW=int(os.environ.get("ADMIN_DIGEST_WINDOW", 60)),
+
+        # 對外 HTTP API (SendGrid / LINE) 的 connect / read timeout 秒數
+        HTTP_CONNECT_TIMEOUT=float(
+            os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05)),
+        HTTP_READ_TIMEOUT=float(os.environ.get("HTTP_READ_TIMEOUT", 10)),
+        # 對外 API 的 DNS 快取秒數與位址偏好 (ipv4 / ipv6 / any)，只影響上面這些 client
+        HTTP_DNS_TTL=int(os.environ.get("HTTP_DNS_TTL", 300)),
+        HTTP_DNS_FAMILY=os.environ.get("HTTP_DNS_FAMILY", "ipv4"),
+
         # Email configuration
         SENDGRID_API_KEY=os.environ.get("SENDGRID_API_KEY"),
         MAIL_DEFAULT_SENDER=os.environ.get("MAIL_DEFAULT_SENDER"),
@@ -89,22 +141,29 @@ def create_app():
     csrf.init_app(app)
     bootstrap.init_app(app)
     mail.init_app(app)
+    init_sql_instrumentation(app, database)
+
+    from project.counters import post_view_counter
+    post_view_counter.init_app(app)
+
+    from project.outbox import outbox_worker
+    outbox_worker.init_app(app)
+
+    from project.http_clients import http_clients
+    http_clients.init_app(app)
+
+    # CLI commands (flask rebuild-sales-stats ...)
+    from project.commands import register_commands
+    register_commands(app)
 
     # Context processors
     @app.context_processor
     def inject_common_data():
-        from project.db import get_current_user_role, get_current_user_id
+        from project.db import get_current_user_role, get_current_user_id, get_nav_categories
 
         try:
-            cursor = database.connection.cursor()
-            cursor.execute(
-                "SELECT id, name FROM product_categories ORDER BY display_order, name")
-            product_categories = cursor.fetchall()
-
-            cursor.execute(
-                "SELECT id, name FROM course_categories ORDER BY display_order, name")
-            course_categories = cursor.fetchall()
-            cursor.close()
+            # ⭐ 分類幾乎不會變動，改讀程序內快取 (後台新增/刪除分類時會清除)
+            product_categories, course_categories = get_nav_categories()
 
             return dict(
                 product_categories=product_categories,
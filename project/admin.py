@@ -18,7 +18,11 @@ from decimal import Decimal
 # from project.services import admin_update_order_with_inventory
 from project.db import get_current_user_id
 from project.audit import log_activity
+from project.cache import category_cache, homepage_cache, invalidate_schedule_cache, popular_cache
 from project.decorators import admin_required, staff_required
+from project.instrumentation import query_budget
+from project.services import (apply_booking_kpis, apply_order_kpis, get_kpi_summary,
+                              record_product_sales, refresh_catalog_kpis, status_kpi_sign)
 
 # --- Cloudinary 設定 ---
 cloudinary.config(
@@ -64,303 +68,381 @@ def save_upload(file, upload_folder):
 
 
 @admin_bp.route('/dashboard')
+@query_budget(8)
 @staff_required
 def dashboard():
+    """
+    後台外框 + 總覽
+    ⭐ 各分頁的資料改由 dashboard_tab 在切換分頁時才載入，這裡只查總覽統計與彈窗需要的選單
+    """
     tab = request.args.get('tab', 'overview')
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
-    # 1. 基礎計數 (Counts)
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM products WHERE is_active = TRUE")
-    product_count = cursor.fetchone()['count']
-
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM courses WHERE is_active = TRUE")
-    course_count = cursor.fetchone()['count']
+    # 1. 總覽統計：kpi_summary 由各項異動同步維護，這裡只加總幾列
+    kpi = get_kpi_summary(cursor)
+    total_revenue = float(kpi['order_revenue']) + float(kpi['booking_revenue'])
+    total_cost = float(kpi['order_cost']) + float(kpi['course_cost'])
+    net_profit = total_revenue - total_cost
 
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM orders WHERE status != 'cancelled'")
-    order_count = cursor.fetchone()['count']
+    # 2. 彈窗用的選單資料 (只取需要的欄位)
+    # 分類選單由 context processor 提供 (get_nav_categories 快取)
+    cursor.execute("""
+        SELECT id, name, price, cost, stock_quantity
+        FROM products
+        ORDER BY display_order ASC, id DESC
+    """)
+    product_options = cursor.fetchall()
 
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM bookings WHERE status != 'cancelled'")
-    booking_count = cursor.fetchone()['count']
+    cursor.execute("""
+        SELECT id, name, duration, regular_price, experience_price
+        FROM courses
+        ORDER BY created_at DESC
+    """)
+    course_options = cursor.fetchall()
 
     cursor.execute(
-        "SELECT COUNT(*) as count FROM users WHERE role = 'customer'")
-    customer_count = cursor.fetchone()['count']
+        "SELECT id, firstname, surname, username FROM users WHERE role = 'customer' ORDER BY firstname")
+    customers = cursor.fetchall()
 
-    # ⭐ 修正 1: 資料表名稱 posts -> blog_posts
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM blog_posts WHERE status = 'published'")
-    post_count = cursor.fetchone()['count']
+    cursor.execute("SELECT * FROM customer_sources ORDER BY id")
+    customer_sources = cursor.fetchall()
 
-    # 2. 營收計算 (Revenue)
-    cursor.execute("""
-        SELECT
-            (SELECT COALESCE(SUM(total_amount), 0) FROM orders WHERE status != 'cancelled') +
-            (SELECT COALESCE(SUM(total_amount), 0) FROM bookings WHERE status != 'cancelled')
-        as total_revenue
-    """)
-    res = cursor.fetchone()
-    total_revenue = float(res['total_revenue']
-                          ) if res and res['total_revenue'] else 0.0
+    cursor.close()
 
-    # 訂單成本
-    cursor.execute("""
-        SELECT COALESCE(SUM(oi.quantity * p.cost), 0) as order_cost
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
-        JOIN orders o ON oi.order_id = o.id
-        WHERE o.status != 'cancelled'
-    """)
-    res = cursor.fetchone()
-    order_cost = float(res['order_cost']) if res and res['order_cost'] else 0.0
+    now = datetime.now()
 
-    # 課程成本
-    cursor.execute("""
-        SELECT COALESCE(SUM(b.sessions_purchased * (c.service_fee + c.product_fee)), 0) as course_cost
-        FROM bookings b
-        JOIN courses c ON b.course_id = c.id
-        WHERE b.status != 'cancelled'
-    """)
-    res = cursor.fetchone()
-    course_cost = float(
-        res['course_cost']) if res and res['course_cost'] else 0.0
+    stats = {
+        'products': kpi['products'],
+        'courses': kpi['courses'],
+        'orders': kpi['orders'],
+        'bookings': kpi['bookings'],
+        'customers': kpi['customers'],
+        'posts': kpi['posts'],
+        'revenue': total_revenue,
+        'net_profit': net_profit
+    }
 
-    total_cost = order_cost + course_cost
-    net_profit = total_revenue - total_cost
+    return render_template(
+        'admin_dashboard.html',
+        tab=tab,
+        stats=stats,
+        product_options=product_options,
+        course_options=course_options,
+        customers=customers,
+        customer_sources=customer_sources,
+        now_str=now.strftime('%Y-%m-%dT%H:%M')
+    )
 
-    # Recent orders
-    cursor.execute("""
-        SELECT o.id, o.total_amount, o.status, o.created_at,
-               u.username, u.firstname, u.surname
-        FROM orders o
-        JOIN users u ON o.customer_id = u.id
-        ORDER BY o.created_at DESC
-        LIMIT 10
-    """)
-    recent_orders = cursor.fetchall()
 
-    # Recent bookings
-    cursor.execute("""
-        SELECT b.id, b.sessions_purchased, b.total_amount, b.status, b.created_at,
-               u.username, u.firstname, u.surname, c.name as course_name
-        FROM bookings b
-        JOIN users u ON b.customer_id = u.id
-        JOIN courses c ON b.course_id = c.id
-        ORDER BY b.created_at DESC
-        LIMIT 10
-    """)
-    recent_bookings = cursor.fetchall()
+# =====================================================
+# DASHBOARD TABS (分頁資料，切換分頁時才以 AJAX 載入)
+# =====================================================
 
-    # Products
+def _load_products_tab(cursor, args):
     cursor.execute("""
         SELECT p.*, pc.name as category_name
         FROM products p
         LEFT JOIN product_categories pc ON p.category_id = pc.id
         ORDER BY p.display_order ASC, p.created_at DESC
     """)
-    products = cursor.fetchall()
+    return {'products': cursor.fetchall()}
 
-    # Courses
+
+def _load_courses_tab(cursor, args):
     cursor.execute("""
         SELECT c.*, cc.name as category_name
         FROM courses c
         LEFT JOIN course_categories cc ON c.category_id = cc.id
         ORDER BY c.created_at DESC
     """)
-    courses = cursor.fetchall()
+    return {'courses': cursor.fetchall()}
 
-    # Categories
-    cursor.execute(
-        "SELECT * FROM product_categories ORDER BY display_order, name")
-    product_categories = cursor.fetchall()
 
-    cursor.execute(
-        "SELECT * FROM course_categories ORDER BY display_order, name")
-    course_categories = cursor.fetchall()
-
-    # ⭐ 修正 2: Events 表不存在，暫時給空列表防止 500 錯誤
-    # cursor.execute("SELECT e.* ... FROM events e ...")
-    events = []
-
-    # Inventory
+def _load_posts_tab(cursor, args):
     cursor.execute("""
-        SELECT 
-            p.id, p.name, p.stock_quantity, p.cost, p.price, 
-            p.last_purchase_date, p.last_sale_date, p.unit,
-            p.image, p.description, c.name as category_name,
-            (SELECT notes FROM inventory_logs WHERE product_id = p.id ORDER BY created_at DESC LIMIT 1) as latest_note
-        FROM products p
-        LEFT JOIN product_categories c ON p.category_id = c.id
-        ORDER BY p.display_order ASC, p.id DESC
+        SELECT p.*, u.firstname, u.surname, CONCAT(u.firstname, ' ', u.surname) as author_name
+        FROM blog_posts p
+        LEFT JOIN users u ON p.author_id = u.id
+        ORDER BY p.created_at DESC
     """)
-    # 轉成 list 以便修改內容
-    inventory_products = list(cursor.fetchall())
+    return {'posts': cursor.fetchall()}
 
-    # ⭐ 新增：清理備註欄位 (只保留使用者輸入的內容)
-    for prod in inventory_products:
-        note = prod.get('latest_note') or ''
 
-        # 1. 去除進貨時系統自動加上的價格資訊 (截斷 '. 進貨價:' 之後的內容)
-        if '. 進貨價:' in note:
-            note = note.split('. 進貨價:')[0]
+ADMIN_LIST_PER_PAGE = 30
 
-        # 2. 去除完全是系統產生的預設文字
-        system_prefixes = ['Admin Manual Order',
-                           'Order Cancelled', 'Order Restored']
-        system_exact = ['Manual Restock']
 
-        # 如果備註是 "Manual Restock" (沒填寫時的預設值)，就清空
-        if note in system_exact:
-            note = ''
-        # 如果備註以 "Admin Manual Order" 開頭 (手動訂單)，就清空
-        elif any(note.startswith(prefix) for prefix in system_prefixes):
-            note = ''
+def _parse_list_filters(args, alias, sort_columns, default_sort):
+    """
+    訂單 / 預約列表共用的篩選條件
+    - status, date_from, date_to (依建立日期，date_to 當天也包含), q (客戶姓名 / 帳號 / Email / 電話)
+    - sort 只接受 sort_columns 內的欄位，dir = asc / desc
+    Returns: (filters, where_sql, params, order_sql)
+    """
+    filters = {
+        'status': args.get('status', '').strip(),
+        'date_from': args.get('date_from', '').strip(),
+        'date_to': args.get('date_to', '').strip(),
+        'q': args.get('q', '').strip(),
+        'sort': args.get('sort', default_sort),
+        'dir': 'asc' if args.get('dir') == 'asc' else 'desc',
+    }
+    if filters['sort'] not in sort_columns:
+        filters['sort'] = default_sort
 
-        prod['latest_note'] = note.strip()
+    where_clauses = ["1 = 1"]
+    params = []
 
-    # Customers
-    cursor.execute(
-        "SELECT id, firstname, surname, username FROM users WHERE role = 'customer' ORDER BY firstname")
-    customers = cursor.fetchall()
+    if filters['status']:
+        where_clauses.append(f"{alias}.status = %s")
+        params.append(filters['status'])
 
-    # Orders full list
-    cursor.execute("""
+    date_from = _parse_date(filters['date_from'])
+    if date_from:
+        where_clauses.append(f"{alias}.created_at >= %s")
+        params.append(date_from)
+    else:
+        filters['date_from'] = ''
+
+    date_to = _parse_date(filters['date_to'])
+    if date_to:
+        where_clauses.append(f"{alias}.created_at < %s")
+        params.append(date_to + timedelta(days=1))
+    else:
+        filters['date_to'] = ''
+
+    if filters['q']:
+        keyword = f"%{filters['q']}%"
+        where_clauses.append("""(CONCAT(u.firstname, ' ', u.surname) LIKE %s
+            OR u.username LIKE %s OR u.email LIKE %s OR u.phone LIKE %s)""")
+        params.extend([keyword] * 4)
+
+    order_sql = f"{sort_columns[filters['sort']]} {filters['dir'].upper()}, {alias}.id DESC"
+    return filters, " AND ".join(where_clauses), params, order_sql
+
+
+def _parse_date(value):
+    """YYYY-MM-DD -> datetime；空白或格式錯誤回傳 None (忽略該條件)"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def _paginate(cursor, count_sql, params, args):
+    """COUNT 總筆數並計算目前頁數，回傳 (page, total_pages, total, offset)"""
+    cursor.execute(count_sql, params)
+    total = cursor.fetchone()['total']
+    total_pages = max((total + ADMIN_LIST_PER_PAGE - 1) // ADMIN_LIST_PER_PAGE, 1)
+    page = min(max(args.get('page', 1, type=int) or 1, 1), total_pages)
+    return page, total_pages, total, (page - 1) * ADMIN_LIST_PER_PAGE
+
+
+ORDER_SORT_COLUMNS = {
+    'created_at': 'o.created_at',
+    'total_amount': 'o.total_amount',
+    'status': 'o.status',
+    'id': 'o.id',
+}
+
+
+def _load_orders_tab(cursor, args):
+    filters, where_sql, params, order_sql = _parse_list_filters(
+        args, 'o', ORDER_SORT_COLUMNS, 'created_at')
+
+    # 客戶條件要 JOIN users 才能篩選，沒有時 COUNT 只掃 orders
+    join_sql = "JOIN users u ON o.customer_id = u.id" if filters['q'] else ""
+    page, total_pages, total, offset = _paginate(cursor, f"""
+        SELECT COUNT(*) as total FROM orders o {join_sql} WHERE {where_sql}
+    """, params, args)
+
+    cursor.execute(f"""
         SELECT o.*, u.username, u.firstname, u.surname, u.email, u.phone
         FROM orders o
         JOIN users u ON o.customer_id = u.id
-        ORDER BY o.created_at DESC
-    """)
+        WHERE {where_sql}
+        ORDER BY {order_sql}
+        LIMIT %s OFFSET %s
+    """, params + [ADMIN_LIST_PER_PAGE, offset])
     orders = cursor.fetchall()
 
-    # Order Items Map
-    cursor.execute("""
-        SELECT oi.order_id, oi.quantity, oi.unit_price, oi.subtotal, p.name as product_name
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
-    """)
-    all_items = cursor.fetchall()
-
-    for item in all_items:
-        if isinstance(item.get('unit_price'), Decimal):
-            item['unit_price'] = float(item['unit_price'])
-        if isinstance(item.get('subtotal'), Decimal):
-            item['subtotal'] = float(item['subtotal'])
-
-    order_items_map = {}
-    for item in all_items:
-        oid = item['order_id']
-        if oid not in order_items_map:
-            order_items_map[oid] = []
-        order_items_map[oid].append(item)
-
     for order in orders:
         if isinstance(order.get('total_amount'), Decimal):
             order['total_amount'] = float(order['total_amount'])
 
+    # Order Items Map (只查這一頁的訂單)
+    order_items_map = {}
+    if orders:
+        in_sql = ', '.join(['%s'] * len(orders))
+        cursor.execute(f"""
+            SELECT oi.order_id, oi.quantity, oi.unit_price, oi.subtotal, p.name as product_name
+            FROM order_items oi
+            JOIN products p ON oi.product_id = p.id
+            WHERE oi.order_id IN ({in_sql})
+        """, [o['id'] for o in orders])
+
+        for item in cursor.fetchall():
+            if isinstance(item.get('unit_price'), Decimal):
+                item['unit_price'] = float(item['unit_price'])
+            if isinstance(item.get('subtotal'), Decimal):
+                item['subtotal'] = float(item['subtotal'])
+            order_items_map.setdefault(item['order_id'], []).append(item)
+
+    return {'orders': orders, 'order_items_map': order_items_map,
+            'filters': filters, 'page': page, 'total_pages': total_pages,
+            'total': total}
+
+
+BOOKING_SORT_COLUMNS = {
+    'created_at': 'b.created_at',
+    'start_time': 's.start_time',
+    'total_amount': 'b.total_amount',
+    'status': 'b.status',
+    'id': 'b.id',
+}
+
+
+def _load_bookings_tab(cursor, args):
+    filters, where_sql, params, order_sql = _parse_list_filters(
+        args, 'b', BOOKING_SORT_COLUMNS, 'created_at')
+
+    join_sql = "LEFT JOIN users u ON b.customer_id = u.id" if filters['q'] else ""
+    page, total_pages, total, offset = _paginate(cursor, f"""
+        SELECT COUNT(*) as total FROM bookings b {join_sql} WHERE {where_sql}
+    """, params, args)
+
     # ⭐ 修正 3: course_schedules -> shop_schedules
-    cursor.execute("""
+    cursor.execute(f"""
         SELECT b.*, u.username, u.firstname, u.surname, u.email, u.phone, u.line_id,
                c.name as course_name, c.duration, s.start_time, s.end_time
         FROM bookings b
         LEFT JOIN users u ON b.customer_id = u.id
         LEFT JOIN courses c ON b.course_id = c.id
         LEFT JOIN shop_schedules s ON b.global_schedule_id = s.id
-        ORDER BY b.created_at DESC
-    """)
+        WHERE {where_sql}
+        ORDER BY {order_sql}
+        LIMIT %s OFFSET %s
+    """, params + [ADMIN_LIST_PER_PAGE, offset])
     bookings = cursor.fetchall()
 
     for booking in bookings:
         if isinstance(booking.get('total_amount'), Decimal):
             booking['total_amount'] = float(booking['total_amount'])
 
-    # Customer list
+    return {'bookings': bookings, 'filters': filters, 'page': page,
+            'total_pages': total_pages, 'total': total}
+
+
+def _load_customers_tab(cursor, args):
     cursor.execute("""
         SELECT u.id, u.username, u.email, u.firstname, u.surname,
                u.phone, u.line_id, u.gender, u.occupation, u.created_at,
                u.birth_date, u.source_id, u.address, u.notes,
                TIMESTAMPDIFF(YEAR, u.birth_date, CURDATE()) as age,
                cs.name as source_name,
-               COUNT(DISTINCT o.id) as order_count,
-               COUNT(DISTINCT b.id) as booking_count
+               COALESCE(st.order_count, 0) as order_count,
+               COALESCE(st.booking_count, 0) as booking_count,
+               COALESCE(st.order_spent + st.booking_spent, 0) as total_spent,
+               st.last_activity_at
         FROM users u
         LEFT JOIN customer_sources cs ON u.source_id = cs.id
-        LEFT JOIN orders o ON u.id = o.customer_id
-        LEFT JOIN bookings b ON u.id = b.customer_id
+        LEFT JOIN customer_stats st ON st.customer_id = u.id
         WHERE u.role = 'customer'
-        GROUP BY u.id
         ORDER BY u.created_at DESC
     """)
-    customers_list = cursor.fetchall()
+    return {'customers_list': cursor.fetchall()}
 
-    # ⭐ 修正 4: blog_posts -> posts (變數名 posts 維持不變，SQL 改為 blog_posts)
+
+def _load_categories_tab(cursor, args):
+    cursor.execute(
+        "SELECT * FROM product_categories ORDER BY display_order, name")
+    product_categories = cursor.fetchall()
+
+    cursor.execute(
+        "SELECT * FROM course_categories ORDER BY display_order, name")
+    course_categories = cursor.fetchall()
+
+    return {'product_categories': product_categories,
+            'course_categories': course_categories}
+
+
+def _load_events_tab(cursor, args):
+    # ⭐ Events 表不存在，暫時給空列表防止 500 錯誤
+    return {'events': []}
+
+
+def _load_inventory_tab(cursor, args):
+    # ⭐ 備註直接讀 products.latest_note (進貨 / 盤點時寫入使用者輸入的內容)，不再逐筆查 inventory_logs
     cursor.execute("""
-        SELECT p.*, u.firstname, u.surname, CONCAT(u.firstname, ' ', u.surname) as author_name
-        FROM blog_posts p
-        LEFT JOIN users u ON p.author_id = u.id
-        ORDER BY p.created_at DESC
+        SELECT 
+            p.id, p.name, p.stock_quantity, p.cost, p.price, 
+            p.last_purchase_date, p.last_sale_date, p.unit,
+            p.image, p.description, c.name as category_name, p.latest_note
+        FROM products p
+        LEFT JOIN product_categories c ON p.category_id = c.id
+        ORDER BY p.display_order ASC, p.id DESC
     """)
-    posts = cursor.fetchall()
+    return {'inventory_products': cursor.fetchall()}
 
-    # Audit Logs
-    audit_logs = []
-    if session.get('user', {}).get('role') == 'admin':
-        # 檢查 audit_logs 表是否存在，避免 500
-        try:
-            cursor.execute("""
-                SELECT a.*, u.username, u.firstname, u.surname,
-                    CONCAT(u.firstname, ' ', u.surname) as operator_name
-                FROM audit_logs a
-                LEFT JOIN users u ON a.user_id = u.id
-                ORDER BY a.created_at DESC
-                LIMIT 50
-            """)
-            audit_logs = cursor.fetchall()
-        except:
-            audit_logs = []
 
-    cursor.execute("SELECT * FROM customer_sources ORDER BY id")
-    customer_sources = cursor.fetchall()
+def _load_logs_tab(cursor, args):
+    # 檢查 audit_logs 表是否存在，避免 500
+    try:
+        cursor.execute("""
+            SELECT a.*, u.username, u.firstname, u.surname,
+                CONCAT(u.firstname, ' ', u.surname) as operator_name
+            FROM audit_logs a
+            LEFT JOIN users u ON a.user_id = u.id
+            ORDER BY a.created_at DESC
+            LIMIT 50
+        """)
+        return {'audit_logs': cursor.fetchall()}
+    except Exception:
+        return {'audit_logs': []}
+
+
+DASHBOARD_TABS = {
+    'products': _load_products_tab,
+    'courses': _load_courses_tab,
+    'posts': _load_posts_tab,
+    'orders': _load_orders_tab,
+    'bookings': _load_bookings_tab,
+    'customers': _load_customers_tab,
+    'categories': _load_categories_tab,
+    'events': _load_events_tab,
+    'inventory': _load_inventory_tab,
+    'logs': _load_logs_tab,
+}
+
+# 只有 admin 可以看的分頁
+ADMIN_ONLY_TABS = {'logs'}
+
+
+@admin_bp.route('/dashboard/tab/<name>')
+@query_budget(5)  # 分頁查詢 3 + context processor 導覽分類 (快取過期時 2)
+@staff_required
+def dashboard_tab(name):
+    """回傳單一分頁的 HTML 片段 (JSON 包裝)，前端在 shown.bs.tab 時載入"""
+    loader = DASHBOARD_TABS.get(name)
+    if loader is None:
+        return jsonify({'success': False, 'message': '未知的分頁'}), 404
 
-    cursor.close()
+    if name in ADMIN_ONLY_TABS and session.get('user', {}).get('role') != 'admin':
+        return jsonify({'success': False, 'message': '權限不足'}), 403
 
-    now = datetime.now()
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        context = loader(cursor, request.args)
+    except Exception as e:
+        print(f"Error loading dashboard tab {name}: {e}")
+        return jsonify({'success': False, 'message': '載入失敗'}), 500
+    finally:
+        cursor.close()
 
-    stats = {
-        'products': product_count,
-        'courses': course_count,
-        'orders': order_count,
-        'bookings': booking_count,
-        'customers': customer_count,
-        'posts': post_count,
-        'revenue': float(total_revenue),
-        'net_profit': net_profit
-    }
-
-    return render_template(
-        'admin_dashboard.html',
-        tab=tab,
-        stats=stats,
-        recent_orders=recent_orders,
-        recent_bookings=recent_bookings,
-        products=products,
-        courses=courses,
-        product_categories=product_categories,
-        course_categories=course_categories,
-        events=events,
-        inventory_products=inventory_products,
-        customers=customers,
-        orders=orders,
-        bookings=bookings,
-        customers_list=customers_list,
-        customer_sources=customer_sources,
-        posts=posts,
-        order_items_map=order_items_map,
-        audit_logs=audit_logs,
-        now_str=now.strftime('%Y-%m-%dT%H:%M')
-    )
+    return jsonify({
+        'success': True,
+        'tab': name,
+        'html': render_template(f'admin_tab_{name}.html', **context)
+    })
 
 
 @admin_bp.route('/product/add/modal', methods=['POST'])
@@ -391,7 +473,9 @@ def add_product_modal():
                        stock, description, image_url, 1))
 
         new_id = cursor.lastrowid
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('create', 'product', new_id, {'name': name})
@@ -457,7 +541,9 @@ def update_product_modal(product_id):
             cursor.execute(sql, (name, category_id, price, cost,
                            stock, description, is_active, product_id))
 
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('update', 'product', product_id, {'name': name})
@@ -495,7 +581,9 @@ def delete_product_modal(product_id):
             msg = f'產品「{p_name}」已永久刪除。'
             action = 'delete'
 
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
+        homepage_cache.invalidate()
         cursor.close()
         log_activity(action, 'product', product_id, {'name': p_name})
         flash(msg, 'success')
@@ -576,7 +664,9 @@ def add_course_modal():
                        service_fee, product_fee, duration, description, image_url))
 
         new_id = cursor.lastrowid
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('create', 'course', new_id, {'name': name})
@@ -652,7 +742,9 @@ def update_course_modal(course_id):
             cursor.execute(sql, (name, category_id, regular_price, experience_price,
                            service_fee, product_fee, duration, description, is_active, course_id))
 
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('update', 'course', course_id, {'name': name})
@@ -703,7 +795,9 @@ def delete_course_modal(course_id):
             msg = f'課程「{c_name}」已永久刪除。'
             action = 'delete'
 
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
+        homepage_cache.invalidate()
         cursor.close()
 
         # LOG ACTIVITY
@@ -739,6 +833,8 @@ def add_product_category():
             "INSERT INTO product_categories (name) VALUES (%s)", (name,))
         cat_id = cursor.lastrowid
         database.connection.commit()
+        category_cache.invalidate()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('create', 'category', cat_id, {
@@ -766,6 +862,8 @@ def add_course_category():
             "INSERT INTO course_categories (name) VALUES (%s)", (name,))
         cat_id = cursor.lastrowid
         database.connection.commit()
+        category_cache.invalidate()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('create', 'category', cat_id, {
@@ -787,6 +885,8 @@ def delete_product_category(category_id):
         cursor.execute(
             "DELETE FROM product_categories WHERE id = %s", (category_id,))
         database.connection.commit()
+        category_cache.invalidate()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('delete', 'category', category_id, {'type': 'product'})
@@ -807,6 +907,8 @@ def delete_course_category(category_id):
         cursor.execute(
             "DELETE FROM course_categories WHERE id = %s", (category_id,))
         database.connection.commit()
+        category_cache.invalidate()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('delete', 'category', category_id, {'type': 'course'})
@@ -998,14 +1100,15 @@ def restock_product():
             final_avg_cost = current_avg_cost
 
         # 3. 更新資料庫
-        # 更新庫存 + 更新為平均成本 + 更新最後進貨日
+        # 更新庫存 + 更新為平均成本 + 更新最後進貨日 + 庫存頁顯示的備註 (只存使用者輸入的內容)
         cursor.execute("""
             UPDATE products 
             SET stock_quantity = stock_quantity + %s, 
                 cost = %s,
-                last_purchase_date = NOW()
+                last_purchase_date = NOW(),
+                latest_note = %s
             WHERE id = %s
-        """, (quantity, final_avg_cost, product_id))
+        """, (quantity, final_avg_cost, notes, product_id))
 
         # 4. 寫入 Log
         # 記錄時備註本次進貨成本與新的平均成本
@@ -1047,12 +1150,13 @@ def adjust_inventory_modal():
 
         cursor = database.connection.cursor()
 
-        # 1. 更新產品實際庫存
+        # 1. 更新產品實際庫存 + 庫存頁顯示的備註
         cursor.execute("""
             UPDATE products 
-            SET stock_quantity = stock_quantity + %s 
+            SET stock_quantity = stock_quantity + %s,
+                latest_note = %s
             WHERE id = %s
-        """, (change_amount, product_id))
+        """, (change_amount, notes, product_id))
 
         # 2. 寫入庫存日誌
         cursor.execute("""
@@ -1132,6 +1236,7 @@ def update_order_status(order_id):
                                (item['quantity'], item['product_id']))
                 cursor.execute("INSERT INTO inventory_logs (product_id, change_amount, change_type, reference_id, notes, created_by) VALUES (%s, %s, 'return', %s, 'Order Cancelled', %s)",
                                (item['product_id'], item['quantity'], order_id, get_current_user_id()))
+            record_product_sales(cursor, items, sign=-1)
 
         elif old_status == 'cancelled' and new_status in ['pending', 'confirmed', 'completed']:
             cursor.execute(
@@ -1147,6 +1252,7 @@ def update_order_status(order_id):
                                (item['quantity'], item['product_id']))
                 cursor.execute("INSERT INTO inventory_logs (product_id, change_amount, change_type, reference_id, notes, created_by) VALUES (%s, %s, 'sale', %s, 'Order Restored', %s)",
                                (item['product_id'], -item['quantity'], order_id, get_current_user_id()))
+            record_product_sales(cursor, items)
 
         elif new_status == 'completed':
             cursor.execute(
@@ -1156,11 +1262,16 @@ def update_order_status(order_id):
                 cursor.execute(
                     "UPDATE products SET last_sale_date = NOW() WHERE id = %s", (item['product_id'],))
 
-        # 3. 更新狀態
+        # 3. 更新狀態 (進出「已取消」時同步後台總覽統計)
         cursor.execute(
             "UPDATE orders SET status = %s WHERE id = %s", (new_status, order_id))
+        kpi_sign = status_kpi_sign(old_status, new_status)
+        if kpi_sign:
+            apply_order_kpis(cursor, order_id, sign=kpi_sign)
         database.connection.commit()
         cursor.close()
+        if kpi_sign:
+            popular_cache.invalidate()
 
         # 4. ⭐ 發送通知 (現在 order_info 已經有定義了，不會報錯)
         customer_data = {
@@ -1217,9 +1328,13 @@ def update_booking_status(booking_id):
         """, (booking_id,))
         booking_info = cursor.fetchone()
 
-        # 2. 更新狀態
+        # 2. 更新狀態 (進出「已取消」時同步後台總覽統計)
         cursor.execute(
             "UPDATE bookings SET status = %s WHERE id = %s", (status, booking_id))
+        if booking_info:
+            kpi_sign = status_kpi_sign(booking_info['status'], status)
+            if kpi_sign:
+                apply_booking_kpis(cursor, booking_id, sign=kpi_sign)
         database.connection.commit()
         cursor.close()
 
@@ -1342,6 +1457,9 @@ def bulk_update_schedule():
 
         database.connection.commit()
         cursor.close()
+        invalidate_schedule_cache(
+            datetime.combine(s_date, datetime.min.time()),
+            datetime.combine(e_date, datetime.max.time()))
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': True, 'message': f'已批次更新 {updated_count} 個時段設定！'})
@@ -1373,7 +1491,7 @@ def update_single_schedule_capacity(schedule_id):
 
         # 檢查是否小於目前已預約人數 (防止超賣)
         cursor.execute(
-            "SELECT current_bookings FROM shop_schedules WHERE id = %s", (schedule_id,))
+            "SELECT current_bookings, start_time FROM shop_schedules WHERE id = %s", (schedule_id,))
         row = cursor.fetchone()
         if not row:
             return jsonify({'success': False, 'message': '時段不存在'}), 404
@@ -1387,6 +1505,7 @@ def update_single_schedule_capacity(schedule_id):
 
         database.connection.commit()
         cursor.close()
+        invalidate_schedule_cache(row['start_time'])
 
         return jsonify({'success': True})
 
@@ -1496,6 +1615,7 @@ def add_customer():
         ))
 
         new_id = cursor.lastrowid
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
         cursor.close()
 
@@ -1572,6 +1692,7 @@ def delete_customer(customer_id):
         cursor = database.connection.cursor()
         cursor.execute(
             "DELETE FROM users WHERE id = %s AND role = 'customer'", (customer_id,))
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
         cursor.close()
 
@@ -1667,7 +1788,9 @@ def add_post():
                            status, author_id, image_url))
 
             new_id = cursor.lastrowid
+            refresh_catalog_kpis(cursor)
             database.connection.commit()
+            homepage_cache.invalidate()
             cursor.close()
 
             log_activity('create', 'post', new_id, {'title': title})
@@ -1726,7 +1849,9 @@ def edit_post(post_id):
                 """
                 cursor.execute(sql, (title, content, summary, status, post_id))
 
+            refresh_catalog_kpis(cursor)
             database.connection.commit()
+            homepage_cache.invalidate()
             cursor.close()
 
             log_activity('update', 'post', post_id, {'title': title})
@@ -1747,7 +1872,9 @@ def delete_post(post_id):
         cursor = database.connection.cursor()
         # ⭐ 修正: posts -> blog_posts
         cursor.execute("DELETE FROM blog_posts WHERE id = %s", (post_id,))
+        refresh_catalog_kpis(cursor)
         database.connection.commit()
+        homepage_cache.invalidate()
         cursor.close()
 
         log_activity('delete', 'post', post_id)
@@ -1831,10 +1958,12 @@ def add_order_manual():
         # 4. 寫入訂單項目 & 扣庫存 & 寫入 Log
         for item in items_to_process:
             # 寫入項目
+            # 成本快照：有填參考成本用參考成本，否則用產品目前的成本
             cursor.execute("""
-                INSERT INTO order_items (order_id, product_id, quantity, unit_price, subtotal)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (order_id, item['product_id'], item['quantity'], item['price'], item['subtotal']))
+                INSERT INTO order_items (order_id, product_id, quantity, unit_price, unit_cost, subtotal)
+                VALUES (%s, %s, %s, %s, COALESCE(%s, (SELECT cost FROM products WHERE id = %s)), %s)
+            """, (order_id, item['product_id'], item['quantity'], item['price'],
+                  item['cost'], item['product_id'], item['subtotal']))
 
             # 扣除庫存
             cursor.execute("""
@@ -1851,6 +1980,10 @@ def add_order_manual():
                 VALUES (%s, %s, 'sale', %s, %s, %s)
             """, (item['product_id'], -item['quantity'], order_id, log_note, get_current_user_id()))
 
+        # 累加熱門產品銷量
+        record_product_sales(cursor, items_to_process)
+        apply_order_kpis(cursor, order_id)
+
         # 5. 取得客戶資料發送通知
         cursor.execute(
             "SELECT firstname, email, line_id FROM users WHERE id = %s", (customer_id,))
@@ -1858,6 +1991,7 @@ def add_order_manual():
 
         database.connection.commit()
         cursor.close()
+        popular_cache.invalidate()
 
         # 發送通知
         if send_notification and user:
@@ -1910,6 +2044,8 @@ def add_booking_manual():
         user = cursor.fetchone()
 
         success_count = 0
+        booked_times = []
+        pending_notifications = []
 
         # 2. 迴圈處理每一筆預約
         for i, course_id in enumerate(course_ids):
@@ -1931,9 +2067,13 @@ def add_booking_manual():
             # 寫入預約
             cursor.execute("""
                 INSERT INTO bookings 
-                (customer_id, course_id, schedule_id, total_amount, is_first_time, sessions_purchased, sessions_remaining, status, created_at)
-                VALUES (%s, %s, NULL, %s, %s, %s, %s, 'confirmed', %s)
-            """, (customer_id, course_id, total_amount, is_first, sessions, sessions, appt_time))
+                (customer_id, course_id, schedule_id, total_amount, total_cost, is_first_time, sessions_purchased, sessions_remaining, status, created_at)
+                VALUES (%s, %s, NULL, %s,
+                        %s * (SELECT COALESCE(service_fee, 0) + COALESCE(product_fee, 0)
+                              FROM courses WHERE id = %s),
+                        %s, %s, %s, 'confirmed', %s)
+            """, (customer_id, course_id, total_amount, sessions, course_id,
+                  is_first, sessions, sessions, appt_time))
 
             booking_id = cursor.lastrowid
 
@@ -1956,32 +2096,39 @@ def add_booking_manual():
                 cursor.execute(
                     "UPDATE bookings SET global_schedule_id = %s WHERE id = %s", (schedule_id, booking_id))
 
+            apply_booking_kpis(cursor, booking_id)
+
             # 記錄 Log
             log_activity('create', 'booking', booking_id, {
                          'type': 'manual_multi', 'time': appt_time_str})
 
             success_count += 1
+            booked_times.append(appt_time)
 
-            # 發送通知 (逐筆發送，避免漏訊)
+            # 取得課程名稱 (通知用，commit 後才排入 outbox)
             if send_notification and user:
-                try:
-                    # 取得課程名稱
-                    cursor.execute(
-                        "SELECT name FROM courses WHERE id = %s", (course_id,))
-                    c_row = cursor.fetchone()
-                    course_name = c_row['name'] if c_row else '課程'
-
-                    from project.notifications import notify_booking_confirmed
-                    customer_data = {
-                        'email': user['email'], 'firstname': user['firstname'], 'line_id': user['line_id']}
-                    time_str = appt_time.strftime('%Y-%m-%d %H:%M')
-                    notify_booking_confirmed(
-                        booking_id, customer_data, course_name, time_str)
-                except Exception as e:
-                    print(f"Notification Error: {e}")
+                cursor.execute(
+                    "SELECT name FROM courses WHERE id = %s", (course_id,))
+                c_row = cursor.fetchone()
+                course_name = c_row['name'] if c_row else '課程'
+                pending_notifications.append(
+                    (booking_id, course_name, appt_time.strftime('%Y-%m-%d %H:%M')))
 
         database.connection.commit()
         cursor.close()
+        for appt_time in booked_times:
+            invalidate_schedule_cache(appt_time)
+
+        # 發送通知 (逐筆排入 outbox，避免漏訊)
+        for booking_id, course_name, time_str in pending_notifications:
+            try:
+                from project.notifications import notify_booking_confirmed
+                customer_data = {
+                    'email': user['email'], 'firstname': user['firstname'], 'line_id': user['line_id']}
+                notify_booking_confirmed(
+                    booking_id, customer_data, course_name, time_str)
+            except Exception as e:
+                print(f"Notification Error: {e}")
 
         if send_notification:
             flash(f'成功建立 {success_count} 筆預約並發送通知', 'success')
@@ -1995,6 +2142,15 @@ def add_booking_manual():
     return redirect(url_for('admin.dashboard', tab='bookings'))
 
 
+@admin_bp.route('/api/db-pool-stats')
+@admin_required
+def db_pool_stats():
+    """MySQL 連線池統計 (本 worker)，供監控使用"""
+    stats = database.pool_stats()
+    stats['pid'] = os.getpid()
+    return jsonify(stats)
+
+
 @admin_bp.route('/fix-db-order')
 @admin_required
 def fix_db_order():
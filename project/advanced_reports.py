@@ -12,6 +12,7 @@ import MySQLdb.cursors
 from project.extensions import database
 # ⭐ 修改：改用 admin_required，並建議從 decorators 匯入以避免循環引用
 from project.decorators import admin_required
+from project.rollups import db_today, ensure_rollups, first_sales_date
 
 reports_bp = Blueprint('reports', __name__, url_prefix='/admin/reports')
 
@@ -46,6 +47,10 @@ def get_date_range(period, custom_start=None, custom_end=None):
     elif period == 'year':
         start_date = today.replace(month=1, day=1)
         end_date = today
+    elif period == 'lifetime':
+        # 累計：第一筆訂單 / 預約到今天
+        start_date = first_sales_date()
+        end_date = today
     elif period == 'custom' and custom_start and custom_end:
         start_date = datetime.strptime(custom_start, '%Y-%m-%d').date()
         end_date = datetime.strptime(custom_end, '%Y-%m-%d').date()
@@ -55,6 +60,32 @@ def get_date_range(period, custom_start=None, custom_end=None):
 
     return start_date, end_date
 
+
+def timestamp_range(start_date, end_date):
+    """
+    日期區間 -> 半開區間 [start, end + 1 天)
+    查詢寫成 created_at >= %s AND created_at < %s，不對欄位套 DATE()，才能走索引
+    """
+    range_start = datetime.combine(start_date, datetime.min.time())
+    range_end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+    return range_start, range_end
+
+
+def _course_unique_customers(cursor, course_ids, range_start, range_end):
+    """整段期間內各課程的不重複客戶數 (一次 GROUP BY 查詢)"""
+    if not course_ids:
+        return {}
+    placeholders = ', '.join(['%s'] * len(course_ids))
+    cursor.execute(f"""
+        SELECT course_id, COUNT(DISTINCT customer_id) as unique_customers
+        FROM bookings
+        WHERE course_id IN ({placeholders})
+        AND created_at >= %s AND created_at < %s
+        AND status != 'cancelled'
+        GROUP BY course_id
+    """, (*course_ids, range_start, range_end))
+    return {row['course_id']: row['unique_customers'] for row in cursor.fetchall()}
+
 # =====================================================
 # MAIN REPORTS DASHBOARD
 # =====================================================
@@ -69,88 +100,58 @@ def dashboard():
     custom_end = request.args.get('end_date')
 
     start_date, end_date = get_date_range(period, custom_start, custom_end)
+    range_start, range_end = timestamp_range(start_date, end_date)
+
+    # ⭐ 改讀每日彙總 (daily_sales_summary)，只有未封存的日期會重新加總
+    ensure_rollups(start_date, end_date)
 
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
-    # Revenue Summary
     cursor.execute("""
-        SELECT 
-            COALESCE(SUM(total_amount), 0) as total_revenue,
-            COUNT(*) as order_count,
-            AVG(total_amount) as avg_order_value
-        FROM orders
-        WHERE DATE(created_at) BETWEEN %s AND %s
-        AND status != 'cancelled'
+        SELECT sales_date as date, order_count, order_revenue, order_cost,
+               booking_count, booking_revenue, course_cost
+        FROM daily_sales_summary
+        WHERE sales_date BETWEEN %s AND %s
+        ORDER BY sales_date
     """, (start_date, end_date))
-    revenue_summary = cursor.fetchone()
+    daily_rows = cursor.fetchall()
 
-    # Booking Revenue
-    cursor.execute("""
-        SELECT 
-            COALESCE(SUM(total_amount), 0) as total_revenue,
-            COUNT(*) as booking_count,
-            AVG(total_amount) as avg_booking_value
-        FROM bookings
-        WHERE DATE(created_at) BETWEEN %s AND %s
-        AND status != 'cancelled'
-    """, (start_date, end_date))
-    booking_summary = cursor.fetchone()
+    order_count = sum(row['order_count'] for row in daily_rows)
+    order_revenue = sum(float(row['order_revenue']) for row in daily_rows)
+    booking_count = sum(row['booking_count'] for row in daily_rows)
+    booking_revenue = sum(float(row['booking_revenue']) for row in daily_rows)
 
-    # Calculate Cost and Profit
-    cursor.execute("""
-        SELECT COALESCE(SUM(oi.quantity * p.cost), 0) as total_cost
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
-        JOIN orders o ON oi.order_id = o.id
-        WHERE DATE(o.created_at) BETWEEN %s AND %s
-        AND o.status != 'cancelled'
-    """, (start_date, end_date))
-    cost_data = cursor.fetchone()
-
-    # Course costs (assuming service_fee + product_fee as cost)
-    cursor.execute("""
-        SELECT COALESCE(SUM(b.sessions_purchased * (c.service_fee + c.product_fee)), 0) as course_cost
-        FROM bookings b
-        JOIN courses c ON b.course_id = c.id
-        WHERE DATE(b.created_at) BETWEEN %s AND %s
-        AND b.status != 'cancelled'
-    """, (start_date, end_date))
-    course_cost_data = cursor.fetchone()
+    # Revenue Summary
+    revenue_summary = {
+        'total_revenue': order_revenue,
+        'order_count': order_count,
+        'avg_order_value': order_revenue / order_count if order_count else None,
+    }
 
-    total_revenue = float(
-        revenue_summary['total_revenue']) + float(booking_summary['total_revenue'])
-    total_cost = float(cost_data['total_cost']) + \
-        float(course_cost_data['course_cost'])
+    # Booking Revenue
+    booking_summary = {
+        'total_revenue': booking_revenue,
+        'booking_count': booking_count,
+        'avg_booking_value': booking_revenue / booking_count if booking_count else None,
+    }
+
+    # Calculate Cost and Profit (course cost = service_fee + product_fee)
+    total_revenue = order_revenue + booking_revenue
+    total_cost = sum(float(row['order_cost']) + float(row['course_cost'])
+                     for row in daily_rows)
     net_profit = total_revenue - total_cost
     profit_margin = (net_profit / total_revenue *
                      100) if total_revenue > 0 else 0
 
     # Daily breakdown
-    cursor.execute("""
-        SELECT 
-            DATE(created_at) as date,
-            COALESCE(SUM(total_amount), 0) as revenue,
-            COUNT(*) as count
-        FROM orders
-        WHERE DATE(created_at) BETWEEN %s AND %s
-        AND status != 'cancelled'
-        GROUP BY DATE(created_at)
-        ORDER BY date
-    """, (start_date, end_date))
-    daily_orders = cursor.fetchall()
-
-    cursor.execute("""
-        SELECT 
-            DATE(created_at) as date,
-            COALESCE(SUM(total_amount), 0) as revenue,
-            COUNT(*) as count
-        FROM bookings
-        WHERE DATE(created_at) BETWEEN %s AND %s
-        AND status != 'cancelled'
-        GROUP BY DATE(created_at)
-        ORDER BY date
-    """, (start_date, end_date))
-    daily_bookings = cursor.fetchall()
+    daily_orders = [
+        {'date': row['date'], 'revenue': row['order_revenue'], 'count': row['order_count']}
+        for row in daily_rows if row['order_count']
+    ]
+    daily_bookings = [
+        {'date': row['date'], 'revenue': row['booking_revenue'], 'count': row['booking_count']}
+        for row in daily_rows if row['booking_count']
+    ]
 
     cursor.close()
 
@@ -182,10 +183,11 @@ def product_rankings():
     custom_end = request.args.get('end_date')
 
     start_date, end_date = get_date_range(period, custom_start, custom_end)
+    ensure_rollups(start_date, end_date)
 
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
-    # Product rankings
+    # Product rankings (⭐ 改讀 daily_product_sales，成本 / 利潤一起算，不再逐筆查詢)
     order_column = 'total_quantity' if sort_by == 'quantity' else 'total_revenue'
 
     cursor.execute(f"""
@@ -194,16 +196,19 @@ def product_rankings():
             p.name,
             p.image,
             pc.name as category_name,
-            SUM(oi.quantity) as total_quantity,
-            SUM(oi.subtotal) as total_revenue,
-            AVG(oi.unit_price) as avg_price,
-            COUNT(DISTINCT o.id) as order_count
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
+            SUM(d.quantity) as total_quantity,
+            SUM(d.revenue) as total_revenue,
+            SUM(d.unit_price_sum) / SUM(d.line_count) as avg_price,
+            SUM(d.order_count) as order_count,
+            SUM(d.cost) as total_cost,
+            SUM(d.revenue) - SUM(d.cost) as total_profit,
+            CASE WHEN SUM(d.revenue) > 0
+                 THEN (SUM(d.revenue) - SUM(d.cost)) / SUM(d.revenue) * 100
+                 ELSE 0 END as profit_margin
+        FROM daily_product_sales d
+        JOIN products p ON d.product_id = p.id
         LEFT JOIN product_categories pc ON p.category_id = pc.id
-        JOIN orders o ON oi.order_id = o.id
-        WHERE DATE(o.created_at) BETWEEN %s AND %s
-        AND o.status != 'cancelled'
+        WHERE d.sales_date BETWEEN %s AND %s
         GROUP BY p.id, p.name, p.image, pc.name
         ORDER BY {order_column} DESC
         LIMIT 50
@@ -211,20 +216,6 @@ def product_rankings():
 
     products = cursor.fetchall()
 
-    # Calculate profit per product
-    for product in products:
-        cursor.execute("""
-            SELECT cost FROM products WHERE id = %s
-        """, (product['id'],))
-        cost_data = cursor.fetchone()
-        cost = float(cost_data['cost']) if cost_data else 0
-
-        product['total_cost'] = cost * int(product['total_quantity'])
-        product['total_profit'] = float(
-            product['total_revenue']) - product['total_cost']
-        product['profit_margin'] = (product['total_profit'] / float(
-            product['total_revenue']) * 100) if product['total_revenue'] > 0 else 0
-
     cursor.close()
 
     return render_template('reports_products.html',
@@ -249,11 +240,15 @@ def course_rankings():
     custom_end = request.args.get('end_date')
 
     start_date, end_date = get_date_range(period, custom_start, custom_end)
+    range_start, range_end = timestamp_range(start_date, end_date)
+
+    ensure_rollups(start_date, end_date)
 
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
     order_column = 'total_sessions' if sort_by == 'quantity' else 'total_revenue'
 
+    # ⭐ 改讀 daily_course_sales，成本 / 利潤一起算，不再逐筆查詢
     cursor.execute(f"""
         SELECT 
             c.id,
@@ -261,16 +256,19 @@ def course_rankings():
             c.image,
             cc.name as category_name,
             c.duration,
-            SUM(b.sessions_purchased) as total_sessions,
-            SUM(b.total_amount) as total_revenue,
-            AVG(b.total_amount / b.sessions_purchased) as avg_price_per_session,
-            COUNT(DISTINCT b.id) as booking_count,
-            COUNT(DISTINCT b.customer_id) as unique_customers
-        FROM bookings b
-        JOIN courses c ON b.course_id = c.id
+            SUM(d.sessions) as total_sessions,
+            SUM(d.revenue) as total_revenue,
+            SUM(d.price_per_session_sum) / SUM(d.booking_count) as avg_price_per_session,
+            SUM(d.booking_count) as booking_count,
+            SUM(d.cost) as total_cost,
+            SUM(d.revenue) - SUM(d.cost) as total_profit,
+            CASE WHEN SUM(d.revenue) > 0
+                 THEN (SUM(d.revenue) - SUM(d.cost)) / SUM(d.revenue) * 100
+                 ELSE 0 END as profit_margin
+        FROM daily_course_sales d
+        JOIN courses c ON d.course_id = c.id
         LEFT JOIN course_categories cc ON c.category_id = cc.id
-        WHERE DATE(b.created_at) BETWEEN %s AND %s
-        AND b.status != 'cancelled'
+        WHERE d.sales_date BETWEEN %s AND %s
         GROUP BY c.id, c.name, c.image, cc.name, c.duration
         ORDER BY {order_column} DESC
         LIMIT 50
@@ -278,28 +276,11 @@ def course_rankings():
 
     courses = cursor.fetchall()
 
-    # Calculate profit per course
+    # 每日的不重複客戶數不能相加 (同一客戶跨日會重複計算)，整段期間另外算一次
+    unique_customers = _course_unique_customers(
+        cursor, [course['id'] for course in courses], range_start, range_end)
     for course in courses:
-        cursor.execute("""
-            SELECT service_fee, product_fee 
-            FROM courses 
-            WHERE id = %s
-        """, (course['id'],))
-        cost_data = cursor.fetchone()
-
-        if cost_data:
-            cost_per_session = float(
-                cost_data['service_fee'] or 0) + float(cost_data['product_fee'] or 0)
-            course['total_cost'] = cost_per_session * \
-                int(course['total_sessions'])
-            course['total_profit'] = float(
-                course['total_revenue']) - course['total_cost']
-            course['profit_margin'] = (course['total_profit'] / float(
-                course['total_revenue']) * 100) if course['total_revenue'] > 0 else 0
-        else:
-            course['total_cost'] = 0
-            course['total_profit'] = float(course['total_revenue'])
-            course['profit_margin'] = 100
+        course['unique_customers'] = unique_customers.get(course['id'], 0)
 
     cursor.close()
 
@@ -324,6 +305,7 @@ def event_analytics():
     custom_end = request.args.get('end_date')
 
     start_date, end_date = get_date_range(period, custom_start, custom_end)
+    range_start, range_end = timestamp_range(start_date, end_date)
 
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
@@ -344,14 +326,16 @@ def event_analytics():
             COUNT(DISTINCT COALESCE(o.customer_id, b.customer_id)) as unique_customers
         FROM events e
         LEFT JOIN users u ON e.customer_id = u.id
-        LEFT JOIN orders o ON DATE(o.created_at) BETWEEN DATE(e.start_date) AND DATE(e.end_date)
+        LEFT JOIN orders o ON o.created_at >= DATE(e.start_date)
+            AND o.created_at < DATE(e.end_date) + INTERVAL 1 DAY
             AND o.status != 'cancelled'
-        LEFT JOIN bookings b ON DATE(b.created_at) BETWEEN DATE(e.start_date) AND DATE(e.end_date)
+        LEFT JOIN bookings b ON b.created_at >= DATE(e.start_date)
+            AND b.created_at < DATE(e.end_date) + INTERVAL 1 DAY
             AND b.status != 'cancelled'
-        WHERE DATE(e.start_date) BETWEEN %s AND %s
+        WHERE e.start_date >= %s AND e.start_date < %s
         GROUP BY e.id, e.title, e.start_date, e.end_date, e.duration, e.customer_id, u.firstname, u.surname
         ORDER BY e.start_date DESC
-    """, (start_date, end_date))
+    """, (range_start, range_end))
 
     events = cursor.fetchall()
 
@@ -392,34 +376,63 @@ def customer_analytics():
     custom_end = request.args.get('end_date')
 
     start_date, end_date = get_date_range(period, custom_start, custom_end)
+    range_start, range_end = timestamp_range(start_date, end_date)
 
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
     # Top customers
-    cursor.execute("""
-        SELECT 
-            u.id,
-            CONCAT(u.firstname, ' ', u.surname) as name,
-            u.email,
-            u.phone,
-            COUNT(DISTINCT o.id) as order_count,
-            COUNT(DISTINCT b.id) as booking_count,
-            COALESCE(SUM(o.total_amount), 0) as order_total,
-            COALESCE(SUM(b.total_amount), 0) as booking_total,
-            (COALESCE(SUM(o.total_amount), 0) + COALESCE(SUM(b.total_amount), 0)) as total_spent
-        FROM users u
-        LEFT JOIN orders o ON u.id = o.customer_id 
-            AND DATE(o.created_at) BETWEEN %s AND %s
-            AND o.status != 'cancelled'
-        LEFT JOIN bookings b ON u.id = b.customer_id 
-            AND DATE(b.created_at) BETWEEN %s AND %s
-            AND b.status != 'cancelled'
-        WHERE u.role = 'customer'
-        GROUP BY u.id, u.firstname, u.surname, u.email, u.phone
-        HAVING total_spent > 0
-        ORDER BY total_spent DESC
-        LIMIT 50
-    """, (start_date, end_date, start_date, end_date))
+    if period == 'lifetime':
+        # 累計排行直接讀 customer_stats (由訂單 / 預約異動同步維護)
+        cursor.execute("""
+            SELECT 
+                u.id,
+                CONCAT(u.firstname, ' ', u.surname) as name,
+                u.email,
+                u.phone,
+                st.order_count,
+                st.booking_count,
+                st.order_spent as order_total,
+                st.booking_spent as booking_total,
+                (st.order_spent + st.booking_spent) as total_spent
+            FROM customer_stats st
+            JOIN users u ON st.customer_id = u.id
+            WHERE (st.order_spent + st.booking_spent) > 0
+            ORDER BY total_spent DESC
+            LIMIT 50
+        """)
+    else:
+        # 期間排行：訂單與預約先各自依客戶彙總再合併，避免 orders × bookings 的列數膨脹
+        cursor.execute("""
+            SELECT 
+                u.id,
+                CONCAT(u.firstname, ' ', u.surname) as name,
+                u.email,
+                u.phone,
+                COALESCE(o.order_count, 0) as order_count,
+                COALESCE(b.booking_count, 0) as booking_count,
+                COALESCE(o.order_total, 0) as order_total,
+                COALESCE(b.booking_total, 0) as booking_total,
+                (COALESCE(o.order_total, 0) + COALESCE(b.booking_total, 0)) as total_spent
+            FROM users u
+            LEFT JOIN (
+                SELECT customer_id, COUNT(*) as order_count, SUM(total_amount) as order_total
+                FROM orders
+                WHERE created_at >= %s AND created_at < %s
+                AND status != 'cancelled'
+                GROUP BY customer_id
+            ) o ON u.id = o.customer_id
+            LEFT JOIN (
+                SELECT customer_id, COUNT(*) as booking_count, SUM(total_amount) as booking_total
+                FROM bookings
+                WHERE created_at >= %s AND created_at < %s
+                AND status != 'cancelled'
+                GROUP BY customer_id
+            ) b ON u.id = b.customer_id
+            WHERE u.role = 'customer'
+            HAVING total_spent > 0
+            ORDER BY total_spent DESC
+            LIMIT 50
+        """, (range_start, range_end, range_start, range_end))
 
     top_customers = cursor.fetchall()
 
@@ -430,10 +443,10 @@ def customer_analytics():
             COUNT(*) as new_customers
         FROM users
         WHERE role = 'customer'
-        AND DATE(created_at) BETWEEN %s AND %s
+        AND created_at >= %s AND created_at < %s
         GROUP BY DATE(created_at)
         ORDER BY date
-    """, (start_date, end_date))
+    """, (range_start, range_end))
 
     acquisition_data = cursor.fetchall()
 
@@ -450,120 +463,49 @@ def customer_analytics():
 # EXPORT REPORTS (CSV/Excel)
 # =====================================================
 
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
 
 @reports_bp.route('/export/<report_type>')
 @admin_required  # ⭐ 修改：僅限 Admin
 def export_report(report_type):
-    """Export reports to CSV"""
-    import csv
-    from io import StringIO
-    from flask import Response
+    """Export reports to CSV / XLSX (⭐ 串流輸出，period=all 匯出全部歷史資料)"""
+    from flask import Response, abort, stream_with_context
+    from project.report_exports import EXPORT_REPORTS, generate_csv, generate_xlsx
+
+    report = EXPORT_REPORTS.get(report_type)
+    export_format = request.args.get('format', 'csv')
+    if report is None or export_format not in EXPORT_FORMATS:
+        abort(404)
 
     period = request.args.get('period', 'month')
     custom_start = request.args.get('start_date')
     custom_end = request.args.get('end_date')
 
-    start_date, end_date = get_date_range(period, custom_start, custom_end)
-
-    output = StringIO()
+    if period == 'all':
+        start_date = end_date = None
+    else:
+        start_date, end_date = get_date_range(period, custom_start, custom_end)
 
-    if report_type == 'products':
-        writer = csv.writer(output)
-        writer.writerow(['產品名稱', '分類', '銷售數量', '銷售金額',
-                        '平均單價', '訂單數', '成本', '利潤', '利潤率%'])
+    if report['rollups']:
+        # 彙總類報表需要明確的日期範圍，全部歷史 = 第一筆訂單 / 預約到今天
+        if start_date is None:
+            start_date, end_date = first_sales_date(), db_today()
+        ensure_rollups(start_date, end_date)
 
-        cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute("""
-            SELECT 
-                p.name,
-                pc.name as category_name,
-                SUM(oi.quantity) as quantity,
-                SUM(oi.subtotal) as revenue,
-                AVG(oi.unit_price) as avg_price,
-                COUNT(DISTINCT o.id) as orders,
-                p.cost
-            FROM order_items oi
-            JOIN products p ON oi.product_id = p.id
-            LEFT JOIN product_categories pc ON p.category_id = pc.id
-            JOIN orders o ON oi.order_id = o.id
-            WHERE DATE(o.created_at) BETWEEN %s AND %s
-            AND o.status != 'cancelled'
-            GROUP BY p.id, p.name, pc.name, p.cost
-            ORDER BY SUM(oi.subtotal) DESC
-        """, (start_date, end_date))
-
-        for row in cursor.fetchall():
-            cost = float(row['cost']) * int(row['quantity'])
-            revenue = float(row['revenue'])
-            profit = revenue - cost
-            margin = (profit / revenue * 100) if revenue > 0 else 0
-
-            writer.writerow([
-                row['name'],
-                row['category_name'] or '',
-                row['quantity'],
-                f"{revenue:.2f}",
-                f"{row['avg_price']:.2f}",
-                row['orders'],
-                f"{cost:.2f}",
-                f"{profit:.2f}",
-                f"{margin:.2f}"
-            ])
-
-        cursor.close()
-
-    elif report_type == 'courses':
-        writer = csv.writer(output)
-        writer.writerow(['課程名稱', '分類', '預約堂數', '銷售金額',
-                        '預約數', '客戶數', '成本', '利潤', '利潤率%'])
-
-        cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute("""
-            SELECT 
-                c.name,
-                cc.name as category_name,
-                SUM(b.sessions_purchased) as sessions,
-                SUM(b.total_amount) as revenue,
-                COUNT(DISTINCT b.id) as bookings,
-                COUNT(DISTINCT b.customer_id) as customers,
-                c.service_fee,
-                c.product_fee
-            FROM bookings b
-            JOIN courses c ON b.course_id = c.id
-            LEFT JOIN course_categories cc ON c.category_id = cc.id
-            WHERE DATE(b.created_at) BETWEEN %s AND %s
-            AND b.status != 'cancelled'
-            GROUP BY c.id, c.name, cc.name, c.service_fee, c.product_fee
-            ORDER BY SUM(b.total_amount) DESC
-        """, (start_date, end_date))
-
-        for row in cursor.fetchall():
-            cost_per = float(row['service_fee'] or 0) + \
-                float(row['product_fee'] or 0)
-            cost = cost_per * int(row['sessions'])
-            revenue = float(row['revenue'])
-            profit = revenue - cost
-            margin = (profit / revenue * 100) if revenue > 0 else 0
-
-            writer.writerow([
-                row['name'],
-                row['category_name'] or '',
-                row['sessions'],
-                f"{revenue:.2f}",
-                row['bookings'],
-                row['customers'],
-                f"{cost:.2f}",
-                f"{profit:.2f}",
-                f"{margin:.2f}"
-            ])
-
-        cursor.close()
-
-    output.seek(0)
-    filename = f"{report_type}_report_{start_date}_to_{end_date}.csv"
+    if start_date is None:
+        filename = f"{report_type}_report_all.{export_format}"
+    else:
+        filename = f"{report_type}_report_{start_date}_to_{end_date}.{export_format}"
 
+    generate = generate_xlsx if export_format == 'xlsx' else generate_csv
+    # stream_with_context：產生器執行期間保留 request context (連線在送完後才歸還)
     return Response(
-        output.getvalue(),
-        mimetype='text/csv',
+        stream_with_context(generate(report_type, start_date, end_date)),
+        mimetype=EXPORT_FORMATS[export_format],
         headers={'Content-Disposition': f'attachment; filename={filename}'}
     )
+
@@ -7,7 +7,8 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
 from urllib.parse import quote
 import secrets
-import requests
+from project.http_clients import http_clients
+from project.services import adjust_kpis
 import re
 import MySQLdb.cursors
 import traceback
@@ -148,6 +149,8 @@ def register():
             # 6.phone(空值), 7.line_id, 8.role
             cursor.execute(sql, (username, email, hashed_password,
                                  firstname, surname, '', line_id, role))
+            if role == 'customer':
+                adjust_kpis(cursor, customers=1)
 
             database.connection.commit()
 
@@ -317,7 +320,8 @@ def line_callback():
     }
 
     try:
-        r = requests.post(token_url, headers=headers, data=payload)
+        r = http_clients['line_login'].post(
+            token_url, headers=headers, data=payload)
         token_data = r.json()
 
         if 'error' in token_data:
@@ -333,8 +337,12 @@ def line_callback():
     # 3. 取得使用者個資 (Profile)
     profile_url = "https://api.line.me/v2/profile"
     headers = {'Authorization': f'Bearer {access_token}'}
-    r_profile = requests.get(profile_url, headers=headers)
-    profile_data = r_profile.json()
+    try:
+        r_profile = http_clients['line_login'].get(profile_url, headers=headers)
+        profile_data = r_profile.json()
+    except Exception as e:
+        flash(f"連線錯誤: {str(e)}", 'error')
+        return redirect(url_for('main.home'))
 
     line_user_id = profile_data.get('userId')
     display_name = profile_data.get('displayName')
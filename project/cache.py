@@ -0,0 +1,99 @@
+"""
+Process-local Cache Helpers
+程序內快取 (每個 gunicorn worker 各自一份，不跨程序共享)
+
+寫入端 (後台) 只能清掉「自己這個 worker」的快取，
+其他 worker 依靠 TTL 自然過期，所以 TTL 就是最長的資料延遲時間。
+"""
+
+import threading
+import time
+
+
+class TTLCache:
+    """
+    簡單的 TTL + 版本號快取
+
+    - 每筆資料記錄載入時的版本號 (version)
+    - invalidate() 會把版本號 +1，舊版本的資料一律視為失效
+    - 若載入期間剛好被 invalidate，載入結果不會寫回快取，避免把舊資料存進去
+    """
+
+    def __init__(self, name, ttl=300):
+        self.name = name
+        self.ttl = ttl
+        self.version = 0
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+
+            value, version, expires_at = entry
+            if version != self.version or expires_at <= time.monotonic():
+                self._data.pop(key, None)
+                return default
+            return value
+
+    def set(self, key, value, ttl=None, version=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if version is not None and version != self.version:
+                # 載入期間已被清除，丟棄這份可能過期的結果
+                return
+            self._data[key] = (value, self.version, time.monotonic() + ttl)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """命中就回傳快取；否則呼叫 loader() 載入並寫回"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+
+        version = self.version
+        value = loader()
+        self.set(key, value, ttl=ttl, version=version)
+        return value
+
+    def invalidate(self, key=None):
+        """清除單一 key；不給 key 則整個快取失效 (版本號 +1)"""
+        with self._lock:
+            if key is None:
+                self.version += 1
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        """只清除 predicate(key) 為 True 的項目，其餘快取保留"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+
+# =====================================================
+# 共用快取實例
+# =====================================================
+
+# 導覽列分類 (product_categories / course_categories)
+category_cache = TTLCache('categories', ttl=600)
+
+# 首頁精選區塊 (最新產品 / 課程 / 文章)
+homepage_cache = TTLCache('homepage', ttl=300)
+
+# 熱門產品 (文章側欄等)；銷量異動時清除
+popular_cache = TTLCache('popular', ttl=60)
+
+# 前台預約行事曆 (key = (起, 迄) 時間範圍)
+# 其他 worker 只能靠 TTL 過期，所以 TTL 設短；真正的名額檢查在 book_course
+schedule_cache = TTLCache('schedule', ttl=30)
+
+
+def invalidate_schedule_cache(start, end=None):
+    """清除涵蓋 [start, end] 時段的行事曆快取 (end 省略則只看單一時間點)"""
+    end = start if end is None else end
+    schedule_cache.invalidate_if(
+        lambda key: key[0] <= end and start <= key[1])
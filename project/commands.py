@@ -0,0 +1,290 @@
+"""
+Maintenance CLI Commands
+使用方式：flask --app project <command>
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+
+
+def register_commands(app):
+
+    @app.cli.command('rebuild-sales-stats')
+    def rebuild_sales_stats():
+        """從 order_items 全量重算 product_sales_stats"""
+        from project.services import rebuild_product_sales_stats
+
+        count = rebuild_product_sales_stats()
+        click.echo(f'✅ product_sales_stats 已重建 ({count} 個產品)')
+
+    @app.cli.command('rebuild-customer-stats')
+    def rebuild_customer_stats_command():
+        """從 orders / bookings 全量重算 customer_stats"""
+        from project.services import rebuild_customer_stats
+
+        count = rebuild_customer_stats()
+        click.echo(f'✅ customer_stats 已重建 ({count} 位客戶)')
+
+    @app.cli.command('reconcile-kpi')
+    def reconcile_kpi():
+        """從原始資料全量重算 kpi_summary，列出與目前值不同的欄位"""
+        from project.services import rebuild_kpi_summary
+
+        _, diffs = rebuild_kpi_summary()
+        if not diffs:
+            click.echo('✅ kpi_summary 與原始資料一致')
+            return
+
+        for column, (old, new) in diffs.items():
+            click.echo(f'  {column}: {old} -> {new}')
+        click.echo(f'✅ kpi_summary 已校正 ({len(diffs)} 個欄位)')
+
+    @app.cli.command('refresh-rollups')
+    @click.option('--days', type=int, default=None,
+                  help='從今天往回處理的天數 (預設：第一筆訂單 / 預約至今)')
+    @click.option('--force', is_flag=True, help='連已封存的日期也重新彙總')
+    def refresh_rollups_command(days, force):
+        """回填 / 校正進階報表的每日彙總 (daily_sales_summary 等)，部署後執行一次"""
+        from project.rollups import db_today, first_sales_date, refresh_rollups
+
+        end_date = db_today()
+        if days:
+            start_date = end_date - timedelta(days=days - 1)
+        else:
+            start_date = first_sales_date()
+        count = refresh_rollups(start_date, end_date, force=force)
+        click.echo(f'✅ 每日彙總已更新 ({start_date} ~ {end_date}，重算 {count} 天)')
+
+    @app.cli.command('outbox-worker')
+    @click.option('--once', is_flag=True, help='只處理目前到期的通知後結束')
+    def outbox_worker_command(once):
+        """獨立程序消化 notification_outbox (搭配 OUTBOX_INPROCESS_WORKER=0)"""
+        from project.outbox import outbox_worker
+
+        if not once:
+            click.echo('📮 Outbox worker started')
+            outbox_worker.run_forever()
+            return
+
+        total = 0
+        while True:
+            handled = outbox_worker.process_batch()
+            total += handled
+            if handled < current_app.config['OUTBOX_BATCH_SIZE']:
+                break
+        purged = outbox_worker.purge_expired()
+        click.echo(f'✅ 已處理 {total} 筆通知，清除 {purged} 筆過期紀錄')
+
+    @app.cli.command('explain-reports')
+    @click.option('--period', default='year', show_default=True,
+                  help='報表的時間範圍 (同報表頁的 period 參數)')
+    @click.option('--tables', default='orders,bookings,users', show_default=True,
+                  help='這些資料表不可出現全表掃描 (EXPLAIN type = ALL)')
+    def explain_reports(period, tables):
+        """
+        執行進階報表的每一頁，逐條 EXPLAIN 實際送出的 SELECT，
+        指定資料表出現全表掃描時列出並以 exit code 1 結束 (可放進部署前檢查)
+        資料量很小時 MySQL 可能仍選擇全表掃描，請對接近正式環境的資料執行
+        """
+        watched = {t.strip() for t in tables.split(',') if t.strip()}
+        failures = 0
+        for endpoint, view_args in REPORT_ENDPOINTS:
+            statements = _capture_report_queries(endpoint, view_args, period)
+            plans = _explain_statements(statements)
+            for sql, rows in plans:
+                scans = [r for r in rows if r['table'] in watched and r['type'] == 'ALL']
+                failures += len(scans)
+                for r in scans:
+                    click.echo(f"❌ {endpoint}: {r['table']} 全表掃描 (rows={r['rows']})\n   {sql}")
+            click.echo(f'  {endpoint} {view_args or ""}: {len(plans)} 條 SELECT 已檢查')
+
+        if failures:
+            raise SystemExit(1)
+        click.echo('✅ 報表查詢皆使用索引')
+
+    @app.cli.command('bench-booking')
+    @click.option('--mode', type=click.Choice(['atomic', 'locking', 'both']), default='both',
+                  help='atomic = 條件式 UPDATE；locking = 舊版 SELECT ... FOR UPDATE')
+    @click.option('--workers', default=8, show_default=True, help='同時搶位的執行緒數')
+    @click.option('--attempts', default=50, show_default=True, help='每個執行緒嘗試次數')
+    @click.option('--capacity', default=200, show_default=True, help='測試時段的名額')
+    def bench_booking(mode, workers, attempts, capacity):
+        """
+        單一熱門時段的搶位壓測
+        建立一個遠期的暫時時段，多執行緒同時佔位，結束後刪除 (不寫入 bookings)
+        """
+        pool_size = current_app.config['MYSQL_POOL_MAX_SIZE']
+        if workers > pool_size:
+            click.echo(f'⚠️ workers ({workers}) 大於連線池上限 ({pool_size})，多出的執行緒會等待連線')
+
+        modes = ['atomic', 'locking'] if mode == 'both' else [mode]
+        for m in modes:
+            result = _run_booking_bench(
+                current_app._get_current_object(), m, workers, attempts, capacity)
+            click.echo(
+                f"[{m:>7}] {result['ok']} 成功 / {result['full']} 額滿 / "
+                f"{result['errors']} 錯誤, {result['elapsed']:.2f}s, "
+                f"{result['ok'] / result['elapsed']:.1f} bookings/s, "
+                f"最終人數 {result['final']} / {capacity}"
+                + ('  ❌ 超賣' if result['final'] > capacity else ''))
+
+
+# =====================================================
+# REPORT QUERY PLANS
+# =====================================================
+
+REPORT_ENDPOINTS = [
+    ('reports.dashboard', {}),
+    ('reports.product_rankings', {}),
+    ('reports.course_rankings', {}),
+    ('reports.customer_analytics', {}),
+    ('reports.export_report', {'report_type': 'products'}),
+    ('reports.export_report', {'report_type': 'courses'}),
+    ('reports.export_report', {'report_type': 'orders'}),
+    ('reports.export_report', {'report_type': 'bookings'}),
+    ('reports.export_report', {'report_type': 'customers'}),
+]
+
+
+def _capture_report_queries(endpoint, view_args, period):
+    """以 admin 身分在測試 request 中執行報表，回傳送出的 [(sql, args), ...]"""
+    from flask import g, session
+    from project.instrumentation import QueryStats
+
+    app = current_app._get_current_object()
+    instrumentation = app.config['SQL_INSTRUMENTATION']
+    app.config['SQL_INSTRUMENTATION'] = True
+    try:
+        # 新的 app context：連線在這裡才取得，才會包上這次的 QueryStats
+        with app.app_context(), app.test_request_context(query_string={'period': period}):
+            session['logged_in'] = True
+            session['user'] = {'id': 0, 'role': 'admin'}
+            g._sql_stats = QueryStats(keep_slowest=0, capture=True)
+            rv = app.view_functions[endpoint](**view_args)
+            # 串流匯出：讀完內容查詢才會真正執行
+            if getattr(rv, 'is_streamed', False):
+                for _ in rv.response:
+                    pass
+            return list(g._sql_stats.captured)
+    finally:
+        app.config['SQL_INSTRUMENTATION'] = instrumentation
+
+
+def _explain_statements(statements):
+    """對每條 SELECT 執行 EXPLAIN，回傳 [(精簡後的 sql, EXPLAIN rows), ...]"""
+    import MySQLdb.cursors
+    from project.extensions import database
+    from project.instrumentation import _shorten
+
+    plans = []
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        for sql, args in statements:
+            if isinstance(sql, bytes):
+                sql = sql.decode('utf-8')
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            cursor.execute('EXPLAIN ' + sql, args)
+            plans.append((_shorten(sql, 120), cursor.fetchall()))
+    finally:
+        cursor.close()
+    return plans
+
+
+# =====================================================
+# BOOKING BENCHMARK
+# =====================================================
+
+def _booking_attempt_atomic(cursor, schedule_id):
+    from project.services import SlotUnavailable, reserve_slot
+
+    try:
+        reserve_slot(cursor, schedule_id)
+        return True
+    except SlotUnavailable:
+        return False
+
+
+def _booking_attempt_locking(cursor, schedule_id):
+    # 對照組：改版前 book_course 的流程 (鎖定 -> 檢查 -> 額外查詢 -> 加一)
+    cursor.execute(
+        "SELECT * FROM shop_schedules WHERE id = %s AND is_active = TRUE FOR UPDATE",
+        (schedule_id,))
+    schedule = cursor.fetchone()
+    if not schedule or schedule['current_bookings'] >= schedule['max_capacity']:
+        return False
+
+    cursor.execute("SELECT COUNT(*) AS count FROM bookings WHERE customer_id = %s", (0,))
+    cursor.fetchone()
+    cursor.execute(
+        "UPDATE shop_schedules SET current_bookings = current_bookings + 1 WHERE id = %s",
+        (schedule_id,))
+    return True
+
+
+def _run_booking_bench(app, mode, workers, attempts, capacity):
+    import MySQLdb.cursors
+    from project.extensions import database
+    from project.services import run_with_lock_retry
+
+    attempt = _booking_attempt_atomic if mode == 'atomic' else _booking_attempt_locking
+
+    # 1. 建立暫時時段 (遠期日期，前台行事曆不會顯示)
+    slot_start = datetime(2099, 12, 31, 8, 0) + timedelta(
+        seconds=int(time.time()) % 36000)
+    with app.app_context():
+        cursor = database.connection.cursor()
+        cursor.execute("""
+            INSERT INTO shop_schedules (start_time, end_time, max_capacity, current_bookings, is_active)
+            VALUES (%s, %s, %s, 0, 1)
+        """, (slot_start, slot_start + timedelta(hours=1), capacity))
+        schedule_id = cursor.lastrowid
+        database.connection.commit()
+        cursor.close()
+
+    counts = {'ok': 0, 'full': 0, 'errors': 0}
+    counts_lock = threading.Lock()
+    start_gate = threading.Barrier(workers)
+
+    def worker():
+        with app.app_context():
+            cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+            start_gate.wait()
+            for _ in range(attempts):
+                def work():
+                    ok = attempt(cursor, schedule_id)
+                    database.connection.commit()
+                    return ok
+                try:
+                    key = 'ok' if run_with_lock_retry(work) else 'full'
+                except Exception as e:
+                    database.connection.rollback()
+                    print(f"❌ bench error: {e}")
+                    key = 'errors'
+                with counts_lock:
+                    counts[key] += 1
+            cursor.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    # 2. 驗證結果並刪除暫時時段
+    with app.app_context():
+        cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute(
+            "SELECT current_bookings FROM shop_schedules WHERE id = %s", (schedule_id,))
+        final = cursor.fetchone()['current_bookings']
+        cursor.execute("DELETE FROM shop_schedules WHERE id = %s", (schedule_id,))
+        database.connection.commit()
+        cursor.close()
+
+    return dict(counts, elapsed=elapsed, final=final)
@@ -0,0 +1,99 @@
+"""
+Buffered View Counters
+文章瀏覽數先累積在記憶體，由背景執行緒定期批次寫回 blog_posts.views
+
+- 讀取文章的 request 不再執行 UPDATE / COMMIT，也不會搶同一列的 row lock
+- 多個 gunicorn worker 各自累積，寫回時用 views = views + n，彼此不衝突
+- 正常關閉時 (atexit) 會把剩餘的數字寫回；強制砍掉程序最多遺失一個週期的計數
+"""
+
+import atexit
+import os
+import threading
+from collections import Counter
+
+from project.extensions import database
+
+
+class ViewCounter:
+
+    def __init__(self, table, column, flush_interval=30):
+        self.table = table
+        self.column = column
+        self.flush_interval = flush_interval
+        self.app = None
+
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config.get(
+            'VIEW_COUNTER_FLUSH_INTERVAL', self.flush_interval)
+        atexit.register(self.flush)
+
+    def increment(self, row_id, amount=1):
+        with self._lock:
+            self._pending[row_id] += amount
+        self._ensure_thread()
+
+    def pending(self, row_id):
+        """尚未寫回資料庫的計數 (顯示時加上，數字才不會倒退)"""
+        with self._lock:
+            return self._pending.get(row_id, 0)
+
+    def flush(self):
+        """把累積的計數用一條 UPDATE 寫回；失敗則放回等待下次"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = self._pending
+            self._pending = Counter()
+
+        ids = list(batch)
+        case_sql = ' '.join(['WHEN %s THEN %s'] * len(ids))
+        in_sql = ', '.join(['%s'] * len(ids))
+        params = [v for row_id in ids for v in (row_id, batch[row_id])] + ids
+
+        try:
+            with self.app.app_context():
+                cursor = database.connection.cursor()
+                cursor.execute(f"""
+                    UPDATE {self.table}
+                    SET {self.column} = {self.column} + CASE id {case_sql} END
+                    WHERE id IN ({in_sql})
+                """, params)
+                database.connection.commit()
+                cursor.close()
+        except Exception as e:
+            print(f"❌ View counter flush failed: {e}")
+            with self._lock:
+                self._pending.update(batch)
+            return 0
+
+        return len(ids)
+
+    def _ensure_thread(self):
+        # gunicorn fork 之後執行緒不會被帶過來，依 pid 判斷是否需要重開
+        if self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name=f'{self.table}-view-counter', daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+# 文章瀏覽數
+post_view_counter = ViewCounter('blog_posts', 'views')
@@ -2,9 +2,10 @@ from flask import Blueprint, render_template, request, session, flash, redirect,
 from .decorators import login_required, customer_required
 from project.extensions import database, mail
 from .db import get_current_user_id, get_user_details, update_user_profile
-from project.notifications import send_email
+from project.notifications import queue_email, transition_key
+from project.services import apply_booking_kpis, apply_order_kpis, record_product_sales
+from project.cache import invalidate_schedule_cache, popular_cache
 import MySQLdb.cursors
-import threading
 import re
 
 customer_bp = Blueprint('customer', __name__, url_prefix='/customer')
@@ -35,6 +36,8 @@ def send_cancel_notification(type_name, item_id, reason="顧客自行取消"):
         admin_email = current_app.config.get('MAIL_DEFAULT_SENDER')
         if not admin_email:
             return
+        if isinstance(admin_email, tuple):
+            admin_email = admin_email[1]
 
         user_id = get_current_user_id()
         user = get_user_details(user_id)
@@ -49,9 +52,12 @@ def send_cancel_notification(type_name, item_id, reason="顧客自行取消"):
         備註：{reason}
         請至後台確認詳情。
         """
-        app = current_app._get_current_object()
-        threading.Thread(target=send_email, args=(
-            admin_email, subject, body)).start()
+        # 排入 outbox (原本在沒有 app context 的執行緒裡呼叫 send_email 會失敗)
+        # 帶上 transition_key：後台恢復後再次取消仍會通知
+        kind = 'order' if type_name == '訂單' else 'booking'
+        version = transition_key(kind, item_id)
+        queue_email(admin_email, subject, body,
+                    dedupe_key=f'cancel:{type_name}:{item_id}:{version}:admin')
 
     except Exception as e:
         print(f"❌ 取消通知 Email 發送失敗: {e}")
@@ -229,11 +235,14 @@ def cancel_order(order_id):
                            (item['quantity'], item['product_id']))
             cursor.execute("INSERT INTO inventory_logs (product_id, change_amount, change_type, notes, created_by) VALUES (%s, %s, 'return', 'Customer Cancel', %s)",
                            (item['product_id'], item['quantity'], user_id))
+        record_product_sales(cursor, items, sign=-1)
 
         cursor.execute(
             "UPDATE orders SET status = 'cancelled' WHERE id = %s", (order_id,))
+        apply_order_kpis(cursor, order_id, sign=-1)
         database.connection.commit()
         cursor.close()
+        popular_cache.invalidate()
 
         send_cancel_notification("訂單", order_id)
         flash('訂單已取消，庫存已釋出', 'success')
@@ -251,8 +260,12 @@ def cancel_booking(booking_id):
     user_id = get_current_user_id()
     try:
         cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute(
-            "SELECT status, schedule_id FROM bookings WHERE id = %s AND customer_id = %s", (booking_id, user_id))
+        cursor.execute("""
+            SELECT b.status, b.schedule_id, b.global_schedule_id, s.start_time
+            FROM bookings b
+            LEFT JOIN shop_schedules s ON b.global_schedule_id = s.id
+            WHERE b.id = %s AND b.customer_id = %s
+        """, (booking_id, user_id))
         booking = cursor.fetchone()
 
         if not booking or booking['status'] in ['completed', 'cancelled']:
@@ -266,9 +279,18 @@ def cancel_booking(booking_id):
             cursor.execute(
                 "UPDATE course_schedules SET current_bookings = GREATEST(current_bookings - 1, 0) WHERE id = %s", (booking['schedule_id'],))
 
+        # ⭐ 釋出全店共用時段的名額 (book_course 佔用的是 shop_schedules)
+        if booking['global_schedule_id']:
+            cursor.execute(
+                "UPDATE shop_schedules SET current_bookings = GREATEST(current_bookings - 1, 0) WHERE id = %s", (booking['global_schedule_id'],))
+
+        apply_booking_kpis(cursor, booking_id, sign=-1)
         database.connection.commit()
         cursor.close()
 
+        if booking['start_time']:
+            invalidate_schedule_cache(booking['start_time'])
+
         send_cancel_notification("預約", booking_id)
         flash('預約已取消', 'success')
 
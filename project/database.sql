@@ -491,4 +491,287 @@ ALTER TABLE blog_posts CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_
 ALTER TABLE contact_messages CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 
 -- 3. 修改產品資料表 (讓您的產品敘述可以放 Emoji)
-ALTER TABLE products CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
\ No newline at end of file
+ALTER TABLE products CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+-- =====================================================
+-- 產品列表 Keyset 分頁索引
+-- 用途：/products 無限捲動以 (created_at, id) 游標接續，避免 OFFSET 掃描前面所有資料
+-- =====================================================
+CREATE INDEX idx_products_active_created ON products (is_active, created_at, id);
+CREATE INDEX idx_products_category_created ON products (category_id, is_active, created_at, id);
+
+-- =====================================================
+-- 產品全文檢索 (FULLTEXT + ngram parser，支援中文)
+-- 用途：/products?q= 搜尋改用 MATCH ... AGAINST，依相關度排序，不再全表 LIKE 掃描
+-- ngram_token_size 使用預設值 2 (雙字詞切分)
+-- =====================================================
+ALTER TABLE products ADD FULLTEXT INDEX ft_products_search (name, description) WITH PARSER ngram;
+
+-- =====================================================
+-- 產品累計銷量 (熱門產品排行)
+-- 用途：文章頁側欄「熱門產品」直接依 total_sold 索引取前幾筆，
+--       不再每次 SUM 整個 order_items
+-- 維護：結帳 / 取消 / 恢復訂單時在同一個 transaction 內增減；
+--       資料有疑慮時執行 flask --app project rebuild-sales-stats 全量重算
+-- =====================================================
+CREATE TABLE IF NOT EXISTS product_sales_stats (
+    product_id INT NOT NULL PRIMARY KEY,
+    total_sold INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_sales_stats_total (total_sold),
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+-- 初始化 (以既有訂單回填)
+INSERT INTO product_sales_stats (product_id, total_sold)
+SELECT oi.product_id, SUM(oi.quantity)
+FROM order_items oi
+JOIN orders o ON oi.order_id = o.id
+WHERE o.status != 'cancelled'
+GROUP BY oi.product_id;
+
+-- =====================================================
+-- 通知 Outbox (Email / LINE 待送佇列)
+-- 用途：request 只寫入一筆紀錄，由背景 worker (或 flask outbox-worker) 送出
+--       dedupe_key 唯一，同一事件不會重複通知；失敗依 next_attempt_at 指數退避重試
+-- =====================================================
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    channel ENUM('email', 'line') NOT NULL,
+    recipient VARCHAR(255) NOT NULL,
+    subject VARCHAR(255) NULL,
+    body TEXT NOT NULL,
+    html MEDIUMTEXT NULL,
+    dedupe_key VARCHAR(191) NULL,
+    status ENUM('pending', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT NULL,
+    next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    claim_token CHAR(32) NULL,
+    claimed_at DATETIME NULL,
+    sent_at DATETIME NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_outbox_dedupe (dedupe_key),
+    INDEX idx_outbox_due (status, next_attempt_at),
+    INDEX idx_outbox_claim (claim_token)
+) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+-- =====================================================
+-- 管理員群組通知彙整 (digest)
+-- 用途：同一 digest_group 在 ADMIN_DIGEST_WINDOW 秒內的通知合併成一則 LINE 訊息
+-- =====================================================
+ALTER TABLE notification_outbox
+    ADD COLUMN digest_group VARCHAR(64) NULL AFTER dedupe_key,
+    ADD INDEX idx_outbox_digest (digest_group, next_attempt_at);
+
+-- =====================================================
+-- 通知 outbox 認領逾時
+-- 用途：worker 重新認領卡在 sending 的通知時依 (status, claimed_at) 走索引，
+--       不必和待送通知的認領合成一條 OR 條件掃描
+-- =====================================================
+CREATE INDEX idx_outbox_stale ON notification_outbox(status, claimed_at);
+
+-- =====================================================
+-- 後台訂單 / 預約列表分頁
+-- 用途：列表依建立時間排序、依狀態 + 日期篩選，LIMIT/OFFSET 不必整張表排序
+-- =====================================================
+CREATE INDEX idx_orders_created ON orders(created_at);
+CREATE INDEX idx_orders_status_created ON orders(status, created_at);
+CREATE INDEX idx_bookings_created ON bookings(created_at);
+CREATE INDEX idx_bookings_status_created ON bookings(status, created_at);
+
+-- =====================================================
+-- 訂單 / 預約成本快照
+-- 用途：下單 / 預約當下記錄成本，之後修改產品成本 (含進貨加權平均) 或課程費用
+--       不影響既有訂單；KPI 計入 / 移出、每日彙總、reconcile-kpi 都讀這兩個欄位
+--       既有資料以目前的產品成本 / 課程費用回填
+-- =====================================================
+ALTER TABLE order_items ADD COLUMN unit_cost DECIMAL(10,2) NULL AFTER unit_price;
+ALTER TABLE bookings ADD COLUMN total_cost DECIMAL(10,2) NULL AFTER total_amount;
+
+UPDATE order_items oi
+JOIN products p ON oi.product_id = p.id
+SET oi.unit_cost = p.cost
+WHERE oi.unit_cost IS NULL;
+
+UPDATE bookings b
+JOIN courses c ON b.course_id = c.id
+SET b.total_cost = b.sessions_purchased * (COALESCE(c.service_fee, 0) + COALESCE(c.product_fee, 0))
+WHERE b.total_cost IS NULL;
+
+-- =====================================================
+-- 後台總覽統計 (KPI summary)
+-- 用途：id = 1 保存產品 / 課程 / 客戶 / 文章數；訂單 / 預約的增減分散寫入 id = 2 ~ 17
+--       (結帳 / 預約 / 取消 / 狀態變更時在同一個 transaction 內隨機挑一列，避免搶同一列鎖)
+--       後台總覽把所有列加總；`flask reconcile-kpi` 可全量重算並合併回 id = 1
+-- =====================================================
+CREATE TABLE IF NOT EXISTS kpi_summary (
+    id TINYINT PRIMARY KEY,
+    products INT NOT NULL DEFAULT 0,
+    courses INT NOT NULL DEFAULT 0,
+    orders INT NOT NULL DEFAULT 0,
+    bookings INT NOT NULL DEFAULT 0,
+    customers INT NOT NULL DEFAULT 0,
+    posts INT NOT NULL DEFAULT 0,
+    order_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    booking_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    order_cost DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    course_cost DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+-- 初始化 (之後由程式增減)
+REPLACE INTO kpi_summary
+    (id, products, courses, orders, bookings, customers, posts,
+     order_revenue, booking_revenue, order_cost, course_cost)
+SELECT 1,
+    (SELECT COUNT(*) FROM products WHERE is_active = TRUE),
+    (SELECT COUNT(*) FROM courses WHERE is_active = TRUE),
+    (SELECT COUNT(*) FROM orders WHERE status != 'cancelled'),
+    (SELECT COUNT(*) FROM bookings WHERE status != 'cancelled'),
+    (SELECT COUNT(*) FROM users WHERE role = 'customer'),
+    (SELECT COUNT(*) FROM blog_posts WHERE status = 'published'),
+    (SELECT COALESCE(SUM(total_amount), 0) FROM orders WHERE status != 'cancelled'),
+    (SELECT COALESCE(SUM(total_amount), 0) FROM bookings WHERE status != 'cancelled'),
+    (SELECT COALESCE(SUM(oi.quantity * oi.unit_cost), 0)
+     FROM order_items oi
+     JOIN orders o ON oi.order_id = o.id
+     WHERE o.status != 'cancelled'),
+    (SELECT COALESCE(SUM(total_cost), 0) FROM bookings WHERE status != 'cancelled');
+
+-- =====================================================
+-- 庫存頁備註 (products.latest_note)
+-- 用途：進貨 / 盤點時直接寫入使用者輸入的備註，庫存頁不必逐筆查 inventory_logs
+--       下方以既有 log 回填：只取進貨 (restock_product) / 盤點調整 (adjust_inventory_modal)
+--       寫入的紀錄，這兩處都沒有 reference_id；訂單產生的 sale / return 紀錄都有訂單編號，
+--       只有客戶自行取消訂單 (Customer Cancel) 沒有，另外排除
+-- =====================================================
+ALTER TABLE products ADD COLUMN latest_note TEXT NULL;
+
+CREATE INDEX idx_inventory_logs_product_created ON inventory_logs(product_id, created_at);
+
+UPDATE products p
+SET p.latest_note = (
+    SELECT CASE
+        WHEN SUBSTRING_INDEX(l.notes, '. 進貨價:', 1) = 'Manual Restock' THEN ''
+        ELSE TRIM(SUBSTRING_INDEX(l.notes, '. 進貨價:', 1))
+    END
+    FROM inventory_logs l
+    WHERE l.product_id = p.id
+      AND l.change_type IN ('purchase', 'adjustment', 'return')
+      AND l.reference_id IS NULL
+      AND COALESCE(l.notes, '') != 'Customer Cancel'
+    ORDER BY l.created_at DESC, l.id DESC
+    LIMIT 1
+);
+
+-- =====================================================
+-- 客戶累計統計 (customer_stats)
+-- 用途：每位客戶未取消的訂單 / 預約數、消費金額、最後消費時間
+--       建立 / 取消 / 恢復訂單與預約時同步增減；`flask rebuild-customer-stats` 可全量重算
+-- =====================================================
+CREATE TABLE IF NOT EXISTS customer_stats (
+    customer_id INT PRIMARY KEY,
+    order_count INT NOT NULL DEFAULT 0,
+    booking_count INT NOT NULL DEFAULT 0,
+    order_spent DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    booking_spent DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    last_activity_at DATETIME NULL,
+    FOREIGN KEY (customer_id) REFERENCES users(id) ON DELETE CASCADE
+) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+-- 回填既有資料
+INSERT INTO customer_stats
+    (customer_id, order_count, booking_count, order_spent, booking_spent, last_activity_at)
+SELECT u.id,
+       COALESCE(o.order_count, 0), COALESCE(b.booking_count, 0),
+       COALESCE(o.order_spent, 0), COALESCE(b.booking_spent, 0),
+       NULLIF(GREATEST(COALESCE(o.last_at, '1000-01-01'), COALESCE(b.last_at, '1000-01-01')),
+              '1000-01-01')
+FROM users u
+LEFT JOIN (
+    SELECT customer_id, COUNT(*) as order_count, SUM(total_amount) as order_spent,
+           MAX(created_at) as last_at
+    FROM orders WHERE status != 'cancelled'
+    GROUP BY customer_id
+) o ON o.customer_id = u.id
+LEFT JOIN (
+    SELECT customer_id, COUNT(*) as booking_count, SUM(total_amount) as booking_spent,
+           MAX(created_at) as last_at
+    FROM bookings WHERE status != 'cancelled'
+    GROUP BY customer_id
+) b ON b.customer_id = u.id
+WHERE u.role = 'customer';
+
+-- =====================================================
+-- 進階報表索引
+-- 用途：報表改用半開區間 created_at >= %s AND created_at < %s (不再包 DATE())，
+--       搭配下列複合索引走 range scan；(status, created_at) 已於後台列表分頁時建立
+--       舊的單欄 idx_customer / idx_status 已被複合索引涵蓋，一併移除
+--       驗證：flask --app project explain-reports
+-- =====================================================
+CREATE INDEX idx_orders_customer_created ON orders(customer_id, created_at);
+CREATE INDEX idx_bookings_customer_created ON bookings(customer_id, created_at);
+CREATE INDEX idx_users_role_created ON users(role, created_at);
+
+ALTER TABLE orders DROP INDEX idx_customer, DROP INDEX idx_status;
+ALTER TABLE bookings DROP INDEX idx_customer, DROP INDEX idx_status;
+
+-- =====================================================
+-- 進階報表每日彙總 (daily rollups)
+-- 用途：報表改讀每日彙總，不再每次從 orders / order_items / bookings 全量加總
+--       過去的日期彙總後封存 (sealed)；今天每 REPORT_ROLLUP_TODAY_TTL 秒重算
+--       訂單 / 預約取消或恢復時該日期解除封存，下次查詢時只重算那一天
+--       ⭐ 部署步驟：建立資料表後執行一次 `flask --app project refresh-rollups` 回填全部歷史
+--       (未回填時第一次查詢長期間報表會在 request 中補算)；校正：refresh-rollups --force
+-- =====================================================
+CREATE TABLE IF NOT EXISTS report_rollup_days (
+    sales_date DATE PRIMARY KEY,
+    sealed BOOLEAN NOT NULL DEFAULT FALSE,
+    refreshed_at DATETIME NULL
+) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS daily_sales_summary (
+    sales_date DATE PRIMARY KEY,
+    order_count INT NOT NULL DEFAULT 0,
+    order_revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    order_cost DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    booking_count INT NOT NULL DEFAULT 0,
+    booking_revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    course_cost DECIMAL(12, 2) NOT NULL DEFAULT 0
+) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS daily_product_sales (
+    sales_date DATE NOT NULL,
+    product_id INT NOT NULL,
+    quantity INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    cost DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    order_count INT NOT NULL DEFAULT 0,
+    customer_count INT NOT NULL DEFAULT 0,
+    line_count INT NOT NULL DEFAULT 0,
+    unit_price_sum DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (sales_date, product_id),
+    INDEX idx_daily_product (product_id, sales_date),
+    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS daily_course_sales (
+    sales_date DATE NOT NULL,
+    course_id INT NOT NULL,
+    sessions INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    cost DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    booking_count INT NOT NULL DEFAULT 0,
+    customer_count INT NOT NULL DEFAULT 0,
+    price_per_session_sum DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (sales_date, course_id),
+    INDEX idx_daily_course (course_id, sales_date),
+    FOREIGN KEY (course_id) REFERENCES courses(id) ON DELETE CASCADE
+) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+-- =====================================================
+-- 報表匯出索引
+-- 用途：匯出操作紀錄 (audit_logs) 依 created_at 範圍 + 排序串流讀取
+--       (orders / bookings / users / inventory_logs 已有 created_at 相關索引)
+-- =====================================================
+CREATE INDEX idx_audit_logs_created ON audit_logs(created_at);
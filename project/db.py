@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 import secrets
 # ⭐ 修改：改用 werkzeug.security
 from werkzeug.security import generate_password_hash, check_password_hash
+from .services import adjust_kpis
 
 # ... (SESSION HELPERS 保持不變) ...
 
@@ -179,6 +180,8 @@ def add_user(form):
             form.surname.data,
             role
         ))
+        if role == 'customer':
+            adjust_kpis(cursor, customers=1)
         database.connection.commit()
     finally:
         cursor.close()
@@ -246,3 +249,29 @@ def get_user_by_email(email):
     user = cursor.fetchone()
     cursor.close()
     return user
+
+
+def get_nav_categories():
+    """
+    導覽列用的產品 / 課程分類 (走程序內快取)
+    Returns: (product_categories, course_categories)
+    ⚠️ 回傳的是共用快取物件，請勿直接修改內容
+    """
+    from .cache import category_cache
+
+    def load():
+        cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+        try:
+            cursor.execute(
+                "SELECT id, name FROM product_categories ORDER BY display_order, name")
+            product_categories = cursor.fetchall()
+
+            cursor.execute(
+                "SELECT id, name FROM course_categories ORDER BY display_order, name")
+            course_categories = cursor.fetchall()
+        finally:
+            cursor.close()
+        return product_categories, course_categories
+
+    ttl = current_app.config.get('CATEGORY_CACHE_TTL')
+    return category_cache.get_or_load('nav', load, ttl=ttl)
@@ -0,0 +1,129 @@
+"""
+Scoped DNS Cache for Outbound HTTP Clients
+只給 project.http_clients 的連線池使用，不影響 MySQL / Cloudinary 等其他連線
+
+- 解析結果快取 HTTP_DNS_TTL 秒 (socket.getaddrinfo 拿不到紀錄本身的 TTL，以設定值為準)
+- 依 HTTP_DNS_FAMILY 排序位址：'ipv4' (預設，IPv4 優先、IPv6 備援) / 'ipv6' / 'any'
+- 重新解析失敗時先沿用過期的結果，避免 DNS 短暫異常導致通知全部失敗
+- 某個位址連不上會換下一個；全部失敗則清掉快取，下次重新解析
+"""
+
+import socket
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util import connection as urllib3_connection
+
+FAMILY_ORDER = {
+    'ipv4': (socket.AF_INET, socket.AF_INET6),
+    'ipv6': (socket.AF_INET6, socket.AF_INET),
+}
+
+
+class DNSCache:
+
+    def __init__(self, ttl=300, family='ipv4'):
+        self.ttl = ttl
+        self.family = family
+        self._entries = {}  # (host, port) -> (addresses, expires_at)
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """回傳 [(family, sockaddr), ...]，已依偏好的 address family 排序"""
+        key = (host, port)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.gaierror:
+            if entry:
+                print(f"⚠️ DNS lookup failed for {host}, using stale result")
+                return entry[0]
+            raise
+
+        addresses = self._order([(info[0], info[4]) for info in infos])
+        with self._lock:
+            self._entries[key] = (addresses, time.monotonic() + self.ttl)
+        return addresses
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def _order(self, addresses):
+        # 去除重複位址，保留 getaddrinfo 原本的順序後再依 family 偏好排序
+        unique = list(dict.fromkeys(addresses))
+        order = FAMILY_ORDER.get(self.family)
+        if not order:
+            return unique
+        return sorted(unique, key=lambda a: order.index(a[0]) if a[0] in order else len(order))
+
+
+# 對外 HTTP client 共用的 DNS 快取 (init_app 時套用設定)
+dns_cache = DNSCache()
+
+
+class CachedDNSConnectionMixin:
+    """覆寫 urllib3 建立 socket 的步驟：改用 dns_cache 的位址逐一連線 (TLS SNI 仍使用原 host)"""
+
+    def _new_conn(self):
+        host = getattr(self, '_dns_host', self.host)
+        try:
+            addresses = dns_cache.resolve(host, self.port)
+        except socket.gaierror as e:
+            raise NewConnectionError(self, f"Failed to resolve {host}: {e}") from e
+
+        last_error = None
+        for _, sockaddr in addresses:
+            try:
+                return urllib3_connection.create_connection(
+                    (sockaddr[0], self.port),
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options,
+                )
+            except socket.timeout:
+                last_error = ConnectTimeoutError(
+                    self, f"Connection to {host} ({sockaddr[0]}) timed out. "
+                          f"(connect timeout={self.timeout})")
+            except OSError as e:
+                last_error = NewConnectionError(
+                    self, f"Failed to establish a new connection to {sockaddr[0]}: {e}")
+
+        # 所有位址都連不上：可能是 DNS 已變更，下次重新解析
+        dns_cache.invalidate(host, self.port)
+        raise last_error or NewConnectionError(self, f"No address found for {host}")
+
+
+class CachedDNSHTTPConnection(CachedDNSConnectionMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    """requests 的 HTTPAdapter，連線池改用上面的 connection class"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDNSHTTPConnectionPool,
+            'https': CachedDNSHTTPSConnectionPool,
+        }
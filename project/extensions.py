@@ -1,9 +1,9 @@
-from flask_mysqldb import MySQL
 from flask_wtf.csrf import CSRFProtect
 from flask_bootstrap import Bootstrap5
 from flask_mail import Mail
+from project.pool import PooledMySQL
 
-database = MySQL()
+database = PooledMySQL()  # 連線池版，介面與 flask_mysqldb.MySQL 相同
 mail = Mail()
 csrf = CSRFProtect()  # Prevent unauthorized malicious requests
 bootstrap = Bootstrap5()
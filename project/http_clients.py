@@ -0,0 +1,141 @@
+"""
+Shared HTTP Clients
+對外 API (SendGrid / LINE Messaging / LINE Login) 共用的 requests.Session
+
+- 每個 upstream 一個 Session + HTTPAdapter 連線池，keep-alive 重複使用，不必每次重新 TLS handshake
+- 一律帶 (connect, read) timeout，避免上游卡住把 worker 拖死
+- 每個 upstream 有同時連線數上限 (BoundedSemaphore)，等不到名額就丟出 UpstreamBusy
+- Session 在 fork 之後才建立 (依 pid 判斷)，gunicorn 各 worker 互不共用 socket
+- DNS 解析走 project.dns_cache (有 TTL 的程序內快取 + IPv4 優先)，只作用在這些 client
+"""
+
+import os
+import threading
+
+import requests
+from urllib3.util.retry import Retry
+
+from project.dns_cache import CachedDNSAdapter, dns_cache
+
+
+class UpstreamBusy(Exception):
+    """該 upstream 的同時連線數已達上限，且等待逾時"""
+
+
+class UpstreamClient:
+
+    # 未個別指定時使用 (init_app 會改成 HTTP_CONNECT_TIMEOUT / HTTP_READ_TIMEOUT)
+    default_connect_timeout = 3.05
+    default_read_timeout = 10
+
+    def __init__(self, name, base_url, pool_size=10, max_concurrency=5,
+                 connect_timeout=None, read_timeout=None, connect_retries=2,
+                 acquire_timeout=5):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connect_retries = connect_retries
+        self.acquire_timeout = acquire_timeout
+
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None or self._session_pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    self._session = self._build_session()
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def _build_session(self):
+        session = requests.Session()
+        # 只重試「連線建立失敗」(請求尚未送出)，POST 不會被重複送出
+        retry = Retry(total=self.connect_retries, connect=self.connect_retries,
+                      read=0, status=0, other=0, backoff_factor=0.3)
+        adapter = self.make_adapter(retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def make_adapter(self, retry):
+        return CachedDNSAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                max_retries=retry)
+
+    def request(self, method, url, **kwargs):
+        """url 以 / 開頭時自動接上 base_url"""
+        if url.startswith('/'):
+            url = self.base_url + url
+        kwargs.setdefault('timeout', self.timeout)
+
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            raise UpstreamBusy(
+                f"{self.name}: 已有 {self.max_concurrency} 個請求進行中")
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            self._semaphore.release()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout or self.default_connect_timeout,
+                self.read_timeout or self.default_read_timeout)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class HTTPClientRegistry:
+
+    def __init__(self):
+        self._clients = {}
+
+    def register(self, name, base_url, **options):
+        self._clients[name] = UpstreamClient(name, base_url, **options)
+        return self._clients[name]
+
+    def get(self, name):
+        return self._clients[name]
+
+    def __getitem__(self, name):
+        return self._clients[name]
+
+    def init_app(self, app):
+        """
+        HTTP_CONNECT_TIMEOUT / HTTP_READ_TIMEOUT 作為未個別指定 timeout 的預設值
+        HTTP_DNS_TTL / HTTP_DNS_FAMILY 套用到 dns_cache
+        """
+        dns_cache.ttl = app.config.get('HTTP_DNS_TTL', dns_cache.ttl)
+        dns_cache.family = app.config.get('HTTP_DNS_FAMILY', dns_cache.family)
+        if app.config.get('HTTP_CONNECT_TIMEOUT'):
+            UpstreamClient.default_connect_timeout = app.config['HTTP_CONNECT_TIMEOUT']
+        if app.config.get('HTTP_READ_TIMEOUT'):
+            UpstreamClient.default_read_timeout = app.config['HTTP_READ_TIMEOUT']
+
+
+# =====================================================
+# 共用 upstream 實例
+# =====================================================
+
+http_clients = HTTPClientRegistry()
+
+# SendGrid v3 Mail Send
+http_clients.register('sendgrid', 'https://api.sendgrid.com',
+                      pool_size=4, max_concurrency=4)
+
+# LINE Messaging API (push message)
+http_clients.register('line_messaging', 'https://api.line.me',
+                      pool_size=4, max_concurrency=4)
+
+# LINE Login (OAuth token / profile)，在使用者的 request 中呼叫，timeout 設短
+http_clients.register('line_login', 'https://api.line.me',
+                      pool_size=10, max_concurrency=10, read_timeout=5)
@@ -0,0 +1,208 @@
+"""
+Per-request SQL Instrumentation
+統計每個 request 的查詢次數、DB 總耗時與最慢的語句
+
+- 回應加上 Server-Timing header (瀏覽器 DevTools 的 Timing 分頁可直接看到)
+- 每個 request 寫一行 JSON log (logger: project.sql)
+- 可用 @query_budget(n) 宣告路由的查詢上限；
+  SQL_QUERY_BUDGET_STRICT=True 時超標會丟出 QueryBudgetExceeded (測試用)
+- 串流回應 (報表匯出) 在 body 送完後才記錄：沒有 Server-Timing，超標只記 warning
+"""
+
+import heapq
+import json
+import logging
+import re
+import time
+
+from flask import current_app, g, has_request_context, request
+
+logger = logging.getLogger('project.sql')
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    """路由的查詢次數超過 @query_budget 宣告的上限"""
+
+
+class QueryStats:
+    """單一 request 的查詢統計"""
+
+    def __init__(self, keep_slowest=3, capture=False):
+        self.count = 0
+        self.total = 0.0
+        self.keep_slowest = keep_slowest
+        self._slowest = []  # min-heap of (duration, seq, sql)
+        # capture=True 時保留每一條 (sql, args)，給 `flask explain-reports` 逐條 EXPLAIN
+        self.captured = [] if capture else None
+
+    def record(self, sql, duration, args=None):
+        self.count += 1
+        self.total += duration
+        if self.captured is not None:
+            self.captured.append((sql, args))
+        if self.keep_slowest <= 0:
+            return
+
+        item = (duration, self.count, sql)
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, item)
+        elif duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    @property
+    def slowest(self):
+        return [
+            {'ms': round(d * 1000, 2), 'sql': _shorten(sql)}
+            for d, _, sql in sorted(self._slowest, reverse=True)
+        ]
+
+
+def _shorten(sql, limit=200):
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _WHITESPACE.sub(' ', str(sql)).strip()
+    return sql if len(sql) <= limit else sql[:limit] + '...'
+
+
+class InstrumentedCursor:
+    """包裝 MySQLdb cursor，execute / executemany 時計時"""
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, query, args=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            self._stats.record(query, time.perf_counter() - start, args)
+
+    def executemany(self, query, args):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, args)
+        finally:
+            self._stats.record(query, time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+
+class InstrumentedConnection:
+    """包裝 MySQLdb connection，cursor() 回傳 InstrumentedCursor"""
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._stats)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def get_query_stats():
+    """目前 request 的 QueryStats (不在 request 中則回傳 None)"""
+    if not has_request_context():
+        return None
+    if '_sql_stats' not in g:
+        g._sql_stats = QueryStats(current_app.config['SQL_SLOW_QUERY_TOP'])
+    return g._sql_stats
+
+
+def instrument_connection(conn):
+    """給 PooledMySQL 使用的 connection wrapper"""
+    if not current_app.config.get('SQL_INSTRUMENTATION'):
+        return conn
+    stats = get_query_stats()
+    if stats is None:
+        return conn
+    return InstrumentedConnection(conn, stats)
+
+
+def query_budget(max_queries):
+    """
+    宣告路由的查詢上限，放在 @xxx_bp.route 底下：
+
+        @main_bp.route('/')
+        @query_budget(5)
+        def home(): ...
+    """
+    def decorator(f):
+        f._query_budget = max_queries
+        return f
+    return decorator
+
+
+def init_sql_instrumentation(app, database):
+    app.config.setdefault('SQL_INSTRUMENTATION', True)
+    app.config.setdefault('SQL_SLOW_QUERY_TOP', 3)
+    app.config.setdefault('SQL_QUERY_BUDGET_STRICT', False)
+
+    database.connection_wrapper = instrument_connection
+
+    @app.after_request
+    def report_query_stats(response):
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, '_query_budget', None)
+        record = {
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+        }
+
+        if response.is_streamed:
+            # 串流回應 (CSV / XLSX 匯出) 的查詢在送出 body 時才執行，after_request 時還沒跑：
+            # 先建立 QueryStats，等 body 送完 (call_on_close) 再記錄。
+            # 此時 header 已送出，不加 Server-Timing；超過 budget 只記 warning，不丟例外
+            stats = get_query_stats()
+            if stats is None:
+                return response
+            response.call_on_close(
+                lambda: _log_query_stats(stats, record, budget, strict=False))
+            return response
+
+        stats = g.get('_sql_stats')
+        if stats is None or stats.count == 0:
+            return response
+
+        db_ms = round(stats.total * 1000, 2)
+        response.headers.add(
+            'Server-Timing', f'db;dur={db_ms};desc="{stats.count} queries"')
+        _log_query_stats(stats, record, budget,
+                         strict=current_app.config['SQL_QUERY_BUDGET_STRICT'])
+        return response
+
+
+def _log_query_stats(stats, record, budget, strict):
+    """寫一行 JSON log；strict=True 且超過 budget 時丟出 QueryBudgetExceeded"""
+    if stats.count == 0:
+        return
+
+    record = dict(record, queries=stats.count, db_ms=round(stats.total * 1000, 2),
+                  slowest=stats.slowest)
+    if budget is not None:
+        record['budget'] = budget
+
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    if budget is not None and stats.count > budget:
+        logger.warning(line)
+        if strict:
+            raise QueryBudgetExceeded(
+                f"{record['endpoint']} 執行了 {stats.count} 次查詢，超過上限 {budget}")
+    else:
+        logger.info(line)
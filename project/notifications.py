@@ -4,29 +4,16 @@ Updated: Uses LINE Messaging API for Group Notifications & Customer Emails
 """
 
 from flask import current_app, url_for
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
 from linebot.exceptions import LineBotApiError
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import threading
-import socket
-from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from project.extensions import database
+from project.http_clients import http_clients
+from project.outbox import enqueue, CHANNEL_EMAIL, CHANNEL_LINE
 
 
-_original_getaddrinfo = socket.getaddrinfo
-
-
-def _ipv4_only_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
-    # 強制指定 family 為 AF_INET (IPv4)
-    return _original_getaddrinfo(host, port, socket.AF_INET, type, proto, flags)
-
-
-# 套用補丁
-socket.getaddrinfo = _ipv4_only_getaddrinfo
-
 # ==========================================
 # 📧 EMAIL 基礎函式
 # ==========================================
@@ -60,9 +47,12 @@ def send_email(to, subject, body, html=None):
             html_content=html if html else None
         )
 
-        # 初始化客戶端並發送
-        sg = SendGridAPIClient(api_key)
-        response = sg.send(message)
+        # 透過共用連線池呼叫 SendGrid v3 API (不再每封信建立新的 client / TLS 連線)
+        response = http_clients['sendgrid'].post(
+            '/v3/mail/send',
+            json=message.get(),
+            headers={'Authorization': f'Bearer {api_key}'}
+        )
 
         # 檢查回應狀態碼 (2xx 代表成功)
         if 200 <= response.status_code < 300:
@@ -70,7 +60,7 @@ def send_email(to, subject, body, html=None):
             return True
         else:
             print(f"❌ Email 發送失敗，API 回應: {response.status_code}")
-            print(response.body)
+            print(response.text)
             return False
 
     except Exception as e:
@@ -78,10 +68,10 @@ def send_email(to, subject, body, html=None):
         return False
 
 
-def send_email_async(app, to, subject, body, html=None):
-    """非同步發送 wrapper"""
-    with app.app_context():
-        send_email(to, subject, body, html)
+def queue_email(to, subject, body, html=None, dedupe_key=None):
+    """排入 outbox，由背景 worker 呼叫 send_email 送出"""
+    return enqueue(CHANNEL_EMAIL, to, body, subject=subject, html=html,
+                   dedupe_key=dedupe_key)
 # ==========================================
 # 💬 LINE MESSAGING API 基礎函式
 # ==========================================
@@ -90,15 +80,26 @@ def send_email_async(app, to, subject, body, html=None):
 def send_line_push_message(target_id, message_text):
     """
     通用函式：發送訊息給 User ID 或 Group ID
+    message_text 可以是字串或字串 list (一次 push 最多 5 則，彙整通知用)
     """
     token = current_app.config.get('LINE_CHANNEL_ACCESS_TOKEN')
     if not token or not target_id:
         return False
 
+    texts = [message_text] if isinstance(message_text, str) else list(message_text)
+
     try:
-        line_bot_api = LineBotApi(token)
-        line_bot_api.push_message(
-            target_id, TextSendMessage(text=message_text))
+        response = http_clients['line_messaging'].post(
+            '/v2/bot/message/push',
+            json={
+                'to': target_id,
+                'messages': [{'type': 'text', 'text': text} for text in texts]
+            },
+            headers={'Authorization': f'Bearer {token}'}
+        )
+        if response.status_code != 200:
+            print(f"❌ LINE Push failed: {response.status_code} {response.text}")
+            return False
         return True
     except Exception as e:
         print(f"❌ LINE Push failed: {e}")
@@ -123,31 +124,68 @@ def send_customer_line_message(user_line_id, message_text):
     """發送給客戶"""
     return send_line_push_message(user_line_id, message_text)
 
+
+def queue_line_message(target_id, message_text, dedupe_key=None):
+    """排入 outbox，由背景 worker 呼叫 send_line_push_message 送出"""
+    return enqueue(CHANNEL_LINE, target_id, message_text, dedupe_key=dedupe_key)
+
+
+def queue_group_notification(message_text, dedupe_key=None):
+    """
+    排入 outbox：發送給「管理員群組」
+    ⭐ ADMIN_DIGEST_WINDOW 秒內的多則通知會合併成一則 (活動期間避免洗版與 LINE 限流)
+    """
+    group_id = current_app.config.get('LINE_ADMIN_GROUP_ID')
+
+    if group_id:
+        return enqueue(CHANNEL_LINE, group_id, message_text, dedupe_key=dedupe_key,
+                       digest_group='admin',
+                       digest_window=current_app.config.get('ADMIN_DIGEST_WINDOW', 0))
+    else:
+        print("⚠️ 未設定 LINE_ADMIN_GROUP_ID，無法發送群組通知")
+        return False
+
 # ==========================================
 # 🔄 整合通知流程
 # ==========================================
+# ⭐ 以下函式只負責「排入 outbox」，實際送出由 project.outbox 的 worker 處理
+# dedupe_key 讓同一事件重複觸發 (例如重複送出表單) 只會通知一次
+# 狀態變更的 key 帶上 transition_key (該筆資料的 updated_at)：
+# 同一次變更重複觸發仍只送一次，取消 -> 恢復 -> 再取消這類重複的轉換則各自通知
+
+TRANSITION_TABLES = {'order': 'orders', 'booking': 'bookings'}
+
+
+def transition_key(kind, row_id):
+    """訂單 / 預約目前這次狀態變更的區別碼 (updated_at；狀態沒變時 MySQL 不會更新它)"""
+    cursor = database.connection.cursor()
+    try:
+        cursor.execute(
+            f"SELECT updated_at FROM {TRANSITION_TABLES[kind]} WHERE id = %s", (row_id,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if not row or not row['updated_at']:
+        return 'initial'
+    return row['updated_at'].strftime('%Y%m%d%H%M%S')
 
 
 def notify_new_order_created(order_id, customer_name, customer_email, total_amount, items_text):
     """新訂單成立"""
-    app = current_app._get_current_object()
-
     # 1. LINE 通知管理員群組
     msg_text = f"🛍️ [新訂單] #{order_id}\n客戶：{customer_name}\n金額：NT$ {total_amount:,.0f}\n\n請至後台確認。"
-    send_group_notification(msg_text)
+    queue_group_notification(msg_text, dedupe_key=f'order:{order_id}:created:admin')
 
     # 2. Email 通知客戶
     if customer_email:
         subject = '晶品芳療 - 訂單申請已收到'
         body = f"""親愛的 {customer_name}，\n\n感謝您的訂購！您的訂單 #{order_id} 申請已收到。\n\n訂購內容：\n{items_text}\n\n總金額：NT$ {total_amount:,.0f}\n\n我們將盡快確認訂單。"""
-        threading.Thread(target=send_email_async, args=(
-            app, customer_email, subject, body)).start()
+        queue_email(customer_email, subject, body,
+                    dedupe_key=f'order:{order_id}:created:email')
 
 
 def notify_new_booking_created(booking_id, customer_name, customer_email, course_name, time_str):
     """新預約成立 (待確認)"""
-    app = current_app._get_current_object()
-
     # 1. LINE 通知管理員群組
     msg_text = (
         f"📅 [新預約申請] #{booking_id}\n"
@@ -159,7 +197,7 @@ def notify_new_booking_created(booking_id, customer_name, customer_email, course
         f"------------------\n"
         f"請管理員至後台確認。"
     )
-    send_group_notification(msg_text)
+    queue_group_notification(msg_text, dedupe_key=f'booking:{booking_id}:created:admin')
 
     # 2. Email 通知客戶
     if customer_email:
@@ -173,90 +211,86 @@ def notify_new_booking_created(booking_id, customer_name, customer_email, course
             f"⚠️ 目前狀態為【待確認】。\n"
             f"服務人員確認時段後，將會發送預約確認信給您。\n"
         )
-        threading.Thread(
-            target=send_email_async,
-            args=(app, customer_email, cust_subject, cust_body)
-        ).start()
+        queue_email(customer_email, cust_subject, cust_body,
+                    dedupe_key=f'booking:{booking_id}:created:email')
 
 
 def notify_order_confirmed(order_id, customer, total_amount):
     """訂單確認 (通知取貨)"""
-    app = current_app._get_current_object()
     msg = f"✅ 訂單 #{order_id} 已確認！\n金額：NT$ {total_amount:,.0f}\n請您於營業時間前往店內付款取貨，謝謝！"
+    version = transition_key('order', order_id)
 
     # LINE 通知客戶
     if customer.get('line_id'):
-        send_customer_line_message(customer['line_id'], msg)
+        queue_line_message(customer['line_id'], msg,
+                           dedupe_key=f'order:{order_id}:confirmed:{version}:line')
 
-    # Email 通知客戶 (非同步)
+    # Email 通知客戶
     if customer.get('email'):
         subject = f"晶品芳療 - 訂單 #{order_id} 確認通知"
-        threading.Thread(target=send_email_async, args=(
-            app, customer['email'], subject, msg)).start()
+        queue_email(customer['email'], subject, msg,
+                    dedupe_key=f'order:{order_id}:confirmed:{version}:email')
 
 
 def notify_booking_confirmed(booking_id, customer, course_name, time_str):
     """預約確認"""
-    app = current_app._get_current_object()
     msg = f"✅ 預約 #{booking_id} 已確認！\n課程：{course_name}\n時間：{time_str}\n\n我們已為您保留時段，請準時蒞臨。"
+    version = transition_key('booking', booking_id)
 
     # LINE 通知客戶
     if customer.get('line_id'):
-        send_customer_line_message(customer['line_id'], msg)
+        queue_line_message(customer['line_id'], msg,
+                           dedupe_key=f'booking:{booking_id}:confirmed:{version}:line')
 
-    # Email 通知客戶 (非同步)
+    # Email 通知客戶
     if customer.get('email'):
         subject = f"晶品芳療 - 預約 #{booking_id} 確認通知"
-        threading.Thread(target=send_email_async, args=(
-            app, customer['email'], subject, msg)).start()
+        queue_email(customer['email'], subject, msg,
+                    dedupe_key=f'booking:{booking_id}:confirmed:{version}:email')
 
 
 def notify_contact_message(name, email, phone, line_id, message):
     """聯絡表單通知"""
-    app = current_app._get_current_object()
-
     # LINE 通知群組
     msg_text = f"📧 [新聯絡訊息]\n姓名：{name}\nEmail：{email}\n電話：{phone}\n內容：{message}"
-    send_group_notification(msg_text)
+    queue_group_notification(msg_text)
 
-    # Email 回信給客戶 (非同步)
+    # Email 回信給客戶
     if email:
         subject = '晶品芳療 - 已收到您的訊息'
         body = f"親愛的 {name}，我們已收到您的訊息，將盡快回覆。\n\n您的訊息：\n{message}"
-        threading.Thread(target=send_email_async, args=(
-            app, email, subject, body)).start()
+        queue_email(email, subject, body)
     return True
 
 
 def notify_order_status_update(order_id, customer_name, customer_email, status):
     """訂單狀態變更 (Email)"""
-    app = current_app._get_current_object()
     status_map = {'confirmed': '已確認', 'completed': '已完成', 'cancelled': '已取消'}
     status_text = status_map.get(status, status)
 
     if customer_email:
+        version = transition_key('order', order_id)
         subject = f'晶品芳療 - 訂單狀態更新 ({status_text})'
         body = f"親愛的 {customer_name}，訂單 #{order_id} 狀態已更新為：{status_text}。"
-        threading.Thread(target=send_email_async, args=(
-            app, customer_email, subject, body)).start()
+        queue_email(customer_email, subject, body,
+                    dedupe_key=f'order:{order_id}:{status}:{version}:email')
 
 
 def notify_booking_status_update(booking_id, customer_name, customer_email, course_name, status):
     """預約狀態變更 (Email)"""
-    app = current_app._get_current_object()
     status_map = {'confirmed': '已確認', 'completed': '已完成', 'cancelled': '已取消'}
     status_text = status_map.get(status, status)
 
     if customer_email:
+        version = transition_key('booking', booking_id)
         subject = f'晶品芳療 - 預約狀態更新 ({status_text})'
         body = f"親愛的 {customer_name}，預約 #{booking_id} ({course_name}) 狀態已更新為：{status_text}。"
-        threading.Thread(target=send_email_async, args=(
-            app, customer_email, subject, body)).start()
+        queue_email(customer_email, subject, body,
+                    dedupe_key=f'booking:{booking_id}:{status}:{version}:email')
 
 
 def send_password_reset_email(to_email, token):
     """發送密碼重設信"""
-    app = current_app._get_current_object()
     reset_url = url_for('auth.reset_password', token=token, _external=True)
 
     subject = "晶品芳療 - 重設您的密碼"
@@ -274,6 +308,5 @@ def send_password_reset_email(to_email, token):
 晶品芳療團隊
     """
 
-    # 改為非同步發送
-    threading.Thread(target=send_email_async, args=(
-        app, to_email, subject, body)).start()
+    # 排入 outbox (每個 token 都不同，不做去重)
+    queue_email(to_email, subject, body)
@@ -0,0 +1,352 @@
+"""
+Notification Outbox
+通知 (Email / LINE) 先寫入 notification_outbox 資料表，由背景 worker 批次送出
+
+- request 只做一次 INSERT，不再等待 SendGrid / LINE API，也不再每封信開一條執行緒
+- dedupe_key 有 UNIQUE 索引：同一事件重複觸發只會送一次
+- 送出失敗以指數退避重試 (OUTBOX_MAX_ATTEMPTS 次後標記為 failed)
+- 多個 gunicorn worker 或獨立的 `flask outbox-worker` 可同時消化，
+  以 claim_token 認領避免重複寄送；認領後卡住超過 OUTBOX_CLAIM_TIMEOUT 的會被重新認領
+  (卡住的那次也算一次嘗試，達 OUTBOX_MAX_ATTEMPTS 直接標記為 failed)
+- digest_group：同一群組 (例如管理員 LINE 群組) 短時間內的多則通知合併成一則送出
+  第一則立即送出；之後在 window 內的通知排到「上一則 + window」一起送，安靜時段不延遲
+- sent / failed 超過 OUTBOX_RETENTION_DAYS 天的資料由 worker 每小時分批刪除
+  (刪除後同一個 dedupe_key 可再次排入；通知的 key 都含事件版本，不會重送舊事件)
+"""
+
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import MySQLdb.cursors
+
+from project.extensions import database
+
+CHANNEL_EMAIL = 'email'
+CHANNEL_LINE = 'line'
+
+# LINE 單則文字訊息上限 5000 字、一次 push 最多 5 則
+LINE_TEXT_LIMIT = 4800
+LINE_MESSAGES_PER_PUSH = 5
+DIGEST_SEPARATOR = '\n━━━━━━━━━━━━\n'
+
+# 保留期清理：每輪最多刪除筆數 / 兩次清理的間隔秒數
+PURGE_CHUNK_SIZE = 1000
+PURGE_INTERVAL = 3600
+
+
+def enqueue(channel, recipient, body, subject=None, html=None, dedupe_key=None,
+            digest_group=None, digest_window=0):
+    """
+    寫入一筆待送通知 (會自行 commit，請在業務資料 commit 之後呼叫)
+    digest_group + digest_window (秒)：同群組在 window 內的通知合併送出
+    Returns: True = 新增；False = dedupe_key 重複 (已排入過) 或寫入失敗
+    """
+    if not recipient:
+        return False
+
+    cursor = database.connection.cursor()
+    try:
+        send_at = None
+        if digest_group and digest_window > 0:
+            send_at = _digest_send_at(cursor, digest_group, digest_window)
+
+        cursor.execute("""
+            INSERT IGNORE INTO notification_outbox
+            (channel, recipient, subject, body, html, dedupe_key,
+             digest_group, next_attempt_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, COALESCE(%s, NOW()))
+        """, (channel, recipient, subject, body, html, dedupe_key,
+              digest_group, send_at))
+        created = cursor.rowcount == 1
+        database.connection.commit()
+    except Exception as e:
+        database.connection.rollback()
+        print(f"❌ Outbox enqueue failed: {e}")
+        return False
+    finally:
+        cursor.close()
+
+    if created:
+        outbox_worker.wake()
+    return created
+
+
+def _digest_send_at(cursor, digest_group, window):
+    """
+    決定 digest 通知的送出時間 (leading + trailing edge)：
+    - window 內沒有其他通知 -> None (立即送出)
+    - 已有排程中的合併訊息 -> 併入同一個時間點
+    - 剛送出過一則 -> 排到「上一則 + window」
+    重試中 (attempts > 0 且尚未送出) 的通知 next_attempt_at 已被退避往後延，
+    不能拿來當合併的時間點，否則新通知會跟著延後最多 OUTBOX_BACKOFF_MAX 秒
+    """
+    cursor.execute("""
+        SELECT MAX(next_attempt_at) AS last_slot, NOW() AS now
+        FROM notification_outbox
+        WHERE digest_group = %s AND (attempts = 0 OR status = 'sent')
+          AND next_attempt_at > NOW() - INTERVAL %s SECOND
+    """, (digest_group, window))
+    row = cursor.fetchone()
+
+    if row['last_slot'] is None:
+        return None
+    if row['last_slot'] > row['now']:
+        return row['last_slot']
+    return row['last_slot'] + timedelta(seconds=window)
+
+
+class OutboxWorker:
+
+    def __init__(self):
+        self.app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._last_purge = None
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('OUTBOX_INPROCESS_WORKER', True)
+        app.config.setdefault('OUTBOX_MAX_WORKERS', 4)
+        app.config.setdefault('OUTBOX_BATCH_SIZE', 20)
+        app.config.setdefault('OUTBOX_POLL_INTERVAL', 5)
+        app.config.setdefault('OUTBOX_MAX_ATTEMPTS', 6)
+        app.config.setdefault('OUTBOX_BACKOFF_BASE', 30)
+        app.config.setdefault('OUTBOX_BACKOFF_MAX', 3600)
+        app.config.setdefault('OUTBOX_CLAIM_TIMEOUT', 600)
+        app.config.setdefault('OUTBOX_RETENTION_DAYS', 14)
+
+        if app.config['OUTBOX_INPROCESS_WORKER']:
+            # 每個 worker 程序第一次收到 request 時啟動 (fork 之後才開執行緒)
+            app.before_request(self._ensure_thread)
+
+    def wake(self):
+        """有新通知：若本程序負責消化就立刻處理，不等下一輪輪詢"""
+        if self.app is None or not self.app.config['OUTBOX_INPROCESS_WORKER']:
+            return
+        self._ensure_thread()
+        self._wakeup.set()
+
+    # ---------- 認領 / 送出 ----------
+
+    def process_batch(self):
+        """認領一批到期的通知並送出，回傳處理筆數"""
+        config = self.app.config
+        token = uuid.uuid4().hex
+
+        with self.app.app_context():
+            cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+            try:
+                # ⭐ 兩次認領各自走索引 (不用 OR)，只鎖到期的那幾筆，不擋 enqueue 的 INSERT
+                # 1. 到期的待送通知 (idx_outbox_due)
+                cursor.execute("""
+                    UPDATE notification_outbox
+                    SET status = 'sending', claim_token = %s, claimed_at = NOW()
+                    WHERE status = 'pending' AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                """, (token, config['OUTBOX_BATCH_SIZE']))
+                claimed = cursor.rowcount
+                database.connection.commit()
+
+                # 2. 認領後卡住 (程序中斷) 的通知 (idx_outbox_stale)
+                # 卡住的那次算一次嘗試；SET 由左至右執行，status / claim_token 看到的是 +1 後的次數
+                if claimed < config['OUTBOX_BATCH_SIZE']:
+                    cursor.execute("""
+                        UPDATE notification_outbox
+                        SET attempts = attempts + 1,
+                            status = IF(attempts >= %s, 'failed', 'sending'),
+                            claim_token = IF(status = 'sending', %s, NULL),
+                            claimed_at = NOW(),
+                            last_error = 'claim timed out'
+                        WHERE status = 'sending'
+                          AND claimed_at < NOW() - INTERVAL %s SECOND
+                        ORDER BY claimed_at
+                        LIMIT %s
+                    """, (config['OUTBOX_MAX_ATTEMPTS'], token, config['OUTBOX_CLAIM_TIMEOUT'],
+                          config['OUTBOX_BATCH_SIZE'] - claimed))
+                    database.connection.commit()
+
+                cursor.execute("""
+                    SELECT * FROM notification_outbox
+                    WHERE claim_token = %s AND status = 'sending'
+                """, (token,))
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+
+        if rows:
+            list(self._get_executor().map(self._deliver, self._group_rows(rows)))
+        return len(rows)
+
+    def _group_rows(self, rows):
+        """
+        同一個 digest_group + 收件者的 LINE 通知合併成一組 (依字數切成數則訊息)
+        Returns: [[row, ...], ...] 每一組對應一次 API 呼叫
+        """
+        batches = []
+        digests = {}
+        for row in rows:
+            if row['digest_group'] and row['channel'] == CHANNEL_LINE:
+                digests.setdefault((row['digest_group'], row['recipient']), []).append(row)
+            else:
+                batches.append([row])
+
+        for group_rows in digests.values():
+            batch = []
+            for row in group_rows:
+                # 一次 push 最多 5 則訊息，超過就拆成下一組
+                if batch and len(_digest_messages(batch + [row])) > LINE_MESSAGES_PER_PUSH:
+                    batches.append(batch)
+                    batch = []
+                batch.append(row)
+            batches.append(batch)
+        return batches
+
+    def _deliver(self, batch):
+        from project.notifications import send_email, send_line_push_message
+
+        row = batch[0]
+        with self.app.app_context():
+            try:
+                if row['channel'] == CHANNEL_EMAIL:
+                    ok = send_email(row['recipient'], row['subject'],
+                                    row['body'], row['html'])
+                elif len(batch) == 1:
+                    ok = send_line_push_message(row['recipient'], row['body'])
+                else:
+                    ok = send_line_push_message(
+                        row['recipient'], _digest_messages(batch))
+                error = None if ok else 'send returned False'
+            except Exception as e:
+                ok, error = False, str(e)
+
+            self._mark_result(batch, ok, error)
+
+    def _mark_result(self, batch, ok, error):
+        config = self.app.config
+        cursor = database.connection.cursor()
+        try:
+            if ok:
+                cursor.executemany("""
+                    UPDATE notification_outbox
+                    SET status = 'sent', sent_at = NOW(), attempts = attempts + 1,
+                        last_error = NULL, claim_token = NULL
+                    WHERE id = %s
+                """, [(row['id'],) for row in batch])
+            else:
+                params = []
+                for row in batch:
+                    attempts = row['attempts'] + 1
+                    status = 'failed' if attempts >= config['OUTBOX_MAX_ATTEMPTS'] else 'pending'
+                    delay = min(config['OUTBOX_BACKOFF_BASE'] * (2 ** (attempts - 1)),
+                                config['OUTBOX_BACKOFF_MAX'])
+                    params.append(
+                        (status, attempts, (error or '')[:1000], delay, row['id']))
+                cursor.executemany("""
+                    UPDATE notification_outbox
+                    SET status = %s, attempts = %s, last_error = %s, claim_token = NULL,
+                        next_attempt_at = NOW() + INTERVAL %s SECOND
+                    WHERE id = %s
+                """, params)
+            database.connection.commit()
+        except Exception as e:
+            database.connection.rollback()
+            print(f"❌ Outbox result update failed (ids={[r['id'] for r in batch]}): {e}")
+        finally:
+            cursor.close()
+
+    # ---------- 保留期清理 ----------
+
+    def purge_expired(self):
+        """分批刪除超過保留天數的 sent / failed 通知 (走 idx_outbox_due)，回傳刪除筆數"""
+        days = self.app.config['OUTBOX_RETENTION_DAYS']
+        total = 0
+        with self.app.app_context():
+            cursor = database.connection.cursor()
+            try:
+                for status in ('sent', 'failed'):
+                    while True:
+                        cursor.execute("""
+                            DELETE FROM notification_outbox
+                            WHERE status = %s AND next_attempt_at < NOW() - INTERVAL %s DAY
+                            ORDER BY next_attempt_at
+                            LIMIT %s
+                        """, (status, days, PURGE_CHUNK_SIZE))
+                        deleted = cursor.rowcount
+                        database.connection.commit()
+                        total += deleted
+                        if deleted < PURGE_CHUNK_SIZE:
+                            break
+            finally:
+                cursor.close()
+        return total
+
+    def _purge_if_due(self):
+        now = time.monotonic()
+        if self._last_purge is not None and now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        try:
+            self.purge_expired()
+        except Exception as e:
+            print(f"❌ Outbox purge failed: {e}")
+
+    # ---------- 執行緒管理 ----------
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.app.config['OUTBOX_MAX_WORKERS'],
+                thread_name_prefix='outbox-send')
+        return self._executor
+
+    def _ensure_thread(self):
+        # gunicorn fork 之後執行緒不會被帶過來，依 pid 判斷是否需要重開
+        if self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._executor = None
+            self._thread = threading.Thread(
+                target=self.run_forever, name='outbox-worker', daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def run_forever(self):
+        while True:
+            self._purge_if_due()
+            try:
+                handled = self.process_batch()
+            except Exception as e:
+                print(f"❌ Outbox worker error: {e}")
+                handled = 0
+
+            # 整批滿載代表可能還有積壓，直接處理下一批
+            if handled < self.app.config['OUTBOX_BATCH_SIZE']:
+                self._wakeup.wait(self.app.config['OUTBOX_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+
+def _digest_messages(batch):
+    """把一組通知組成 LINE 訊息 (每則不超過 LINE_TEXT_LIMIT 字)"""
+    messages, text = [], ''
+    for row in batch:
+        if text and len(text) + len(DIGEST_SEPARATOR) + len(row['body']) > LINE_TEXT_LIMIT:
+            messages.append(text)
+            text = ''
+        text = f"{text}{DIGEST_SEPARATOR}{row['body']}" if text else row['body']
+    messages.append(text)
+
+    messages[0] = f"📬 彙整通知 ({len(batch)} 則)\n\n" + messages[0]
+    return messages
+
+
+outbox_worker = OutboxWorker()
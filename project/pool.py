@@ -0,0 +1,292 @@
+"""
+Pooled MySQL Connection Provider
+取代 flask_mysqldb.MySQL：連線在 request 結束時歸還連線池，而不是關閉
+
+用法與原本相同：
+    from project.extensions import database
+    cursor = database.connection.cursor()
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import MySQLdb
+import MySQLdb.cursors
+from flask import current_app, g
+
+
+class PoolTimeout(Exception):
+    """連線池已滿且等待逾時"""
+
+
+class ConnectionPool:
+    """
+    執行緒安全的 MySQLdb 連線池
+
+    - min_size: 第一次取用時預先建立的連線數
+    - max_size: 同時存在 (使用中 + 閒置) 的連線上限
+    - max_lifetime: 連線存活超過此秒數就汰換，避免被 MySQL wait_timeout 踢掉
+    - timeout: 池滿時最多等待幾秒，逾時丟出 PoolTimeout
+    - ping_interval: 閒置超過此秒數的連線，取出前先 ping 做健康檢查
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, max_lifetime=1800,
+                 timeout=10, ping_interval=10):
+        self._connect = connect
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size)
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+
+        self._idle = deque()  # (conn, last_used_at)
+        self._created_at = {}  # id(conn) -> created_at
+        self._size = 0
+        self._warmed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            'connects': 0,
+            'checkouts': 0,
+            'reused': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'ping_failures': 0,
+            'expired': 0,
+            'discarded': 0,
+        }
+
+    # ---------- 內部工具 ----------
+
+    def _open(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        now = time.monotonic()
+        with self._cond:
+            self._stats['connects'] += 1
+            self._created_at[id(conn)] = now
+        return conn
+
+    def _close(self, conn):
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_expired(self, conn, now):
+        created_at = self._created_at.get(id(conn), now)
+        return self.max_lifetime and now - created_at > self.max_lifetime
+
+    def _warm_up(self):
+        """第一次使用時預先開好 min_size - 1 條連線 (呼叫者自己那條另外算)"""
+        while True:
+            with self._cond:
+                if self._size + 1 >= self.min_size or self._size >= self.max_size:
+                    return
+                self._size += 1
+            conn = self._open()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+
+    # ---------- 公開介面 ----------
+
+    def checkout(self):
+        # 檢查並設定 _warmed 需在鎖內：同一 worker 同時進來的第一批 request 只有一個會預熱
+        with self._cond:
+            warm = not self._warmed
+            self._warmed = True
+        if warm:
+            self._warm_up()
+
+        with self._cond:
+            self._stats['checkouts'] += 1
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            last_used = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f"MySQL 連線池已滿 ({self.max_size})，等待 {self.timeout} 秒逾時")
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                return self._open()
+
+            now = time.monotonic()
+            if self._is_expired(conn, now):
+                with self._cond:
+                    self._stats['expired'] += 1
+                self._close(conn)
+                continue
+
+            if self.ping_interval is not None and now - last_used >= self.ping_interval:
+                try:
+                    conn.ping()
+                except Exception:
+                    with self._cond:
+                        self._stats['ping_failures'] += 1
+                    self._close(conn)
+                    continue
+
+            with self._cond:
+                self._stats['reused'] += 1
+            return conn
+
+    def checkin(self, conn, discard=False):
+        if not discard:
+            try:
+                # 結束未提交的交易 & 釋放 REPEATABLE READ 的讀取快照
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or self._is_expired(conn, time.monotonic()):
+            with self._cond:
+                self._stats['discarded'] += 1
+            self._close(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+        return data
+
+
+class PooledMySQL:
+    """
+    flask_mysqldb.MySQL 的替代品 (沿用相同的 MYSQL_* 設定)
+
+    每個 request / app context 第一次讀取 database.connection 時從池中取出，
+    teardown 時歸還。連線池在 fork 之後才會建立，gunicorn 各 worker 互不共用。
+    """
+
+    def __init__(self, app=None):
+        self._pools = {}
+        self._pool_pid = os.getpid()
+        self._lock = threading.Lock()
+        # 可選：包裝每個 request 拿到的連線 (例如 SQL instrumentation)
+        self.connection_wrapper = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MYSQL_HOST', 'localhost')
+        app.config.setdefault('MYSQL_USER', None)
+        app.config.setdefault('MYSQL_PASSWORD', None)
+        app.config.setdefault('MYSQL_DB', None)
+        app.config.setdefault('MYSQL_PORT', 3306)
+        app.config.setdefault('MYSQL_UNIX_SOCKET', None)
+        app.config.setdefault('MYSQL_CONNECT_TIMEOUT', 10)
+        app.config.setdefault('MYSQL_CHARSET', 'utf8')
+        app.config.setdefault('MYSQL_CURSORCLASS', None)
+        app.config.setdefault('MYSQL_AUTOCOMMIT', False)
+        app.config.setdefault('MYSQL_INIT_COMMAND', None)
+        app.config.setdefault('MYSQL_CUSTOM_OPTIONS', None)
+
+        app.config.setdefault('MYSQL_POOL_MIN_SIZE', 1)
+        app.config.setdefault('MYSQL_POOL_MAX_SIZE', 10)
+        app.config.setdefault('MYSQL_POOL_MAX_LIFETIME', 1800)
+        app.config.setdefault('MYSQL_POOL_TIMEOUT', 10)
+        app.config.setdefault('MYSQL_POOL_PING_INTERVAL', 10)
+
+        app.teardown_appcontext(self.teardown)
+
+    def _connect_kwargs(self, config):
+        kwargs = {
+            'host': config['MYSQL_HOST'],
+            'port': config['MYSQL_PORT'],
+            'connect_timeout': config['MYSQL_CONNECT_TIMEOUT'],
+            'charset': config['MYSQL_CHARSET'],
+            'autocommit': config['MYSQL_AUTOCOMMIT'],
+        }
+        if config['MYSQL_USER']:
+            kwargs['user'] = config['MYSQL_USER']
+        if config['MYSQL_PASSWORD']:
+            kwargs['passwd'] = config['MYSQL_PASSWORD']
+        if config['MYSQL_DB']:
+            kwargs['db'] = config['MYSQL_DB']
+        if config['MYSQL_UNIX_SOCKET']:
+            kwargs['unix_socket'] = config['MYSQL_UNIX_SOCKET']
+        if config['MYSQL_CURSORCLASS']:
+            kwargs['cursorclass'] = getattr(
+                MySQLdb.cursors, config['MYSQL_CURSORCLASS'])
+        # ⭐ init_command 只在建立連線時執行一次，之後重複使用不必再付 SET time_zone
+        if config['MYSQL_INIT_COMMAND']:
+            kwargs['init_command'] = config['MYSQL_INIT_COMMAND']
+        if config['MYSQL_CUSTOM_OPTIONS']:
+            kwargs.update(config['MYSQL_CUSTOM_OPTIONS'])
+        return kwargs
+
+    def get_pool(self, app=None):
+        app = app or current_app._get_current_object()
+        with self._lock:
+            if os.getpid() != self._pool_pid:
+                # fork 之後不可沿用父程序的 socket，直接丟棄 (不呼叫 close)
+                self._pools = {}
+                self._pool_pid = os.getpid()
+
+            pool = self._pools.get(id(app))
+            if pool is None:
+                config = app.config
+                kwargs = self._connect_kwargs(config)
+                pool = ConnectionPool(
+                    lambda: MySQLdb.connect(**kwargs),
+                    min_size=config['MYSQL_POOL_MIN_SIZE'],
+                    max_size=config['MYSQL_POOL_MAX_SIZE'],
+                    max_lifetime=config['MYSQL_POOL_MAX_LIFETIME'],
+                    timeout=config['MYSQL_POOL_TIMEOUT'],
+                    ping_interval=config['MYSQL_POOL_PING_INTERVAL'],
+                )
+                self._pools[id(app)] = pool
+            return pool
+
+    @property
+    def connection(self):
+        if '_mysql_conn' not in g:
+            conn = self.get_pool().checkout()
+            g._mysql_raw_conn = conn
+            if self.connection_wrapper is not None:
+                conn = self.connection_wrapper(conn)
+            g._mysql_conn = conn
+        return g._mysql_conn
+
+    def teardown(self, exception):
+        g.pop('_mysql_conn', None)
+        conn = g.pop('_mysql_raw_conn', None)
+        if conn is not None:
+            self.get_pool().checkin(conn)
+
+    def pool_stats(self):
+        return self.get_pool().stats()
@@ -0,0 +1,491 @@
+"""
+Streaming Report Exports
+進階報表匯出：以 server-side cursor (SSDictCursor) 逐批讀取，邊查邊送出
+
+- 每種報表由一或多個 section 組成 (例如訂單 + 訂單明細)，
+  每個 section = 標題 + 欄位定義 + 查詢；CSV / 其他格式共用同一組查詢
+- 欄位定義 (標題, 欄位名稱, 型別)，型別決定輸出格式：
+  text / int / money / percent / datetime / date
+- 每次 fetchmany(EXPORT_CHUNK_SIZE) 筆，記憶體用量與匯出筆數無關
+- XLSX：xlsxwriter constant_memory 模式逐列寫入暫存檔，每個 section 一個工作表，
+  數字 / 日期為實際型別、凍結標題列；檔案完成後 (zip 格式需要) 再分段送出
+- period=all 匯出全部歷史資料 (不加日期條件)
+- SSDictCursor 讀取期間同一條連線不能執行其他查詢，需要的彙總請寫進同一個 SQL
+"""
+
+import csv
+import tempfile
+from datetime import date, datetime
+from decimal import Decimal
+from io import StringIO
+
+import MySQLdb.cursors
+import xlsxwriter
+from flask import current_app
+
+from project.advanced_reports import timestamp_range
+from project.extensions import database
+
+UTF8_BOM = '\ufeff'
+
+# Excel 單一工作表上限 1,048,576 列 (含標題列)，超過時接續到下一個工作表
+XLSX_MAX_ROWS = 1048576
+XLSX_FILE_CHUNK = 64 * 1024
+
+# 欄位型別 -> (數字格式, 欄寬)
+XLSX_COLUMN_STYLES = {
+    'text': (None, 20),
+    'int': ('0', 10),
+    'money': ('#,##0.00', 14),
+    'percent': ('0.00%', 10),
+    'datetime': ('yyyy-mm-dd hh:mm:ss', 20),
+    'date': ('yyyy-mm-dd', 12),
+}
+
+
+def _range_clause(column, start_date, end_date):
+    """日期條件 (半開區間)；period=all (日期為 None) 時不限制"""
+    if start_date is None:
+        return '1 = 1', ()
+    return f'{column} >= %s AND {column} < %s', timestamp_range(start_date, end_date)
+
+
+# =====================================================
+# SECTION QUERIES
+# 每個函式回傳 (sql, params)；日期為 None 代表全部歷史資料
+# =====================================================
+
+PRODUCT_COLUMNS = [
+    ('產品名稱', 'name', 'text'),
+    ('分類', 'category_name', 'text'),
+    ('銷售數量', 'quantity', 'int'),
+    ('銷售金額', 'revenue', 'money'),
+    ('平均單價', 'avg_price', 'money'),
+    ('訂單數', 'orders', 'int'),
+    ('成本', 'cost', 'money'),
+    ('利潤', 'profit', 'money'),
+    ('利潤率%', 'margin', 'percent'),
+]
+
+
+def _products_query(start_date, end_date):
+    return """
+        SELECT
+            p.name,
+            pc.name as category_name,
+            SUM(d.quantity) as quantity,
+            SUM(d.revenue) as revenue,
+            SUM(d.unit_price_sum) / SUM(d.line_count) as avg_price,
+            SUM(d.order_count) as orders,
+            SUM(d.cost) as cost,
+            SUM(d.revenue) - SUM(d.cost) as profit,
+            CASE WHEN SUM(d.revenue) > 0
+                 THEN (SUM(d.revenue) - SUM(d.cost)) / SUM(d.revenue) * 100
+                 ELSE 0 END as margin
+        FROM daily_product_sales d
+        JOIN products p ON d.product_id = p.id
+        LEFT JOIN product_categories pc ON p.category_id = pc.id
+        WHERE d.sales_date BETWEEN %s AND %s
+        GROUP BY p.id, p.name, pc.name
+        ORDER BY SUM(d.revenue) DESC
+    """, (start_date, end_date)
+
+
+COURSE_COLUMNS = [
+    ('課程名稱', 'name', 'text'),
+    ('分類', 'category_name', 'text'),
+    ('預約堂數', 'sessions', 'int'),
+    ('銷售金額', 'revenue', 'money'),
+    ('預約數', 'bookings', 'int'),
+    ('客戶數', 'customers', 'int'),
+    ('成本', 'cost', 'money'),
+    ('利潤', 'profit', 'money'),
+    ('利潤率%', 'margin', 'percent'),
+]
+
+
+def _courses_query(start_date, end_date):
+    range_clause, range_params = _range_clause('created_at', start_date, end_date)
+    # 不重複客戶數不能由每日彙總相加，整段期間從 bookings 另外算 (同一個 SQL)
+    return f"""
+        SELECT
+            c.name,
+            cc.name as category_name,
+            SUM(d.sessions) as sessions,
+            SUM(d.revenue) as revenue,
+            SUM(d.booking_count) as bookings,
+            COALESCE(MAX(uc.customers), 0) as customers,
+            SUM(d.cost) as cost,
+            SUM(d.revenue) - SUM(d.cost) as profit,
+            CASE WHEN SUM(d.revenue) > 0
+                 THEN (SUM(d.revenue) - SUM(d.cost)) / SUM(d.revenue) * 100
+                 ELSE 0 END as margin
+        FROM daily_course_sales d
+        JOIN courses c ON d.course_id = c.id
+        LEFT JOIN course_categories cc ON c.category_id = cc.id
+        LEFT JOIN (
+            SELECT course_id, COUNT(DISTINCT customer_id) as customers
+            FROM bookings
+            WHERE {range_clause}
+            AND status != 'cancelled'
+            GROUP BY course_id
+        ) uc ON uc.course_id = c.id
+        WHERE d.sales_date BETWEEN %s AND %s
+        GROUP BY c.id, c.name, cc.name
+        ORDER BY SUM(d.revenue) DESC
+    """, (*range_params, start_date, end_date)
+
+
+ORDER_COLUMNS = [
+    ('訂單編號', 'id', 'int'),
+    ('建立時間', 'created_at', 'datetime'),
+    ('客戶', 'customer_name', 'text'),
+    ('Email', 'email', 'text'),
+    ('電話', 'phone', 'text'),
+    ('狀態', 'status', 'text'),
+    ('付款方式', 'payment_method', 'text'),
+    ('品項數', 'item_count', 'int'),
+    ('金額', 'total_amount', 'money'),
+    ('備註', 'notes', 'text'),
+]
+
+
+def _orders_query(start_date, end_date):
+    range_clause, params = _range_clause('o.created_at', start_date, end_date)
+    return f"""
+        SELECT
+            o.id, o.created_at,
+            CONCAT(u.firstname, ' ', u.surname) as customer_name,
+            u.email, u.phone,
+            o.status, o.payment_method,
+            (SELECT COALESCE(SUM(oi.quantity), 0) FROM order_items oi
+             WHERE oi.order_id = o.id) as item_count,
+            o.total_amount, o.notes
+        FROM orders o
+        JOIN users u ON o.customer_id = u.id
+        WHERE {range_clause}
+        ORDER BY o.created_at, o.id
+    """, params
+
+
+ORDER_ITEM_COLUMNS = [
+    ('訂單編號', 'order_id', 'int'),
+    ('建立時間', 'created_at', 'datetime'),
+    ('訂單狀態', 'status', 'text'),
+    ('產品名稱', 'product_name', 'text'),
+    ('數量', 'quantity', 'int'),
+    ('單價', 'unit_price', 'money'),
+    ('小計', 'subtotal', 'money'),
+]
+
+
+def _order_items_query(start_date, end_date):
+    range_clause, params = _range_clause('o.created_at', start_date, end_date)
+    return f"""
+        SELECT
+            oi.order_id, o.created_at, o.status,
+            p.name as product_name,
+            oi.quantity, oi.unit_price, oi.subtotal
+        FROM order_items oi
+        JOIN orders o ON oi.order_id = o.id
+        JOIN products p ON oi.product_id = p.id
+        WHERE {range_clause}
+        ORDER BY o.created_at, oi.order_id, oi.id
+    """, params
+
+
+BOOKING_COLUMNS = [
+    ('預約編號', 'id', 'int'),
+    ('建立時間', 'created_at', 'datetime'),
+    ('客戶', 'customer_name', 'text'),
+    ('Email', 'email', 'text'),
+    ('電話', 'phone', 'text'),
+    ('課程', 'course_name', 'text'),
+    ('預約時間', 'booking_date', 'datetime'),
+    ('購買堂數', 'sessions_purchased', 'int'),
+    ('剩餘堂數', 'sessions_remaining', 'int'),
+    ('金額', 'total_amount', 'money'),
+    ('狀態', 'status', 'text'),
+    ('首次體驗', 'is_first_time', 'int'),
+    ('備註', 'notes', 'text'),
+]
+
+
+def _bookings_query(start_date, end_date):
+    range_clause, params = _range_clause('b.created_at', start_date, end_date)
+    return f"""
+        SELECT
+            b.id, b.created_at,
+            CONCAT(u.firstname, ' ', u.surname) as customer_name,
+            u.email, u.phone,
+            c.name as course_name,
+            b.booking_date, b.sessions_purchased, b.sessions_remaining,
+            b.total_amount, b.status, b.is_first_time, b.notes
+        FROM bookings b
+        JOIN users u ON b.customer_id = u.id
+        JOIN courses c ON b.course_id = c.id
+        WHERE {range_clause}
+        ORDER BY b.created_at, b.id
+    """, params
+
+
+CUSTOMER_COLUMNS = [
+    ('客戶編號', 'id', 'int'),
+    ('註冊時間', 'created_at', 'datetime'),
+    ('姓名', 'name', 'text'),
+    ('帳號', 'username', 'text'),
+    ('Email', 'email', 'text'),
+    ('電話', 'phone', 'text'),
+    ('來源', 'source_name', 'text'),
+    ('訂單數', 'order_count', 'int'),
+    ('預約數', 'booking_count', 'int'),
+    ('訂單消費', 'order_spent', 'money'),
+    ('預約消費', 'booking_spent', 'money'),
+    ('累計消費', 'total_spent', 'money'),
+    ('最後消費', 'last_activity_at', 'datetime'),
+]
+
+
+def _customers_query(start_date, end_date):
+    # 期間 = 註冊時間；消費統計為累計值 (customer_stats)
+    range_clause, params = _range_clause('u.created_at', start_date, end_date)
+    return f"""
+        SELECT
+            u.id, u.created_at,
+            CONCAT(u.firstname, ' ', u.surname) as name,
+            u.username, u.email, u.phone,
+            cs.name as source_name,
+            COALESCE(st.order_count, 0) as order_count,
+            COALESCE(st.booking_count, 0) as booking_count,
+            COALESCE(st.order_spent, 0) as order_spent,
+            COALESCE(st.booking_spent, 0) as booking_spent,
+            COALESCE(st.order_spent, 0) + COALESCE(st.booking_spent, 0) as total_spent,
+            st.last_activity_at
+        FROM users u
+        LEFT JOIN customer_stats st ON st.customer_id = u.id
+        LEFT JOIN customer_sources cs ON u.source_id = cs.id
+        WHERE u.role = 'customer' AND {range_clause}
+        ORDER BY u.created_at, u.id
+    """, params
+
+
+INVENTORY_LOG_COLUMNS = [
+    ('編號', 'id', 'int'),
+    ('時間', 'created_at', 'datetime'),
+    ('產品名稱', 'product_name', 'text'),
+    ('類型', 'change_type', 'text'),
+    ('數量變動', 'change_amount', 'int'),
+    ('參考編號', 'reference_id', 'int'),
+    ('備註', 'notes', 'text'),
+    ('操作人員', 'operator_name', 'text'),
+]
+
+
+def _inventory_logs_query(start_date, end_date):
+    range_clause, params = _range_clause('l.created_at', start_date, end_date)
+    return f"""
+        SELECT
+            l.id, l.created_at,
+            p.name as product_name,
+            l.change_type, l.change_amount, l.reference_id, l.notes,
+            CONCAT(u.firstname, ' ', u.surname) as operator_name
+        FROM inventory_logs l
+        JOIN products p ON l.product_id = p.id
+        LEFT JOIN users u ON l.created_by = u.id
+        WHERE {range_clause}
+        ORDER BY l.created_at, l.id
+    """, params
+
+
+AUDIT_LOG_COLUMNS = [
+    ('編號', 'id', 'int'),
+    ('時間', 'created_at', 'datetime'),
+    ('操作人員', 'operator_name', 'text'),
+    ('帳號', 'username', 'text'),
+    ('動作', 'action', 'text'),
+    ('對象類型', 'target_type', 'text'),
+    ('對象編號', 'target_id', 'int'),
+    ('內容', 'details', 'text'),
+    ('IP', 'ip_address', 'text'),
+]
+
+
+def _audit_logs_query(start_date, end_date):
+    range_clause, params = _range_clause('a.created_at', start_date, end_date)
+    return f"""
+        SELECT
+            a.id, a.created_at,
+            CONCAT(u.firstname, ' ', u.surname) as operator_name,
+            u.username,
+            a.action, a.target_type, a.target_id, a.details, a.ip_address
+        FROM audit_logs a
+        LEFT JOIN users u ON a.user_id = u.id
+        WHERE {range_clause}
+        ORDER BY a.created_at, a.id
+    """, params
+
+
+# report_type -> 設定
+#   rollups：需要先確保每日彙總是最新的 (ensure_rollups)
+#   sections：[(section 標題, 欄位定義, 查詢函式), ...]
+EXPORT_REPORTS = {
+    'products': {
+        'rollups': True,
+        'sections': [('產品銷售', PRODUCT_COLUMNS, _products_query)],
+    },
+    'courses': {
+        'rollups': True,
+        'sections': [('課程銷售', COURSE_COLUMNS, _courses_query)],
+    },
+    'orders': {
+        'rollups': False,
+        'sections': [('訂單', ORDER_COLUMNS, _orders_query),
+                     ('訂單明細', ORDER_ITEM_COLUMNS, _order_items_query)],
+    },
+    'bookings': {
+        'rollups': False,
+        'sections': [('預約', BOOKING_COLUMNS, _bookings_query)],
+    },
+    'customers': {
+        'rollups': False,
+        'sections': [('客戶', CUSTOMER_COLUMNS, _customers_query)],
+    },
+    'inventory_logs': {
+        'rollups': False,
+        'sections': [('庫存異動', INVENTORY_LOG_COLUMNS, _inventory_logs_query)],
+    },
+    'audit_logs': {
+        'rollups': False,
+        'sections': [('操作紀錄', AUDIT_LOG_COLUMNS, _audit_logs_query)],
+    },
+}
+
+
+# =====================================================
+# STREAMING PIPELINE
+# =====================================================
+
+
+def iter_section_chunks(query, start_date, end_date):
+    """以 SSDictCursor 執行 section 查詢，每次產出 EXPORT_CHUNK_SIZE 筆 (list of dict)"""
+    chunk_size = current_app.config.get('EXPORT_CHUNK_SIZE', 1000)
+    sql, params = query(start_date, end_date)
+
+    cursor = database.connection.cursor(MySQLdb.cursors.SSDictCursor)
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        # 中途中斷 (例如使用者取消下載) 時 close 會讀掉剩餘結果，連線才能歸還連線池
+        cursor.close()
+
+
+# 以這些字元開頭的儲存格 Excel 會當成公式執行 (CSV injection)
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _csv_value(value, kind):
+    if value is None:
+        return ''
+    if kind in ('money', 'percent'):
+        return f"{float(value):.2f}"
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    # ⭐ 客戶可輸入的文字 (姓名、備註…) 前面加 ' 讓 Excel 當成純文字
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def generate_csv(report_type, start_date, end_date):
+    """CSV 串流：UTF-8 BOM (Excel 才會以 UTF-8 開啟) + 每批資料一個 chunk"""
+    sections = EXPORT_REPORTS[report_type]['sections']
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    yield UTF8_BOM
+    for index, (title, columns, query) in enumerate(sections):
+        # 多個 section 時以空白列 + 標題列分隔
+        if len(sections) > 1:
+            if index > 0:
+                writer.writerow([])
+            writer.writerow([f'【{title}】'])
+        writer.writerow([header for header, _, _ in columns])
+
+        for rows in iter_section_chunks(query, start_date, end_date):
+            for row in rows:
+                writer.writerow([_csv_value(row[key], kind) for _, key, kind in columns])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    yield buffer.getvalue()
+
+
+def _xlsx_add_sheet(workbook, name, columns, formats, header_format):
+    worksheet = workbook.add_worksheet(name[:31])
+    # constant_memory 模式只能依序寫入，欄寬 / 凍結需在寫資料前設定
+    for col, (_, _, kind) in enumerate(columns):
+        worksheet.set_column(col, col, XLSX_COLUMN_STYLES[kind][1], formats[kind])
+    worksheet.freeze_panes(1, 0)
+    for col, (header, _, _) in enumerate(columns):
+        worksheet.write_string(0, col, header, header_format)
+    return worksheet
+
+
+def _xlsx_write_cell(worksheet, row_index, col, value, kind, cell_format):
+    if value is None:
+        return
+    if kind in ('int', 'money'):
+        worksheet.write_number(row_index, col, float(value), cell_format)
+    elif kind == 'percent':
+        worksheet.write_number(row_index, col, float(value) / 100, cell_format)
+    elif kind in ('datetime', 'date') and isinstance(value, (datetime, date)):
+        worksheet.write_datetime(row_index, col, value, cell_format)
+    else:
+        # 一律當字串寫入，避免 "=..." 之類的內容被當成公式
+        worksheet.write_string(row_index, col, str(value))
+
+
+def generate_xlsx(report_type, start_date, end_date):
+    """XLSX：與 CSV 共用 section 查詢，每個 section 一個工作表"""
+    sections = EXPORT_REPORTS[report_type]['sections']
+
+    with tempfile.TemporaryFile() as output:
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        header_format = workbook.add_format({'bold': True, 'bg_color': '#E9ECEF'})
+        formats = {
+            kind: workbook.add_format({'num_format': num_format}) if num_format else None
+            for kind, (num_format, _) in XLSX_COLUMN_STYLES.items()
+        }
+
+        for title, columns, query in sections:
+            sheet_count = 1
+            worksheet = _xlsx_add_sheet(workbook, title, columns, formats, header_format)
+            row_index = 1
+            for rows in iter_section_chunks(query, start_date, end_date):
+                for row in rows:
+                    if row_index >= XLSX_MAX_ROWS:
+                        sheet_count += 1
+                        worksheet = _xlsx_add_sheet(
+                            workbook, f'{title} ({sheet_count})', columns, formats, header_format)
+                        row_index = 1
+                    for col, (_, key, kind) in enumerate(columns):
+                        _xlsx_write_cell(worksheet, row_index, col, row[key], kind, formats[kind])
+                    row_index += 1
+
+        workbook.close()
+        output.seek(0)
+        while True:
+            data = output.read(XLSX_FILE_CHUNK)
+            if not data:
+                break
+            yield data
@@ -0,0 +1,265 @@
+"""
+Daily Sales Rollups
+進階報表改讀每日彙總表，不再每次從 orders / order_items / bookings 重新加總
+
+- daily_sales_summary：每天一列 (訂單 / 預約的筆數、營收、成本)
+- daily_product_sales：每天 × 產品 (數量、營收、成本、訂單數、客戶數)
+- daily_course_sales：每天 × 課程 (堂數、營收、成本、預約數、客戶數)
+- report_rollup_days：每天的狀態；過去的日期彙總後標記 sealed，之後直接讀取
+- 今天的資料在 REPORT_ROLLUP_TODAY_TTL 秒後重新彙總
+- 訂單 / 預約在建立、取消、恢復時 (apply_order_kpis / apply_booking_kpis)
+  會把所屬日期標回未封存，下次查詢時只重算那一天
+- 成本讀取下單 / 預約當下記錄的 order_items.unit_cost / bookings.total_cost
+- 「今天」與 TTL 一律以 MySQL 的 CURDATE() / NOW() 判斷 (連線時區 +08:00，與 created_at 一致)，
+  不使用 Python 端的 date.today() / datetime.now() (伺服器為 UTC)
+"""
+
+from datetime import datetime, timedelta
+
+import MySQLdb.cursors
+from flask import current_app
+
+from project.extensions import database
+
+
+def mark_rollup_stale(cursor, created_at):
+    """訂單 / 預約異動後，讓該日期的彙總重算 (需由呼叫端 commit)"""
+    if created_at is None:
+        return
+    day = created_at.date() if isinstance(created_at, datetime) else created_at
+    cursor.execute(
+        "UPDATE report_rollup_days SET sealed = FALSE WHERE sales_date = %s", (day,))
+
+
+def db_today(cursor=None):
+    """資料庫時區 (+08:00) 的今天"""
+    own_cursor = cursor is None
+    if own_cursor:
+        cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute("SELECT CURDATE() as today")
+        return cursor.fetchone()['today']
+    finally:
+        if own_cursor:
+            cursor.close()
+
+
+def first_sales_date():
+    """最早一筆訂單 / 預約的日期 (都沒有則為今天)"""
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute("""
+            SELECT
+                (SELECT MIN(created_at) FROM orders) as first_order,
+                (SELECT MIN(created_at) FROM bookings) as first_booking,
+                CURDATE() as today
+        """)
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+
+    firsts = [value.date() for value in (row['first_order'], row['first_booking']) if value]
+    return min(firsts) if firsts else row['today']
+
+
+def _is_stale(row, is_today):
+    """row = report_rollup_days 的狀態 (含 expired)；None 代表從未彙總"""
+    if row is None:
+        return True
+    return bool(row['expired']) if is_today else not row['sealed']
+
+
+def ensure_rollups(start_date, end_date):
+    """
+    確保 [start_date, end_date] 每一天的彙總都是最新的
+    - 已封存的日期不動
+    - 過去未封存 (或從未彙總) 的日期重算後封存
+    - 今天超過 TTL 才重算，不封存
+    需要重算的日期一次批次處理 (refresh_days)，查詢次數與天數無關
+    """
+    ttl = current_app.config.get('REPORT_ROLLUP_TODAY_TTL', 60)
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        today = db_today(cursor)
+        end_date = min(end_date, today)
+        if start_date > end_date:
+            return 0
+
+        # TTL 在 SQL 中比較：refreshed_at 由 NOW() 寫入，與 Python 端時鐘的時區不同
+        cursor.execute("""
+            SELECT sales_date, sealed,
+                   (refreshed_at IS NULL
+                    OR refreshed_at < NOW() - INTERVAL %s SECOND) as expired
+            FROM report_rollup_days
+            WHERE sales_date BETWEEN %s AND %s
+        """, (ttl, start_date, end_date))
+        status = {row['sales_date']: row for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+    stale = []
+    day = start_date
+    while day <= end_date:
+        if _is_stale(status.get(day), day == today):
+            stale.append(day)
+        day += timedelta(days=1)
+
+    if not stale:
+        return 0
+    return refresh_days(stale)
+
+
+def refresh_days(days):
+    """
+    重新彙總多個日期 (一個 transaction，固定次數的 GROUP BY 查詢)
+    過去的日期標記為已封存；今天只更新 refreshed_at
+    Returns: 實際重算的天數
+    """
+    ttl = current_app.config.get('REPORT_ROLLUP_TODAY_TTL', 60)
+
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        today = db_today(cursor)
+
+        # 先鎖住這些日期的狀態列：同時有兩個 request 要重算同一天時，第二個等第一個完成
+        cursor.executemany("""
+            INSERT IGNORE INTO report_rollup_days (sales_date, sealed) VALUES (%s, FALSE)
+        """, [(day,) for day in days])
+        placeholders = ', '.join(['%s'] * len(days))
+        cursor.execute(f"""
+            SELECT sales_date, sealed,
+                   (refreshed_at IS NULL
+                    OR refreshed_at < NOW() - INTERVAL %s SECOND) as expired
+            FROM report_rollup_days
+            WHERE sales_date IN ({placeholders})
+            FOR UPDATE
+        """, (ttl, *days))
+        # 等鎖期間可能已被其他 request 重算完成，重新判斷
+        days = sorted(row['sales_date'] for row in cursor.fetchall()
+                      if _is_stale(row, row['sales_date'] == today))
+        if not days:
+            database.connection.commit()
+            return 0
+
+        placeholders = ', '.join(['%s'] * len(days))
+        # created_at 先以範圍走索引，再以 DATE() 篩出要重算的日期
+        range_start = datetime.combine(days[0], datetime.min.time())
+        range_end = datetime.combine(days[-1] + timedelta(days=1), datetime.min.time())
+        in_range = (range_start, range_end, *days)
+
+        for table in ('daily_product_sales', 'daily_course_sales', 'daily_sales_summary'):
+            cursor.execute(
+                f"DELETE FROM {table} WHERE sales_date IN ({placeholders})", tuple(days))
+
+        cursor.execute(f"""
+            INSERT INTO daily_product_sales
+                (sales_date, product_id, quantity, revenue, cost,
+                 order_count, customer_count, line_count, unit_price_sum)
+            SELECT DATE(o.created_at), oi.product_id,
+                   SUM(oi.quantity), SUM(oi.subtotal),
+                   COALESCE(SUM(oi.quantity * oi.unit_cost), 0),
+                   COUNT(DISTINCT o.id), COUNT(DISTINCT o.customer_id),
+                   COUNT(*), SUM(oi.unit_price)
+            FROM order_items oi
+            JOIN orders o ON oi.order_id = o.id
+            WHERE o.created_at >= %s AND o.created_at < %s
+            AND DATE(o.created_at) IN ({placeholders})
+            AND o.status != 'cancelled'
+            GROUP BY DATE(o.created_at), oi.product_id
+        """, in_range)
+
+        cursor.execute(f"""
+            INSERT INTO daily_course_sales
+                (sales_date, course_id, sessions, revenue, cost,
+                 booking_count, customer_count, price_per_session_sum)
+            SELECT DATE(b.created_at), b.course_id,
+                   SUM(b.sessions_purchased), SUM(b.total_amount),
+                   COALESCE(SUM(b.total_cost), 0),
+                   COUNT(*), COUNT(DISTINCT b.customer_id),
+                   COALESCE(SUM(b.total_amount / b.sessions_purchased), 0)
+            FROM bookings b
+            WHERE b.created_at >= %s AND b.created_at < %s
+            AND DATE(b.created_at) IN ({placeholders})
+            AND b.status != 'cancelled'
+            GROUP BY DATE(b.created_at), b.course_id
+        """, in_range)
+
+        # 整體金額：訂單 / 預約本身的總額 (不受明細 JOIN 影響)，成本取自上面的明細彙總
+        cursor.executemany("""
+            INSERT INTO daily_sales_summary (sales_date) VALUES (%s)
+        """, [(day,) for day in days])
+
+        cursor.execute(f"""
+            UPDATE daily_sales_summary s
+            JOIN (
+                SELECT DATE(created_at) as sales_date,
+                       COUNT(*) as order_count, SUM(total_amount) as order_revenue
+                FROM orders
+                WHERE created_at >= %s AND created_at < %s
+                AND DATE(created_at) IN ({placeholders})
+                AND status != 'cancelled'
+                GROUP BY DATE(created_at)
+            ) o ON o.sales_date = s.sales_date
+            SET s.order_count = o.order_count, s.order_revenue = o.order_revenue
+        """, in_range)
+
+        cursor.execute(f"""
+            UPDATE daily_sales_summary s
+            JOIN (
+                SELECT DATE(created_at) as sales_date,
+                       COUNT(*) as booking_count, SUM(total_amount) as booking_revenue
+                FROM bookings
+                WHERE created_at >= %s AND created_at < %s
+                AND DATE(created_at) IN ({placeholders})
+                AND status != 'cancelled'
+                GROUP BY DATE(created_at)
+            ) b ON b.sales_date = s.sales_date
+            SET s.booking_count = b.booking_count, s.booking_revenue = b.booking_revenue
+        """, in_range)
+
+        cursor.execute(f"""
+            UPDATE daily_sales_summary s
+            LEFT JOIN (
+                SELECT sales_date, SUM(cost) as cost FROM daily_product_sales
+                WHERE sales_date IN ({placeholders}) GROUP BY sales_date
+            ) p ON p.sales_date = s.sales_date
+            LEFT JOIN (
+                SELECT sales_date, SUM(cost) as cost FROM daily_course_sales
+                WHERE sales_date IN ({placeholders}) GROUP BY sales_date
+            ) c ON c.sales_date = s.sales_date
+            SET s.order_cost = COALESCE(p.cost, 0), s.course_cost = COALESCE(c.cost, 0)
+            WHERE s.sales_date IN ({placeholders})
+        """, (*days, *days, *days))
+
+        cursor.execute(f"""
+            UPDATE report_rollup_days
+            SET sealed = (sales_date < %s), refreshed_at = NOW()
+            WHERE sales_date IN ({placeholders})
+        """, (today, *days))
+        database.connection.commit()
+        return len(days)
+    except Exception:
+        database.connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def refresh_rollups(start_date, end_date, force=False):
+    """
+    重算一段期間 (給 `flask refresh-rollups` 回填 / 校正用)
+    force=False 只處理未封存的日期；force=True 連已封存的也重算
+    """
+    if force:
+        # 強制重算：先解除封存並清掉 refreshed_at (今天也會重算)
+        cursor = database.connection.cursor()
+        try:
+            cursor.execute("""
+                UPDATE report_rollup_days SET sealed = FALSE, refreshed_at = NULL
+                WHERE sales_date BETWEEN %s AND %s
+            """, (start_date, end_date))
+            database.connection.commit()
+        finally:
+            cursor.close()
+
+    return ensure_rollups(start_date, end_date)
@@ -0,0 +1,29 @@
+"""
+Product Search
+使用 MySQL FULLTEXT (ngram parser) 索引 ft_products_search (name, description)
+
+- ngram_token_size 預設 2：中文以「雙字詞」切詞，英文同樣以 2 字元切分
+- 索引由 InnoDB 在 INSERT / UPDATE 時自動維護，後台新增或修改產品不需額外重建
+- 少於 2 個字的關鍵字無法被 ngram 索引命中，退回 LIKE 比對
+"""
+
+# 對應 MySQL 的 ngram_token_size
+NGRAM_TOKEN_SIZE = 2
+
+MATCH_SQL = "MATCH(p.name, p.description) AGAINST (%s IN NATURAL LANGUAGE MODE)"
+
+
+def product_search_clause(query):
+    """
+    Returns: (where_sql, where_params, score_sql, score_params)
+    score_sql 可放進 SELECT 作為 relevance 欄位排序用
+    """
+    query = query.strip()
+
+    if len(query) < NGRAM_TOKEN_SIZE:
+        like = f'%{query}%'
+        return "(p.name LIKE %s OR p.description LIKE %s)", [like, like], "0", []
+
+    # 名稱命中的產品加權，排在只有描述命中的前面
+    score_sql = f"({MATCH_SQL} + (p.name LIKE %s) * 10)"
+    return MATCH_SQL, [query], score_sql, [query, f'%{query}%']
@@ -1,5 +1,12 @@
+import random
+import time
+
+import MySQLdb
 import MySQLdb.cursors
+from flask import current_app
+from project.cache import popular_cache
 from project.extensions import database
+from project.rollups import mark_rollup_stale
 
 # =====================================================
 # ADMIN ORDER STATUS UPDATE WITH INVENTORY SYNC
@@ -45,12 +52,19 @@ def admin_update_order_with_inventory(order_id, new_status, admin_id):
                     VALUES (%s, %s, 'return', %s, 'Order cancelled by admin', %s)
                 """, (item['product_id'], item['quantity'], order_id, admin_id))
 
+            record_product_sales(cursor, items, sign=-1)
+
         # 3. 更新訂單狀態
         cursor.execute(
             "UPDATE orders SET status = %s WHERE id = %s", (new_status, order_id))
+        kpi_sign = status_kpi_sign(old_status, new_status)
+        if kpi_sign:
+            apply_order_kpis(cursor, order_id, sign=kpi_sign)
 
         database.connection.commit()
         cursor.close()
+        if kpi_sign:
+            popular_cache.invalidate()
         return True
 
     except Exception as e:
@@ -59,3 +73,469 @@ def admin_update_order_with_inventory(order_id, new_status, admin_id):
         print(f"Error updating order status: {e}")
         # 如果是開發環境，可以考慮 raise e 來看清楚錯誤，但在這裡我們先回傳 False
         return False
+
+
+# =====================================================
+# BATCHED STOCK DECREMENT (結帳扣庫存)
+# =====================================================
+
+
+class StockShortage(Exception):
+    """扣庫存時有產品數量不足，整筆訂單需 rollback"""
+
+
+def decrement_stock(cursor, items):
+    """
+    一條 UPDATE 同時扣除多個產品的庫存 (條件式：stock_quantity >= 購買數量)
+    items: [{'product_id': ..., 'quantity': ...}, ...]
+
+    只要有任何一個產品被條件擋下 (影響筆數不足)，就丟出 StockShortage，
+    由呼叫端 rollback；不需要先逐筆 SELECT ... FOR UPDATE 檢查。
+    """
+    totals = {}
+    for item in items:
+        pid = int(item['product_id'])
+        totals[pid] = totals.get(pid, 0) + int(item['quantity'])
+
+    if not totals:
+        return
+
+    derived = ' UNION ALL '.join(
+        ['SELECT %s AS product_id, %s AS qty'] * len(totals))
+    params = [v for pid, qty in totals.items() for v in (pid, qty)]
+
+    cursor.execute(f"""
+        UPDATE products p
+        JOIN ({derived}) d ON p.id = d.product_id
+        SET p.stock_quantity = p.stock_quantity - d.qty
+        WHERE p.stock_quantity >= d.qty
+    """, params)
+
+    if cursor.rowcount != len(totals):
+        # 失敗路徑才多查一次，找出是哪些產品不足 (用於錯誤訊息)
+        in_sql = ', '.join(['%s'] * len(totals))
+        cursor.execute(
+            f"SELECT id, name, stock_quantity FROM products WHERE id IN ({in_sql})",
+            list(totals))
+        names = [
+            row['name'] for row in cursor.fetchall()
+            if row['stock_quantity'] < totals[row['id']]
+        ]
+        raise StockShortage(
+            f"「{'、'.join(names)}」庫存不足" if names else '庫存不足')
+
+
+# =====================================================
+# SLOT RESERVATION (預約時段名額)
+# =====================================================
+
+# 1213 = Deadlock found, 1205 = Lock wait timeout
+RETRYABLE_LOCK_ERRORS = (1213, 1205)
+
+
+class SlotUnavailable(Exception):
+    """時段不存在、已關閉或已額滿"""
+
+
+def reserve_slot(cursor, schedule_id):
+    """
+    原子性佔用一個名額：一條條件式 UPDATE 完成「檢查 + 加一」
+    不需要 SELECT ... FOR UPDATE；搶不到 (影響 0 筆) 就丟出 SlotUnavailable
+    列鎖只持有到呼叫端 commit，請盡量放在 transaction 的最後階段
+    """
+    cursor.execute("""
+        UPDATE shop_schedules
+        SET current_bookings = current_bookings + 1
+        WHERE id = %s AND is_active = TRUE
+          AND current_bookings < max_capacity
+    """, (schedule_id,))
+
+    if cursor.rowcount != 1:
+        raise SlotUnavailable("抱歉，該時段剛剛已額滿，請選擇其他時間")
+
+
+def run_with_lock_retry(work, attempts=3, base_delay=0.05):
+    """
+    執行 work() (內含完整 transaction 與 commit)，遇到 deadlock / lock wait timeout
+    時 rollback 並以指數退避 + 隨機抖動重試，最多 attempts 次
+    """
+    for attempt in range(attempts):
+        try:
+            return work()
+        except MySQLdb.OperationalError as e:
+            if e.args[0] not in RETRYABLE_LOCK_ERRORS or attempt == attempts - 1:
+                raise
+            database.connection.rollback()
+            print(f"⚠️ Lock conflict ({e.args[0]}), retry {attempt + 1}")
+            time.sleep(base_delay * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+# =====================================================
+# PRODUCT SALES STATS (熱門產品排行)
+# =====================================================
+# product_sales_stats 保存每個產品「未取消訂單」的累計銷量，
+# 在結帳 / 取消 / 恢復訂單的同一個 transaction 內增減，
+# 讀取熱門產品時只需依 total_sold 索引取前幾筆，不必掃描整個 order_items。
+
+
+def record_product_sales(cursor, items, sign=1):
+    """
+    累加 (sign=1) 或扣回 (sign=-1) 產品銷量 (不會低於 0)
+    items: [{'product_id': ..., 'quantity': ...}, ...]
+    需由呼叫端 commit (與訂單異動同一個 transaction)，commit 後再 popular_cache.invalidate()
+    (commit 前清除的話，其他 request 可能把尚未 commit 的舊排行重新載入快取)
+    """
+    totals = {}
+    for item in items:
+        pid = int(item['product_id'])
+        totals[pid] = totals.get(pid, 0) + int(item['quantity']) * sign
+
+    if not totals:
+        return
+
+    # 新增的資料列直接夾在 0 以上；既有的資料列以原始增減量累加後再夾
+    cursor.executemany("""
+        INSERT INTO product_sales_stats (product_id, total_sold)
+        VALUES (%s, GREATEST(%s, 0))
+        ON DUPLICATE KEY UPDATE
+            total_sold = GREATEST(total_sold + %s, 0)
+    """, [(pid, qty, qty) for pid, qty in totals.items()])
+
+
+def rebuild_product_sales_stats():
+    """從 order_items 全量重算 (初次上線或資料校正用)，回傳產品數"""
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute("DELETE FROM product_sales_stats")
+        cursor.execute("""
+            INSERT INTO product_sales_stats (product_id, total_sold)
+            SELECT oi.product_id, SUM(oi.quantity)
+            FROM order_items oi
+            JOIN orders o ON oi.order_id = o.id
+            WHERE o.status != 'cancelled'
+            GROUP BY oi.product_id
+        """)
+        count = cursor.rowcount
+        database.connection.commit()
+    except Exception:
+        database.connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    popular_cache.invalidate()
+    return count
+
+
+def get_popular_products(limit=3):
+    """熱門產品 (依累計銷量)；沒有銷售紀錄時回傳最新上架的產品"""
+
+    def load():
+        cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+        try:
+            cursor.execute("""
+                SELECT p.*, c.name as category_name, s.total_sold
+                FROM product_sales_stats s
+                JOIN products p ON s.product_id = p.id
+                LEFT JOIN product_categories c ON p.category_id = c.id
+                WHERE s.total_sold > 0 AND p.is_active = 1
+                ORDER BY s.total_sold DESC
+                LIMIT %s
+            """, (limit,))
+            products = cursor.fetchall()
+
+            # 備案：如果沒有銷售紀錄，抓最新的產品
+            if not products:
+                cursor.execute("""
+                    SELECT p.*, c.name as category_name
+                    FROM products p
+                    LEFT JOIN product_categories c ON p.category_id = c.id
+                    WHERE p.is_active = 1
+                    ORDER BY p.id DESC
+                    LIMIT %s
+                """, (limit,))
+                products = cursor.fetchall()
+            return products
+        finally:
+            cursor.close()
+
+    return popular_cache.get_or_load(
+        ('products', limit), load,
+        ttl=current_app.config.get('POPULAR_CACHE_TTL'))
+
+
+# =====================================================
+# KPI SUMMARY (後台總覽統計)
+# =====================================================
+# kpi_summary 保存後台總覽需要的計數與金額，讀取時把所有列加總：
+# - id = 1 (KPI_ROW_ID)：產品 / 課程 / 文章 / 客戶數，後台異動時重新計數
+#   (資料量小，且避免上下架切換算錯)；註冊新客戶時 +1
+# - id = 2 ~ KPI_SHARDS + 1：訂單 / 預約的數量、營收、成本，
+#   在建立、取消、恢復的同一個 transaction 內隨機挑一列增減
+#   ⭐ 結帳 / 預約不再全部搶同一列的列鎖，同時下單的交易不會互相排隊
+# 成本讀取下單 / 預約當下記錄的 order_items.unit_cost / bookings.total_cost，
+# 計入與移出使用同一個金額，之後修改產品成本或課程費用不會讓統計偏移。
+
+KPI_ROW_ID = 1
+KPI_SHARDS = 16
+
+KPI_CATALOG_COLUMNS = ('products', 'courses', 'customers', 'posts')
+
+KPI_COLUMNS = (
+    'products', 'courses', 'orders', 'bookings', 'customers', 'posts',
+    'order_revenue', 'booking_revenue', 'order_cost', 'course_cost',
+)
+
+KPI_FULL_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM products WHERE is_active = TRUE) as products,
+        (SELECT COUNT(*) FROM courses WHERE is_active = TRUE) as courses,
+        (SELECT COUNT(*) FROM orders WHERE status != 'cancelled') as orders,
+        (SELECT COUNT(*) FROM bookings WHERE status != 'cancelled') as bookings,
+        (SELECT COUNT(*) FROM users WHERE role = 'customer') as customers,
+        (SELECT COUNT(*) FROM blog_posts WHERE status = 'published') as posts,
+        (SELECT COALESCE(SUM(total_amount), 0) FROM orders
+         WHERE status != 'cancelled') as order_revenue,
+        (SELECT COALESCE(SUM(total_amount), 0) FROM bookings
+         WHERE status != 'cancelled') as booking_revenue,
+        (SELECT COALESCE(SUM(oi.quantity * oi.unit_cost), 0)
+         FROM order_items oi
+         JOIN orders o ON oi.order_id = o.id
+         WHERE o.status != 'cancelled') as order_cost,
+        (SELECT COALESCE(SUM(total_cost), 0) FROM bookings
+         WHERE status != 'cancelled') as course_cost
+"""
+
+KPI_TOTALS_SQL = """
+    SELECT
+        SUM(id = %s) as has_catalog_row,
+        CAST(SUM(products) AS SIGNED) as products,
+        CAST(SUM(courses) AS SIGNED) as courses,
+        CAST(SUM(orders) AS SIGNED) as orders,
+        CAST(SUM(bookings) AS SIGNED) as bookings,
+        CAST(SUM(customers) AS SIGNED) as customers,
+        CAST(SUM(posts) AS SIGNED) as posts,
+        SUM(order_revenue) as order_revenue,
+        SUM(booking_revenue) as booking_revenue,
+        SUM(order_cost) as order_cost,
+        SUM(course_cost) as course_cost
+    FROM kpi_summary
+"""
+
+
+def adjust_kpis(cursor, **deltas):
+    """
+    累加 kpi_summary 的欄位，例如 adjust_kpis(cursor, orders=1, order_revenue=500)
+    只有目錄計數 (例如 customers=1) 時更新 id = 1，其餘隨機寫入一個分片列 (沒有就建立)
+    需由呼叫端 commit (與業務資料同一個 transaction)
+    """
+    columns = [c for c in KPI_COLUMNS if deltas.get(c)]
+    if not columns:
+        return
+
+    if all(c in KPI_CATALOG_COLUMNS for c in columns):
+        # id = 1 尚未建立時不補建 (get_kpi_summary 會全量計算)
+        set_sql = ', '.join(f"{c} = {c} + %s" for c in columns)
+        cursor.execute(
+            f"UPDATE kpi_summary SET {set_sql} WHERE id = %s",
+            [deltas[c] for c in columns] + [KPI_ROW_ID])
+        return
+
+    row_id = KPI_ROW_ID + random.randint(1, KPI_SHARDS)
+    update_sql = ', '.join(f"{c} = {c} + VALUES({c})" for c in columns)
+    cursor.execute(f"""
+        INSERT INTO kpi_summary (id, {', '.join(columns)})
+        VALUES (%s, {', '.join(['%s'] * len(columns))})
+        ON DUPLICATE KEY UPDATE {update_sql}
+    """, [row_id] + [deltas[c] for c in columns])
+
+
+def apply_order_kpis(cursor, order_id, sign=1):
+    """
+    訂單計入 (sign=1) 或移出 (sign=-1) 後台總覽統計與客戶統計
+    例如補登訂單、取消 / 恢復訂單時
+    """
+    cursor.execute("""
+        SELECT o.customer_id, o.total_amount, o.created_at,
+               (SELECT COALESCE(SUM(oi.quantity * oi.unit_cost), 0)
+                FROM order_items oi
+                WHERE oi.order_id = o.id) as cost
+        FROM orders o
+        WHERE o.id = %s
+    """, (order_id,))
+    row = cursor.fetchone()
+    if not row:
+        return
+
+    amount = row['total_amount'] or 0
+    mark_rollup_stale(cursor, row['created_at'])
+    adjust_customer_stats(cursor, row['customer_id'], orders=sign,
+                          order_spent=sign * amount,
+                          activity_at=row['created_at'] if sign > 0 else None)
+    adjust_kpis(cursor, orders=sign, order_revenue=sign * amount,
+                order_cost=sign * (row['cost'] or 0))
+
+
+def apply_booking_kpis(cursor, booking_id, sign=1):
+    """預約計入 (sign=1) 或移出 (sign=-1) 後台總覽統計與客戶統計"""
+    cursor.execute("""
+        SELECT customer_id, total_amount, created_at, COALESCE(total_cost, 0) as cost
+        FROM bookings
+        WHERE id = %s
+    """, (booking_id,))
+    row = cursor.fetchone()
+    if not row:
+        return
+
+    amount = row['total_amount'] or 0
+    mark_rollup_stale(cursor, row['created_at'])
+    adjust_customer_stats(cursor, row['customer_id'], bookings=sign,
+                          booking_spent=sign * amount,
+                          activity_at=row['created_at'] if sign > 0 else None)
+    adjust_kpis(cursor, bookings=sign, booking_revenue=sign * amount,
+                course_cost=sign * (row['cost'] or 0))
+
+
+def status_kpi_sign(old_status, new_status):
+    """狀態變更對統計的影響：進入取消 -1、離開取消 +1、其他 0"""
+    if old_status != 'cancelled' and new_status == 'cancelled':
+        return -1
+    if old_status == 'cancelled' and new_status != 'cancelled':
+        return 1
+    return 0
+
+
+def refresh_catalog_kpis(cursor):
+    """重新計數產品 / 課程 / 客戶 / 已發布文章 (後台異動時呼叫，需由呼叫端 commit)"""
+    cursor.execute("""
+        UPDATE kpi_summary SET
+            products = (SELECT COUNT(*) FROM products WHERE is_active = TRUE),
+            courses = (SELECT COUNT(*) FROM courses WHERE is_active = TRUE),
+            customers = (SELECT COUNT(*) FROM users WHERE role = 'customer'),
+            posts = (SELECT COUNT(*) FROM blog_posts WHERE status = 'published')
+        WHERE id = %s
+    """, (KPI_ROW_ID,))
+
+
+def get_kpi_summary(cursor):
+    """後台總覽統計 (加總 kpi_summary 的幾列)；尚未建立時先全量計算"""
+    cursor.execute(KPI_TOTALS_SQL, (KPI_ROW_ID,))
+    row = cursor.fetchone()
+    if not row or not row['has_catalog_row']:
+        row, _ = rebuild_kpi_summary()
+    return row
+
+
+def rebuild_kpi_summary():
+    """
+    從原始資料全量重算 kpi_summary (上線初始化或校正用)，分片列合併回 id = 1
+    Returns: (新的統計, {欄位: (舊值, 新值)} 有差異的欄位)
+    """
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        # 鎖住所有列，重算期間的結帳 / 預約會等這個 transaction 結束
+        cursor.execute("SELECT id FROM kpi_summary FOR UPDATE")
+        cursor.execute(KPI_TOTALS_SQL, (KPI_ROW_ID,))
+        totals = cursor.fetchone()
+        old = totals if totals['has_catalog_row'] else {}
+
+        cursor.execute(KPI_FULL_SQL)
+        fresh = cursor.fetchone()
+
+        cursor.execute("DELETE FROM kpi_summary WHERE id != %s", (KPI_ROW_ID,))
+        cursor.execute(f"""
+            REPLACE INTO kpi_summary (id, {', '.join(KPI_COLUMNS)})
+            VALUES (%s, {', '.join(['%s'] * len(KPI_COLUMNS))})
+        """, [KPI_ROW_ID] + [fresh[c] for c in KPI_COLUMNS])
+        database.connection.commit()
+    except Exception:
+        database.connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    diffs = {
+        c: (old.get(c), fresh[c]) for c in KPI_COLUMNS
+        if old.get(c) is None or old[c] != fresh[c]
+    }
+    return fresh, diffs
+
+
+# =====================================================
+# CUSTOMER STATS (每位客戶的累計統計)
+# =====================================================
+# customer_stats 保存每位客戶「未取消」的訂單 / 預約數、消費金額與最後消費時間，
+# 和 kpi_summary 一起在建立、取消、恢復的 transaction 內增減 (見 apply_order_kpis)。
+# 後台客戶列表與客戶分析直接讀取，不必 JOIN orders × bookings 再 GROUP BY。
+
+CUSTOMER_STATS_FULL_SQL = """
+    INSERT INTO customer_stats
+        (customer_id, order_count, booking_count, order_spent, booking_spent, last_activity_at)
+    SELECT u.id,
+           COALESCE(o.order_count, 0), COALESCE(b.booking_count, 0),
+           COALESCE(o.order_spent, 0), COALESCE(b.booking_spent, 0),
+           NULLIF(GREATEST(COALESCE(o.last_at, '1000-01-01'), COALESCE(b.last_at, '1000-01-01')),
+                  '1000-01-01')
+    FROM users u
+    LEFT JOIN (
+        SELECT customer_id, COUNT(*) as order_count, SUM(total_amount) as order_spent,
+               MAX(created_at) as last_at
+        FROM orders WHERE status != 'cancelled'
+        GROUP BY customer_id
+    ) o ON o.customer_id = u.id
+    LEFT JOIN (
+        SELECT customer_id, COUNT(*) as booking_count, SUM(total_amount) as booking_spent,
+               MAX(created_at) as last_at
+        FROM bookings WHERE status != 'cancelled'
+        GROUP BY customer_id
+    ) b ON b.customer_id = u.id
+    WHERE u.role = 'customer'
+"""
+
+
+def adjust_customer_stats(cursor, customer_id, orders=0, bookings=0,
+                          order_spent=0, booking_spent=0, activity_at=None,
+                          activity_now=False):
+    """
+    累加單一客戶的統計 (沒有資料列時自動建立)
+    activity_at：新訂單 / 預約的時間，只會往後更新 last_activity_at
+    activity_now=True：以資料庫的 NOW() 作為 activity_at (剛寫入的訂單 / 預約用，
+                       與 created_at 同為 +08:00；Python 端的 datetime.now() 是 UTC)
+    需由呼叫端 commit
+    """
+    if not customer_id:
+        return
+
+    activity_sql = 'NOW()' if activity_now else '%s'
+    params = [customer_id, orders, bookings, order_spent, booking_spent]
+    if not activity_now:
+        params.append(activity_at)
+
+    cursor.execute(f"""
+        INSERT INTO customer_stats
+            (customer_id, order_count, booking_count, order_spent, booking_spent, last_activity_at)
+        VALUES (%s, %s, %s, %s, %s, {activity_sql})
+        ON DUPLICATE KEY UPDATE
+            order_count = GREATEST(order_count + VALUES(order_count), 0),
+            booking_count = GREATEST(booking_count + VALUES(booking_count), 0),
+            order_spent = order_spent + VALUES(order_spent),
+            booking_spent = booking_spent + VALUES(booking_spent),
+            last_activity_at = GREATEST(COALESCE(last_activity_at, VALUES(last_activity_at)),
+                                        COALESCE(VALUES(last_activity_at), last_activity_at))
+    """, tuple(params))
+
+
+def rebuild_customer_stats():
+    """從 orders / bookings 全量重算 customer_stats (初次上線或資料校正用)，回傳客戶數"""
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute("DELETE FROM customer_stats")
+        cursor.execute(CUSTOMER_STATS_FULL_SQL)
+        count = cursor.rowcount
+        database.connection.commit()
+    except Exception:
+        database.connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return count
@@ -1,22 +1,85 @@
-from flask import Blueprint, render_template, request, session, flash, redirect, url_for, jsonify, abort
+from flask import Blueprint, render_template, request, session, flash, redirect, url_for, jsonify, abort, make_response, current_app
 from .decorators import login_required, customer_required
 from project.extensions import database
 from .db import get_current_user_id, get_current_user_role, is_logged_in
+from .instrumentation import query_budget
+from .search import product_search_clause
+from .cache import homepage_cache, popular_cache, schedule_cache, invalidate_schedule_cache
+from .counters import post_view_counter
+from .services import (StockShortage, adjust_customer_stats, adjust_kpis, apply_order_kpis,
+                       decrement_stock, get_popular_products, record_product_sales,
+                       reserve_slot, run_with_lock_retry)
 # 引入新的通知函式
 from .notifications import notify_contact_message, notify_new_order_created, notify_new_booking_created
 import MySQLdb.cursors
+import base64
+import hashlib
+import json
 from datetime import datetime, timedelta
 
 main_bp = Blueprint('main', __name__)
 
 
+# =====================================================
+# KEYSET PAGINATION CURSOR
+# =====================================================
+
+def encode_page_cursor(*parts):
+    """例如 (created_at, id) -> 不透明的 URL-safe 字串"""
+    raw = '|'.join(
+        p.isoformat() if isinstance(p, datetime) else str(p) for p in parts)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_page_cursor(token):
+    """解析 encode_page_cursor 的結果 (字串 list)；格式錯誤回傳 None"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return base64.urlsafe_b64decode(padded).decode().split('|')
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
 # =====================================================
 # HOME PAGE
 # =====================================================
 
 @main_bp.route('/')
+@query_budget(5)
 def home():
     """Homepage with latest products and courses"""
+    # ⭐ 首頁區塊走程序內快取，後台修改產品/課程/文章時會清除
+    featured = homepage_cache.get_or_load(
+        'featured', load_homepage_blocks,
+        ttl=current_app.config.get('HOMEPAGE_CACHE_TTL'))
+
+    # Testimonials
+    testimonials = [
+        {
+            'content': '晶品的課程非常專業，讓我的壓力得到很好的釋放，強烈推薦！',
+            'author': '王小姐'
+        },
+        {
+            'content': '產品品質很好，服務也很貼心，會繼續支持！',
+            'author': '李先生'
+        },
+        {
+            'content': '第一次體驗芳療就選擇晶品，真的沒有失望，環境舒適放鬆。',
+            'author': '陳小姐'
+        }
+    ]
+
+    return render_template(
+        'index.html',
+        products=featured['products'],
+        courses=featured['courses'],
+        posts=featured['posts'],
+        testimonials=testimonials
+    )
+
+
+def load_homepage_blocks():
+    """首頁三個區塊的資料 (快取 miss 時才會執行)"""
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
     # Get featured products (latest 6)
@@ -52,6 +115,8 @@ def home():
     """)
     posts = cursor.fetchall()
 
+    cursor.close()
+
     # Convert datetime to string for template
     for post in posts:
         if post['published_at']:
@@ -59,31 +124,11 @@ def home():
         else:
             post['date'] = ''
 
-    # Testimonials
-    testimonials = [
-        {
-            'content': '晶品的課程非常專業，讓我的壓力得到很好的釋放，強烈推薦！',
-            'author': '王小姐'
-        },
-        {
-            'content': '產品品質很好，服務也很貼心，會繼續支持！',
-            'author': '李先生'
-        },
-        {
-            'content': '第一次體驗芳療就選擇晶品，真的沒有失望，環境舒適放鬆。',
-            'author': '陳小姐'
-        }
-    ]
-
-    cursor.close()
-
-    return render_template(
-        'index.html',
-        products=featured_products,
-        courses=featured_courses,
-        posts=posts,
-        testimonials=testimonials
-    )
+    return {
+        'products': featured_products,
+        'courses': featured_courses,
+        'posts': posts,
+    }
 
 
 # =====================================================
@@ -91,54 +136,103 @@ def home():
 # =====================================================
 
 @main_bp.route('/products')
+@query_budget(5)  # 列表 3 + context processor 導覽分類 (快取過期時 2)
 def products():
-    """Product listing page with infinite scroll"""
+    """
+    Product listing page with infinite scroll
+
+    - after=<cursor>：無限捲動用的游標
+      一般瀏覽為 Keyset 分頁 (created_at, id)，每一頁成本都跟第一頁相同；
+      搜尋結果依相關度排序，游標內容為位移量
+    - page=<n>：舊的 OFFSET 分頁，保留給既有連結相容
+    """
     page = request.args.get('page', 1, type=int)
     category_id = request.args.get('category', type=int)
     search = request.args.get('q', '').strip()
+    after = request.args.get('after')
     per_page = 15
+
+    after_key = None
     offset = (page - 1) * per_page
+    if after:
+        parts = decode_page_cursor(after)
+        try:
+            if search:
+                offset = int(parts[0])
+            else:
+                after_key = (datetime.fromisoformat(parts[0]), int(parts[1]))
+        except (TypeError, ValueError, IndexError):
+            abort(400)
 
     cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
 
     # Build query
     where_clauses = ["p.is_active = TRUE"]
     params = []
+    score_sql, score_params = "0", []
 
     if category_id:
         where_clauses.append("p.category_id = %s")
         params.append(category_id)
 
     if search:
-        where_clauses.append("(p.name LIKE %s OR p.description LIKE %s)")
-        params.extend([f'%{search}%', f'%{search}%'])
+        # ⭐ FULLTEXT (ngram) 搜尋，依相關度排序
+        search_sql, search_params, score_sql, score_params = product_search_clause(
+            search)
+        where_clauses.append(search_sql)
+        params.extend(search_params)
+        order_sql = "relevance DESC, p.id DESC"
+    else:
+        order_sql = "p.created_at DESC, p.id DESC"
+
+    if after_key:
+        # 從上一頁最後一筆 (created_at, id) 之後接著讀，走 idx_products_active_created
+        where_clauses.append(
+            "(p.created_at < %s OR (p.created_at = %s AND p.id < %s))")
+        params.extend([after_key[0], after_key[0], after_key[1]])
+        offset = 0
 
     where_sql = " AND ".join(where_clauses)
 
+    # 多抓一筆用來判斷是否還有下一頁
     sql = f"""
         SELECT p.id, p.name, p.price, p.image, p.description, p.stock_quantity,
-               pc.name as category_name
+               p.created_at, pc.name as category_name,
+               {score_sql} as relevance
         FROM products p
         LEFT JOIN product_categories pc ON p.category_id = pc.id
         WHERE {where_sql}
-        ORDER BY p.created_at DESC
+        ORDER BY {order_sql}
         LIMIT %s OFFSET %s
     """
-    params.extend([per_page, offset])
+    params = score_params + params + [per_page + 1, offset]
 
     cursor.execute(sql, params)
-    products_list = cursor.fetchall()
+    products_list = list(cursor.fetchall())
 
     cursor.close()
 
+    next_cursor = None
+    if len(products_list) > per_page:
+        products_list = products_list[:per_page]
+        if search:
+            next_cursor = encode_page_cursor(offset + per_page)
+        else:
+            last = products_list[-1]
+            next_cursor = encode_page_cursor(last['created_at'], last['id'])
+
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return render_template('products_partial.html', products=products_list)
+        response = make_response(render_template(
+            'products_partial.html', products=products_list))
+        response.headers['X-Next-Cursor'] = next_cursor or ''
+        return response
 
     return render_template(
         'products.html',
         products=products_list,
         current_category=category_id,
-        search_query=search
+        search_query=search,
+        next_cursor=next_cursor
     )
 
 
@@ -255,10 +349,12 @@ def course_detail(course_id):
 
 
 @main_bp.route('/api/course/<int:course_id>/schedule')
+@query_budget(1)
 def get_course_schedule(course_id):
     """
     API for FullCalendar
     Modified: 讀取全店共用時段 (shop_schedules)，限制預約時間
+    ⭐ 依日期範圍快取 + ETag：行事曆切換月份時未變動的範圍直接回 304
     """
     import traceback  # 用來印出錯誤堆疊
 
@@ -287,63 +383,77 @@ def get_course_schedule(course_id):
             # 預設抓 60 天，避免跨年邏輯錯誤
             end_date = start_date + timedelta(days=60)
 
-        # 3. 執行資料庫查詢
-        cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute("SET time_zone = '+08:00'")
+        # 早於後天的時段不開放，直接把查詢下限往後推 (也讓快取 key 每天自然換新)
+        range_start = max(start_date.replace(tzinfo=None), start_limit)
+        range_end = end_date.replace(tzinfo=None)
 
-        # 查詢語句 (確保欄位名稱與 shop_schedules 表格一致)
+        # 3. 讀取快取 (時段異動時會精準清除涵蓋該時間的範圍)
+        body, etag = schedule_cache.get_or_load(
+            (range_start, range_end),
+            lambda: load_schedule_events(range_start, range_end),
+            ttl=current_app.config.get('SCHEDULE_CACHE_TTL'))
+
+        response = current_app.response_class(
+            body, mimetype='application/json')
+        response.set_etag(etag)
+        # 瀏覽器可以存，但每次都要帶 If-None-Match 回來驗證
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    except Exception as e:
+        # ⭐ 關鍵：將錯誤印在伺服器 Log，並回傳空陣列避免前端崩潰
+        print(f"API Error in get_course_schedule: {e}")
+        traceback.print_exc()
+        return jsonify([]), 500
+
+
+def load_schedule_events(range_start, range_end):
+    """
+    查詢 [range_start, range_end] 內可顯示的時段
+    Returns: (json_body, etag)
+    """
+    cursor = database.connection.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        # 過濾條件全部在 SQL 完成 (走 unique_start_time 索引做範圍掃描)：
+        # - 晚上 7 點以後的時段不顯示 (HOUR > 19)
+        # - 人數設為 0 視為休息
         cursor.execute("""
             SELECT id, start_time, end_time, max_capacity, current_bookings
             FROM shop_schedules
             WHERE start_time BETWEEN %s AND %s
               AND is_active = TRUE
-        """, (start_date, end_date))
-
+              AND HOUR(start_time) <= 19
+              AND max_capacity > 0
+            ORDER BY start_time
+        """, (range_start, range_end))
         db_schedules = cursor.fetchall()
+    finally:
         cursor.close()
 
-        events = []
-
-        # 4. 轉換資料格式
-        for s in db_schedules:
-            # 過濾掉「早於後天」的時段 (在 Python 層過濾比較安全)
-            # 注意：這裡要處理 timezone aware vs naive 的問題，簡單起見直接比較 timestamp 或字串
-            if s['start_time'] < start_limit:
-                continue
-
-            # 過濾掉「晚上7點以後」的時段 (HOUR > 19)
-            if s['start_time'].hour > 19:
-                continue
-
-            is_full = s['current_bookings'] >= s['max_capacity']
-            remaining = s['max_capacity'] - s['current_bookings']
-
-            # 若人數設為 0，視為休息
-            if s['max_capacity'] <= 0:
-                continue
-
-            events.append({
-                'id': str(s['id']),
-                'title': f"{'額滿' if is_full else '可預約'} ({remaining})",
-                'start': s['start_time'].isoformat(),
-                'end': s['end_time'].isoformat(),
-                'backgroundColor': '#dc3545' if is_full else '#28a745',
-                'borderColor': '#dc3545' if is_full else '#28a745',
-                'textColor': '#fff',
-                'extendedProps': {
-                    'isFull': is_full,
-                    'scheduleId': s['id'],
-                    'dateStr': s['start_time'].strftime('%Y-%m-%d %H:%M')
-                }
-            })
-
-        return jsonify(events)
+    events = []
 
-    except Exception as e:
-        # ⭐ 關鍵：將錯誤印在伺服器 Log，並回傳空陣列避免前端崩潰
-        print(f"API Error in get_course_schedule: {e}")
-        traceback.print_exc()
-        return jsonify([]), 500
+    # 4. 轉換資料格式
+    for s in db_schedules:
+        is_full = s['current_bookings'] >= s['max_capacity']
+        remaining = s['max_capacity'] - s['current_bookings']
+
+        events.append({
+            'id': str(s['id']),
+            'title': f"{'額滿' if is_full else '可預約'} ({remaining})",
+            'start': s['start_time'].isoformat(),
+            'end': s['end_time'].isoformat(),
+            'backgroundColor': '#dc3545' if is_full else '#28a745',
+            'borderColor': '#dc3545' if is_full else '#28a745',
+            'textColor': '#fff',
+            'extendedProps': {
+                'isFull': is_full,
+                'scheduleId': s['id'],
+                'dateStr': s['start_time'].strftime('%Y-%m-%d %H:%M')
+            }
+        })
+
+    body = json.dumps(events, ensure_ascii=False).encode('utf-8')
+    return body, hashlib.sha256(body).hexdigest()[:32]
 
 
 # =====================================================
@@ -372,12 +482,10 @@ def post_detail(post_id):
             abort(404)
 
         # 2. Increment view count (增加觀看數)
-        cursor.execute("""
-            UPDATE blog_posts
-            SET views = views + 1
-            WHERE id = %s
-        """, (post_id,))
-        database.connection.commit()
+        # ⭐ 先累積在記憶體，由背景執行緒批次寫回，讀取路徑不做任何寫入
+        post_view_counter.increment(post_id)
+        post['views'] = (post.get('views') or 0) + \
+            post_view_counter.pending(post_id)
 
         # 3. Get related posts (取得相關文章)
         cursor.execute("""
@@ -390,34 +498,11 @@ def post_detail(post_id):
         related_posts = cursor.fetchall()
 
         # =========================================================
-        # 4. Get Popular Products (⭐ 新增：取得熱門產品)
-        # 邏輯：關聯 products -> order_items -> orders
-        # 排除取消訂單，依照銷售數量 (SUM quantity) 排序
+        # 4. Get Popular Products (⭐ 取得熱門產品)
+        # 讀取預先累計的 product_sales_stats (結帳/取消時即時增減)，
+        # 不再每次 SUM 整個 order_items；沒有銷售紀錄時回傳最新產品
         # =========================================================
-        cursor.execute("""
-            SELECT p.*, c.name as category_name, SUM(oi.quantity) as total_sold
-            FROM products p
-            JOIN order_items oi ON p.id = oi.product_id
-            JOIN orders o ON oi.order_id = o.id
-            LEFT JOIN product_categories c ON p.category_id = c.id
-            WHERE o.status != 'cancelled' AND p.is_active = 1
-            GROUP BY p.id
-            ORDER BY total_sold DESC
-            LIMIT 3
-        """)
-        popular_products = cursor.fetchall()
-
-        # 5. Fallback (備案：如果沒有銷售紀錄，隨機抓 3 個產品)
-        if not popular_products:
-            cursor.execute("""
-                SELECT p.*, c.name as category_name
-                FROM products p
-                LEFT JOIN product_categories c ON p.category_id = c.id
-                WHERE p.is_active = 1
-                ORDER BY p.id DESC
-                LIMIT 3
-            """)
-            popular_products = cursor.fetchall()
+        popular_products = get_popular_products(3)
         # =========================================================
 
     except Exception as e:
@@ -479,6 +564,8 @@ def blog():
 
     # Format dates
     for post in posts:
+        post['views'] = (post.get('views') or 0) + \
+            post_view_counter.pending(post['id'])
         if post['published_at']:
             post['date'] = post['published_at'].strftime('%Y-%m-%d')
         else:
@@ -650,6 +737,7 @@ def remove_from_cart(item_id):
 # =====================================================
 
 @main_bp.route('/cart/checkout', methods=['POST'])
+@query_budget(12)
 @login_required
 @customer_required
 def checkout():
@@ -676,7 +764,7 @@ def checkout():
         cursor.execute("""
             SELECT
                 ci.id, ci.quantity, ci.product_id,
-                p.name, p.price, p.stock_quantity
+                p.name, p.price, p.cost, p.stock_quantity
             FROM cart_items ci
             JOIN products p ON ci.product_id = p.id
             WHERE ci.cart_id = %s AND p.is_active = TRUE
@@ -688,7 +776,7 @@ def checkout():
             cursor.close()
             return redirect(url_for('main.cart'))
 
-        # 3. Stock validation
+        # 3. Stock validation (快速檢查；最終以步驟 6 的條件式扣庫存為準)
         for item in items:
             if item['stock_quantity'] < item['quantity']:
                 flash(f'「{item["name"]}」庫存不足', 'error')
@@ -706,31 +794,31 @@ def checkout():
         order_id = cursor.lastrowid
 
         # 6. Insert order_items + reduce stock + log
-        for item in items:
-            subtotal = item['price'] * item['quantity']
-
-            # Insert order item record
-            cursor.execute("""
-                INSERT INTO order_items
-                (order_id, product_id, quantity, unit_price, subtotal)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (order_id, item['product_id'], item['quantity'], item['price'], subtotal))
-
-            # Reduce inventory
-            cursor.execute("""
-                UPDATE products
-                SET stock_quantity = stock_quantity - %s
-                WHERE id = %s
-            """, (item['quantity'], item['product_id']))
-
-            # Write inventory log
-            cursor.execute("""
-                INSERT INTO inventory_logs
-                (product_id, change_amount, change_type, reference_id, created_by)
-                VALUES (%s, %s, 'sale', %s, %s)
-            """, (item['product_id'], -item['quantity'], order_id, user_id))
-
-        # 7. Clear cart
+        # ⭐ 批次寫入：不論購物車幾項商品，都是固定幾次 round-trip
+        # 先扣庫存 (條件式 UPDATE)，不足就整筆 rollback
+        decrement_stock(cursor, items)
+
+        cursor.executemany("""
+            INSERT INTO order_items
+            (order_id, product_id, quantity, unit_price, unit_cost, subtotal)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, [
+            (order_id, item['product_id'], item['quantity'],
+             item['price'], item['cost'], item['price'] * item['quantity'])
+            for item in items
+        ])
+
+        cursor.executemany("""
+            INSERT INTO inventory_logs
+            (product_id, change_amount, change_type, reference_id, created_by)
+            VALUES (%s, %s, 'sale', %s, %s)
+        """, [
+            (item['product_id'], -item['quantity'], order_id, user_id)
+            for item in items
+        ])
+
+        # 7. Update sales ranking + clear cart
+        record_product_sales(cursor, items)
         cursor.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart_id,))
 
         # 8. Get user info
@@ -741,10 +829,17 @@ def checkout():
         """, (user_id,))
         user = cursor.fetchone()
 
+        # 9. 客戶統計 + 後台總覽統計 (放在 commit 前最後一步，縮短 kpi_summary 列鎖的持有時間)
+        adjust_customer_stats(cursor, user_id, orders=1, order_spent=total,
+                              activity_now=True)
+        adjust_kpis(cursor, orders=1, order_revenue=total,
+                    order_cost=sum((item['cost'] or 0) * item['quantity'] for item in items))
+
         database.connection.commit()
         cursor.close()
+        popular_cache.invalidate()
 
-        # 9. Send notification
+        # 10. Send notification
         try:
             items_text = '\n'.join([
                 f"- {item['name']} x {item['quantity']}"
@@ -764,6 +859,13 @@ def checkout():
 
         return redirect(url_for('main.checkout_success', order_id=order_id))
 
+    except StockShortage as e:
+        # 結帳期間庫存被其他訂單買走
+        database.connection.rollback()
+        cursor.close()
+        flash(str(e), 'error')
+        return redirect(url_for('main.cart'))
+
     except Exception as e:
         database.connection.rollback()
         if 'cursor' in locals():
@@ -831,6 +933,9 @@ def cancel_order(order_id):
                 VALUES (%s, %s, 'return', %s, %s)
             """, (item['product_id'], item['quantity'], order_id, user_id))
 
+        # 扣回熱門產品銷量
+        record_product_sales(cursor, items, sign=-1)
+
         # Update order status
         cursor.execute("""
             UPDATE orders 
@@ -838,8 +943,11 @@ def cancel_order(order_id):
             WHERE id = %s
         """, (order_id,))
 
+        apply_order_kpis(cursor, order_id, sign=-1)
+
         database.connection.commit()
         cursor.close()
+        popular_cache.invalidate()
 
         flash('訂單已取消,庫存已恢復', 'success')
         return redirect(url_for('customer.orders'))
@@ -1001,6 +1109,7 @@ def booking_success(booking_id):
 # =====================================================
 
 @main_bp.route('/course/<int:course_id>/book', methods=['POST'])
+@query_budget(9)
 @login_required
 @customer_required
 def book_course(course_id):
@@ -1025,12 +1134,12 @@ def book_course(course_id):
         if not course:
             raise Exception("課程不存在")
 
-        # 3. 檢查時段是否存在且有名額 (鎖定行以防超賣)
+        # 3. 讀取時段 (一般讀取不上鎖，只用來提早擋掉已關閉 / 已額滿的時段)
         # ⭐ 重點修正：查詢 shop_schedules (全店共用時段)，而非 course_schedules
         cursor.execute("""
-            SELECT * FROM shop_schedules 
-            WHERE id = %s AND is_active = TRUE 
-            FOR UPDATE
+            SELECT id, start_time, max_capacity, current_bookings
+            FROM shop_schedules
+            WHERE id = %s AND is_active = TRUE
         """, (schedule_id,))
         schedule = cursor.fetchone()
 
@@ -1041,10 +1150,10 @@ def book_course(course_id):
             raise Exception("抱歉，該時段剛剛已額滿，請選擇其他時間")
 
         # 4. 判斷是否為首購 (決定價格)
-        cursor.execute(
-            "SELECT COUNT(*) as count FROM bookings WHERE customer_id = %s", (user_id,))
-        booking_count = cursor.fetchone()['count']
-        is_first_time = (booking_count == 0)
+        cursor.execute("""
+            SELECT EXISTS(SELECT 1 FROM bookings WHERE customer_id = %s) AS has_booking
+        """, (user_id,))
+        is_first_time = not cursor.fetchone()['has_booking']
 
         # 計算金額
         if is_first_time and course.get('experience_price') and course['experience_price'] > 0:
@@ -1052,40 +1161,54 @@ def book_course(course_id):
         else:
             final_price = course['regular_price']
 
-        # 5. 寫入預約 (bookings)
-        # ⭐ 重點修正：寫入 global_schedule_id
-        cursor.execute("""
-            INSERT INTO bookings 
-            (customer_id, course_id, global_schedule_id, total_amount, 
-             is_first_time, sessions_purchased, sessions_remaining, status, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending', NOW())
-        """, (
-            user_id,
-            course_id,
-            schedule_id,
-            final_price,
-            is_first_time,
-            course['sessions'],  # 購買堂數
-            course['sessions']  # 剩餘堂數
-        ))
-        booking_id = cursor.lastrowid
-
-        # 6. 更新時段人數 (shop_schedules)
-        cursor.execute("""
-            UPDATE shop_schedules 
-            SET current_bookings = current_bookings + 1 
-            WHERE id = %s
-        """, (schedule_id,))
+        # ⭐ 成本快照：之後修改課程費用不影響這筆預約的成本
+        course_cost = course['sessions'] * (
+            (course.get('service_fee') or 0) + (course.get('product_fee') or 0))
 
-        # 7. 取得用戶資料 (發通知用)
+        # 5. 取得用戶資料 (發通知用)
         cursor.execute(
             "SELECT firstname, surname, email FROM users WHERE id = %s", (user_id,))
         user = cursor.fetchone()
 
-        database.connection.commit()
+        def reserve_and_insert():
+            # 6. 原子性佔用名額 (條件式 UPDATE，額滿則丟出 SlotUnavailable)
+            # 先鎖時段再寫 bookings，外鍵檢查才不會和其他人互相卡住
+            reserve_slot(cursor, schedule_id)
+
+            # 7. 寫入預約 (bookings)
+            # ⭐ 重點修正：寫入 global_schedule_id
+            cursor.execute("""
+                INSERT INTO bookings 
+                (customer_id, course_id, global_schedule_id, total_amount, total_cost,
+                 is_first_time, sessions_purchased, sessions_remaining, status, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending', NOW())
+            """, (
+                user_id,
+                course_id,
+                schedule_id,
+                final_price,
+                course_cost,
+                is_first_time,
+                course['sessions'],  # 購買堂數
+                course['sessions']  # 剩餘堂數
+            ))
+            booking_id = cursor.lastrowid
+
+            # 8. 客戶統計 + 後台總覽統計 (kpi_summary 一律最後才鎖，和結帳的上鎖順序一致)
+            adjust_customer_stats(cursor, user_id, bookings=1, booking_spent=final_price,
+                                  activity_now=True)
+            adjust_kpis(cursor, bookings=1, booking_revenue=final_price,
+                        course_cost=course_cost)
+
+            database.connection.commit()
+            return booking_id
+
+        # 時段列鎖只在 6 ~ commit 之間持有；遇到 deadlock 自動重試
+        booking_id = run_with_lock_retry(reserve_and_insert)
+        invalidate_schedule_cache(schedule['start_time'])
 
         # ==========================================
-        # 8. 發送通知 (LINE + Email)
+        # 9. 發送通知 (LINE + Email)
         # ==========================================
         try:
             from .notifications import notify_new_booking_created